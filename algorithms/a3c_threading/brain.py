@@ -1,4 +1,5 @@
 import time
+from threading import Lock
 
 import tensorflow as tf
 from colorama import Fore, Style
@@ -6,6 +7,7 @@ from keras.models import *
 
 import algorithms.a3c_threading.params as params
 from algorithms.a3c_threading.memory import Memory
+from util.graph_rollout import GraphRollout
 from util.loss_functions import huber_loss
 
 class Brain:
@@ -27,6 +29,10 @@ class Brain:
         # the loss function for training is set up here
         self.__setup_training()
 
+        # all optimizer threads share the rollout variables of the graph
+        # one optimizer uploads and trains on its rollout, before the next one can replace it
+        self.rollout_lock = Lock()
+
         # running tensorflow in a multithreaded environment requires additional setup work
         # and freezing the resulting graph
         self.model.model._make_predict_function()
@@ -41,14 +47,23 @@ class Brain:
         # due to keras' restrictions on loss functions,
         # we use tensorflow to create a minimization step for the custom loss
 
-        # placeholders
-        self.action_mask = Input(shape=(params.NUM_ACTIONS,), name="action_mask")
+        # the rollout of an update is uploaded once, the minibatches are gathered from it inside the graph
+        self.rollout = GraphRollout({
+            "observations": (self.model.INPUT_SHAPE, self.model.OBSERVATION_DTYPE),
+            "states": (self.model.STATE_SHAPE, tf.float32),
+            "action_mask": ((params.NUM_ACTIONS,), tf.float32),
+            "advantages": ((1,), tf.float32),
+            "target_values": ((1,), tf.float32)})
+        minibatch = self.rollout.minibatch
+
+        self.action_mask = minibatch["action_mask"]
+        self.target_value = minibatch["target_values"]
 
-        self.target_value = Input(shape=(1,), name="target_value")
-        self.advantage = Input(shape=(1,), name="advantage")
+        # z-normalization of the advantages, within every minibatch
+        advantage_mean, advantage_variance = tf.nn.moments(minibatch["advantages"], axes=[0])
+        self.advantage = (minibatch["advantages"] - advantage_mean) / (tf.sqrt(advantage_variance) + 1e-8)
 
-        pred_values = self.model.pred_value
-        policy = self.model.pred_policy
+        policy, pred_values = self.model.apply(minibatch["observations"], minibatch["states"])
 
         # loss formulation of A3C
         chosen_action = policy * self.action_mask
@@ -94,17 +109,7 @@ class Brain:
          advantages,
          terminals, lengths) = batch
 
-        from_observations = np.array(from_observations)
-        from_states = np.array(from_states)
-        to_observations = np.array(to_observations)
-        to_states = np.array(to_states)
-        pred_policies = np.array(pred_policies).reshape((-1, params.NUM_ACTIONS))
-        pred_values = np.array(pred_values).reshape((-1, 1))
-        actions = np.vstack(actions).reshape((-1, params.NUM_ACTIONS))
-        rewards = np.vstack(rewards)
-        terminals = np.vstack(terminals)
-        advantages = np.vstack(advantages).reshape((-1, 1))
-        lengths = np.vstack(lengths)
+        # the memory keeps every field in an array, with one row per transition
 
         num_samples = from_observations.shape[0]
 
@@ -116,35 +121,26 @@ class Brain:
         target_values = advantages + pred_values
         # advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
 
-        indices = np.arange(num_samples)
-
-        for epoch in range(params.NUM_EPOCHS):
-            np.random.shuffle(indices)
+        with self.rollout_lock:
+            # the whole rollout is copied into the graph once, the minibatches only feed their indices
+            self.rollout.upload(self.session, {
+                "observations": from_observations,
+                "states": from_states,
+                "action_mask": actions,
+                "advantages": advantages,
+                "target_values": target_values})
 
-            for idx in range(num_samples // params.BATCH_SIZE):
-                lower_idx = idx * params.BATCH_SIZE
-                upper_idx = (idx + 1) * params.BATCH_SIZE
-                batch_indices = indices[lower_idx:upper_idx]
+            indices = np.arange(num_samples)
 
-                batch_observations = from_observations[batch_indices]
-                batch_states = from_states[batch_indices]
-                batch_policies = pred_policies[batch_indices]
-                batch_values = pred_values[batch_indices]
-                batch_action_mask = actions[batch_indices]
-                batch_advantages = advantages[batch_indices]
-                batch_target_values = target_values[batch_indices]
+            for epoch in range(params.NUM_EPOCHS):
+                np.random.shuffle(indices)
 
-                # z-normalization
-                batch_advantages = (batch_advantages - batch_advantages.mean()) / (batch_advantages.std() + 1e-8)
+                for idx in range(num_samples // params.BATCH_SIZE):
+                    lower_idx = idx * params.BATCH_SIZE
+                    upper_idx = (idx + 1) * params.BATCH_SIZE
+                    batch_indices = indices[lower_idx:upper_idx]
 
-                # the model is responsible for plugging in observations and states as needed
-                model_feed_dict = self.model.create_feed_dict(batch_observations, batch_states)
-
-                self.session.run(self.minimize_step, feed_dict={
-                    **model_feed_dict,
-                    self.action_mask: batch_action_mask,
-                    self.advantage: batch_advantages,
-                    self.target_value: batch_target_values})
+                    self.session.run(self.minimize_step, feed_dict=self.rollout.create_feed_dict(batch_indices))
 
         print(Fore.RED)
         print("policy updated")
@@ -159,5 +155,8 @@ class Brain:
     def preprocess(self, observation):
         return self.model.preprocess(observation)
 
+    def preprocess_batch(self, observations, out=None):
+        return self.model.preprocess_batch(observations, out)
+
     def get_initial_state(self):
         return self.model.get_initial_state()
@@ -1,53 +1,32 @@
 import threading
-import time
-
-import numpy as np
 
 import algorithms.a3c_threading.params as params
+from util.rollout_buffer import RolloutBuffer
 
 
-class Memory:
+class Memory(RolloutBuffer):
     def __init__(self):
-        # from_state, from_memory, to_state, to_memory, action, reward, advantage, terminal, length
+        # from_observation, from_state, to_observation, to_state, policy, value, action, reward, advantage, terminal, length
         # the length is the number of steps between from and to
         # this allows the agents to push observations of arbitrary length
-        self.train_queue = [[], [], [], [], [], [], [], [], [], [], []]
+        RolloutBuffer.__init__(self, params.MEM_SIZE + params.NUM_STEPS)
         self.lock = threading.Lock()
 
-    def __len__(self):
-        return len(self.train_queue[0])
+        # the agents wait on it while the memory is full, popping wakes them
+        self.not_full = threading.Condition(self.lock)
 
     def pop(self, size=None):
         with self.lock:
-            if size is None:
-                size = len(self)
-            retval = [entry[:size] for entry in self.train_queue]
-            self.train_queue = [entry[size:] for entry in self.train_queue]
-
-            return retval
+            batch = RolloutBuffer.pop(self, size)
+            self.not_full.notify_all()
+            return batch
 
-    def push(self, batch):
+    def push_many(self, batch):
 
-        while (len(self) >= params.MEM_SIZE):
-            time.sleep(
-                params.WAITING_TIME)  # yield control, if all agents sleep, brain gets to optimize away the memory
+        # the size is checked under the lock, the brain can't pop in between
+        # if all agents wait, the brain gets to optimize away the memory
+        with self.not_full:
+            while len(self) >= params.MEM_SIZE:
+                self.not_full.wait()
 
-        with self.lock:
-            from_state, from_memory, to_state, to_memory, policy, value, action, reward, advantage, terminal, length = batch
-            assert action.shape == (params.NUM_ACTIONS,)
-            assert type(reward) in [np.float, np.float64]
-            assert type(advantage) in [np.float, np.float64]
-            assert type(terminal) == bool
-            assert type(length) == int
-
-            self.train_queue[0].append(from_state)
-            self.train_queue[1].append(from_memory)
-            self.train_queue[2].append(to_state)
-            self.train_queue[3].append(to_memory)
-            self.train_queue[4].append(policy)
-            self.train_queue[5].append(value)
-            self.train_queue[6].append(action)
-            self.train_queue[7].append(reward)
-            self.train_queue[8].append(advantage)
-            self.train_queue[9].append(terminal)
-            self.train_queue[10].append(length)
+            RolloutBuffer.push_many(self, batch)
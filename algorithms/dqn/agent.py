@@ -4,11 +4,12 @@ import algorithms.dqn.params as params
 
 
 class Agent:
-    def __init__(self, memory, brain, environment):
+    def __init__(self, memory, brain, environment, exploration=None):
         """
         :param memory: act stores training samples in this memory
         :param brain: act uses this brain to determine actions
         :param environment: agent interacts with this environment
+        :param exploration: a fixed probability of random actions, by default it is annealed
         """
 
         self.memory = memory
@@ -17,23 +18,35 @@ class Agent:
 
         # the internal state of the agent:
         # current probability of random action
-        self.exploration = params.INITIAL_EXPLORATION
+        self.anneal_exploration = exploration is None
+        self.exploration = params.INITIAL_EXPLORATION if exploration is None else exploration
+
+        # preprocesses the frames and stacks them, without allocating new arrays every step
+        self.pipeline = None
 
         self.reset()
 
-    def reset(self):
-        self.observation = self.env.reset()
+    def get_state(self):
+        # what a resumed training needs, the current episode is not continued
+        return {"exploration": self.exploration,
+                "env_random_states": [self.env.np_random.get_state()] if hasattr(self.env, "np_random") else []}
+
+    def set_state(self, state):
+        self.exploration = state["exploration"]
+        if hasattr(self.env, "np_random"):
+            self.env.np_random.set_state(state["env_random_states"][0])
 
+    def reset(self):
         # internally, the brain uses a model, and that can have a state, rnns for example
         if self.brain.stateful:
             self.state = self.brain.get_initial_state()
         else:
             self.state = None
 
-        self.observation = self.brain.preprocess(self.observation)
-
-        if params.FRAME_STACK:
-            self.observation = np.stack([self.observation] * params.FRAME_STACK, axis=-1)
+        # the observation is a view into the frame stack, which the brain allocates once
+        if self.pipeline is None:
+            self.pipeline = self.brain.create_pipeline()
+        self.observation = self.pipeline.reset(self.env.reset())
 
         self.total_reward = 0
 
@@ -75,7 +88,7 @@ class Agent:
             to_state = None
 
         # anneal exploration
-        if self.exploration > params.FINAL_EXPLORATION:
+        if self.anneal_exploration and self.exploration > params.FINAL_EXPLORATION:
             self.exploration -= params.EXPLORATION_STEP
 
         # we only allow a limited amount of repeated actions
@@ -95,25 +108,9 @@ class Agent:
         reward *= params.REWARD_SCALE
         self.total_reward += reward
 
-        # preprocess the new observation
-        from_observation = self.observation
+        # preprocess the new observation, from and to observation are views into the frame stack
         from_state = self.state
-
-        new_observation = self.brain.preprocess(new_observation)
-
-        if params.FRAME_STACK:
-            to_observation = np.zeros_like(self.observation)
-            to_observation[:, :, :-1] = self.observation[:, :, 1:]
-            to_observation[:, :, -1] = new_observation
-        else:
-            to_observation = new_observation
-
-        if not done:
-            self.observation = to_observation
-            self.state = to_state
-        else:
-            print(self.total_reward)
-            self.reset()
+        from_observation, to_observation = self.pipeline.push(new_observation)
 
         # the value that should have been predicted
         # q_target = self.brain.get_targets(to_state, reward, done)
@@ -128,5 +125,121 @@ class Agent:
         # new observations are pushed to the memory with a default priority
         # this means that for most interactions, we don't need to use the brain
         # if the agent is exploring, we don't have to calculate any q values
+        # the memory copies the observations, so this has to happen before the stack changes again
         self.memory.push(from_observation, to_observation, from_state, to_state, action, reward, done,
                          params.DEFAULT_PRIO)
+
+        if not done:
+            self.observation = to_observation
+            self.state = to_state
+        else:
+            print(self.total_reward)
+            self.reset()
+
+
+class VecAgent:
+    def __init__(self, memory, brain, environments):
+        """
+        :param memory: act stores training samples in this memory, it needs one stream per environment
+        :param brain: act uses this brain to determine actions
+        :param environments: the agent interacts with all these environments in lockstep
+        """
+        assert not brain.stateful, "the vectorized agent doesn't support stateful models"
+        assert memory.num_streams == len(environments), "the memory needs one stream per environment"
+
+        self.memory = memory
+        self.brain = brain
+        self.envs = environments
+        self.num_envs = len(environments)
+
+        # the first environment, e.g. for rendering
+        self.env = environments[0]
+
+        # the internal state of the agent:
+        # current probability of random action, shared by all environments
+        self.exploration = params.INITIAL_EXPLORATION
+
+        # the observations of all environments are kept in one frame stack, the brain allocates it
+        self.pipeline = brain.create_pipeline(self.num_envs)
+        self.observations = self.pipeline.observation()
+        self.total_rewards = np.zeros((self.num_envs,))
+
+        # don't repeat actions too often
+        self.last_actions = np.full((self.num_envs,), -1)
+        self.repeat_action_counters = np.zeros((self.num_envs,), dtype=np.int64)
+
+        for i in range(self.num_envs):
+            self.reset(i)
+
+    def get_state(self):
+        # what a resumed training needs, the current episodes are not continued
+        return {"exploration": self.exploration,
+                "env_random_states": [env.np_random.get_state() for env in self.envs if hasattr(env, "np_random")]}
+
+    def set_state(self, state):
+        self.exploration = state["exploration"]
+
+        envs = [env for env in self.envs if hasattr(env, "np_random")]
+        for env, random_state in zip(envs, state["env_random_states"]):
+            env.np_random.set_state(random_state)
+
+    def reset(self, i):
+        self.observations = self.pipeline.reset(self.envs[i].reset(), env=i)
+
+        self.total_rewards[i] = 0
+
+        self.last_actions[i] = -1
+        self.repeat_action_counters[i] = 0
+
+    def act(self):
+        """
+        chooses an action for every environment and applies them.
+        updates the memory to provide training data for the brain
+        :return:
+        """
+
+        # exploration vs exploitation, decided for every environment
+        # q values are only predicted for the exploiting environments, all of them in one batch
+        actions = np.random.randint(params.NUM_ACTIONS, size=self.num_envs)
+        exploit = np.random.rand(self.num_envs) >= self.exploration
+        if np.any(exploit):
+            current_q, _ = self.brain.predict_q(self.observations[exploit], None)
+            actions[exploit] = current_q.argmax(axis=-1)
+
+        # anneal exploration, every environment counts as one interaction
+        self.exploration = max(self.exploration - self.num_envs * params.EXPLORATION_STEP, params.FINAL_EXPLORATION)
+
+        # we only allow a limited amount of repeated actions
+        repeated = actions == self.last_actions
+        self.repeat_action_counters = np.where(repeated, self.repeat_action_counters + 1, 0)
+        too_many = self.repeat_action_counters > params.REPEAT_ACTION_MAX
+        actions[too_many] = np.random.randint(params.NUM_ACTIONS, size=np.count_nonzero(too_many))
+        self.repeat_action_counters[too_many] = 0
+        self.last_actions = actions
+
+        # interact with the environments
+        new_frames = []
+        rewards = np.zeros((self.num_envs,))
+        dones = np.zeros((self.num_envs,), dtype=np.bool)
+        for i, env in enumerate(self.envs):
+            new_observation, rewards[i], dones[i], _ = env.step(actions[i])
+            new_frames.append(new_observation)
+
+        rewards *= params.REWARD_SCALE
+        self.total_rewards += rewards
+
+        # views into the frame stack, the memory copies them
+        from_observations, to_observations = self.pipeline.push(new_frames)
+
+        # new observations are pushed to the memory with a default priority
+        if self.memory.priority_based_sampling:
+            self.memory.push_many(from_observations, to_observations, None, None, actions, rewards, dones,
+                                  np.full((self.num_envs,), params.DEFAULT_PRIO))
+        else:
+            self.memory.push_many(from_observations, to_observations, None, None, actions, rewards, dones)
+
+        # finished environments start their next episode right away
+        self.observations = to_observations
+        for i in np.flatnonzero(dones):
+            print(self.total_rewards[i])
+            self.reset(i)
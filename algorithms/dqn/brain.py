@@ -8,14 +8,19 @@ import keras.backend as K
 
 import algorithms.dqn.params as params
 from algorithms.dqn.memory import Memory
-import os
-import shutil
 
 
 class Brain:
-    def __init__(self, Model, memory: Memory, loss_func="mse", load_path=None):
+    def __init__(self, Model, memory: Memory, loss_func="mse", load_path=None, prefetcher=None):
 
         self.memory = memory
+
+        # if given, the batches are sampled in the background
+        # sequences are sampled by the brain itself, they can't be prefetched
+        self.prefetcher = prefetcher
+        assert prefetcher is None or not (Model.STATEFUL and memory.sequence_mode), \
+            "the sequences of stateful models can't be prefetched, set PREFETCH_BATCHES to 0"
+
         # use this to influence the tensorflow behaviour
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = params.TF_ALLOW_GROWTH
@@ -28,6 +33,7 @@ class Brain:
         self.model = Model()
         self.target_model = Model()
         self.stateful = Model.STATEFUL
+        self.observation_shape = Model.OBSERVATION_SHAPE
 
         self.loss_func = loss_func
 
@@ -36,33 +42,131 @@ class Brain:
 
         self.target_updates = 0
 
-        # cleaning a directory for checkpoints
-        if os.path.exists(os.getcwd() + "/checkpoints/"):
-            shutil.rmtree(os.getcwd() + "/checkpoints/")
-        os.mkdir(os.getcwd() + "/checkpoints/")
-
     def __setup_training(self):
+        model_variables = self.model.trainable_weights
+        target_model_variables = self.target_model.trainable_weights
+        self.optimizer = tf.train.RMSPropOptimizer(learning_rate=params.LEARNING_RATE, decay=params.RHO,
+                                                   epsilon=params.EPSILON)
 
-        self.q_target = Input(shape=(params.NUM_ACTIONS,))
+        if self.stateful:
+            self.__setup_stateful_training()
+        else:
+            self.__setup_fused_training()
 
-        loss_q = self.loss_func(self.q_target, self.model.q_values_masked)
+        self.assignments = [tf.assign(to_var, from_var) for (to_var, from_var) in
+                            zip(target_model_variables, model_variables)]
 
+    def __setup_stateful_training(self):
+        # stateful models get their states through their own inputs, see create_feed_dict
+        # the states come from the memory or from running the model over sequences
+        # the targets and priorities are computed with predict, outside of the graph
+        self.q_targets = Input(shape=(params.NUM_ACTIONS,))
+        self.sample_weights = Input(shape=(1,))
+
+        loss_q = self.loss_func(self.q_targets, self.model.q_values_masked, self.sample_weights)
         loss = loss_q + self.model.loss_regularization
 
-        model_variables = self.model.trainable_weights
-        target_model_variables = self.target_model.trainable_weights
-        optimizer = tf.train.RMSPropOptimizer(learning_rate=params.LEARNING_RATE, decay=params.RHO, epsilon=params.EPSILON)
-        gradients_variables = optimizer.compute_gradients(loss, model_variables)
+        self.minimize_step = self.__minimize(loss)
+
+    def __setup_fused_training(self):
+        # the whole training step is a single graph:
+        # targets from both models, the loss, the optimizer step and the new priorities
+        # this way, a training step needs only one session call
+
+        # the batch, as it is sampled from the memory
+        self.from_observations = Input(shape=self.observation_shape)
+        self.to_observations = Input(shape=self.observation_shape)
+        self.actions = tf.placeholder(tf.int32, shape=(None,))
+        self.rewards = tf.placeholder(tf.float32, shape=(None,))
+        self.terminals = tf.placeholder(tf.float32, shape=(None,))
+        self.discounts = tf.placeholder(tf.float32, shape=(None,))
+
+        # importance sampling weights, they correct the bias of prioritized sampling
+        self.sample_weights = Input(shape=(1,))
+
+        loss, self.priorities = self.__build_td_graph(self.from_observations, self.to_observations, self.actions,
+                                                       self.rewards, self.terminals, self.discounts,
+                                                       self.sample_weights)
+
+        self.minimize_step = self.__minimize(loss, self.priorities)
+
+        self.__setup_multi_batch_training()
+
+    def __minimize(self, loss, priorities=None):
+        gradients_variables = self.optimizer.compute_gradients(loss, self.model.trainable_weights)
         if not params.GRADIENT_NORM_CLIP is None:
             gradients, variables = zip(*gradients_variables)
             gradients, gradient_norms = tf.clip_by_global_norm(gradients, params.GRADIENT_NORM_CLIP)
             gradients_variables = zip(gradients, variables)
-        minimize_step = optimizer.apply_gradients(gradients_variables)
 
-        self.minimize_step = minimize_step
+        if priorities is None:
+            return self.optimizer.apply_gradients(gradients_variables)
+
+        # the priorities are computed from the q values before the update
+        with tf.control_dependencies([priorities]):
+            return self.optimizer.apply_gradients(gradients_variables)
+
+    def __setup_multi_batch_training(self):
+        # several batches, stacked along a new first axis, are trained on in a loop inside the graph
+        # this saves the python and session overhead of every single step, which dominates for small models
+        # the optimizer already has its slots, the steps in the loop update the same ones
+        self.stacked_from_observations = tf.placeholder(tf.float32, shape=(None, None, *self.observation_shape))
+        self.stacked_to_observations = tf.placeholder(tf.float32, shape=(None, None, *self.observation_shape))
+        self.stacked_actions = tf.placeholder(tf.int32, shape=(None, None))
+        self.stacked_rewards = tf.placeholder(tf.float32, shape=(None, None))
+        self.stacked_terminals = tf.placeholder(tf.float32, shape=(None, None))
+        self.stacked_discounts = tf.placeholder(tf.float32, shape=(None, None))
+        self.stacked_sample_weights = tf.placeholder(tf.float32, shape=(None, None, 1))
+
+        num_batches = tf.shape(self.stacked_actions)[0]
+
+        def train_step(i, priorities):
+            loss, batch_priorities = self.__build_td_graph(self.stacked_from_observations[i],
+                                                           self.stacked_to_observations[i],
+                                                           self.stacked_actions[i],
+                                                           self.stacked_rewards[i],
+                                                           self.stacked_terminals[i],
+                                                           self.stacked_discounts[i],
+                                                           self.stacked_sample_weights[i])
+            minimize_step = self.__minimize(loss, batch_priorities)
+
+            # the next step has to see the updated weights
+            with tf.control_dependencies([minimize_step]):
+                return i + 1, priorities.write(i, batch_priorities)
+
+        _, priorities = tf.while_loop(lambda i, priorities: i < num_batches, train_step,
+                                      (tf.constant(0), tf.TensorArray(tf.float32, size=num_batches)),
+                                      parallel_iterations=1)
+
+        # the priorities of all batches, with shape (batches, batch size)
+        self.stacked_priorities = priorities.stack()
+
+    def __build_td_graph(self, from_observations, to_observations, actions, rewards, terminals, discounts,
+                         sample_weights):
+        # the models are applied to the given tensors, they share their weights with the models' own inputs
+        action_mask = tf.one_hot(actions, params.NUM_ACTIONS)
+        all_actions = tf.ones_like(action_mask)
+
+        q_values_masked = self.model.model([from_observations, action_mask])
+
+        # double dqn: the model chooses the next action, the target model evaluates it
+        next_q = self.model.model([to_observations, all_actions])
+        next_q_target = self.target_model.model([to_observations, all_actions])
+        next_actions = tf.one_hot(tf.argmax(next_q, axis=-1), params.NUM_ACTIONS)
+        chosen_q = tf.reduce_sum(next_q_target * next_actions, axis=-1)
 
-        self.assignments = [tf.assign(to_var, from_var) for (to_var, from_var) in
-                            zip(target_model_variables, model_variables)]
+        # this is the value that should be predicted by the network
+        # for n-step targets, the rewards are already accumulated and the discount is GAMMA ** n
+        q_targets = tf.stop_gradient(rewards + discounts * chosen_q * (1 - terminals))
+        q_targets_masked = tf.expand_dims(q_targets, axis=-1) * action_mask
+
+        loss_q = self.loss_func(q_targets_masked, q_values_masked, sample_weights)
+        loss = loss_q + self.model.loss_regularization
+
+        errors = tf.reduce_sum(tf.abs(q_targets_masked - q_values_masked), axis=-1)
+        priorities = tf.pow(errors + params.ERROR_BIAS, params.ERROR_POW)
+
+        return loss, priorities
 
     # the following methods will simply be routed to the model
     # this routing is not really elegant but I didn't want to expose the model outside of the brain
@@ -70,6 +174,12 @@ class Brain:
     def preprocess(self, observation):
         return self.model.preprocess(observation)
 
+    def preprocess_batch(self, observations, out=None):
+        return self.model.preprocess_batch(observations, out)
+
+    def create_pipeline(self, num_envs=None):
+        return self.model.create_pipeline(num_envs)
+
     def get_initial_state(self):
         return self.model.get_initial_state()
 
@@ -79,52 +189,178 @@ class Brain:
     def predict_q_target(self, observation, state):
         return self.target_model.predict(observation, state)
 
-    def get_targets(self, to_observations, to_states, rewards, done):
+    def get_targets(self, to_observations, to_states, rewards, terminals, discounts):
+        # double dqn targets in numpy, for stateful models
         next_q_target, _ = self.predict_q_target(to_observations, to_states)
         next_q, _ = self.predict_q(to_observations, to_states)
         chosen_q = next_q_target[np.arange(next_q.shape[0]), next_q.argmax(axis=-1)]
 
         # this is the value that should be predicted by the network
-        q_targets = rewards + params.GAMMA * chosen_q * (1 - done)
+        return rewards + discounts * chosen_q * (1 - terminals)
+
+    def compute_priorities(self, from_observations, to_observations, actions, rewards, terminals, discounts):
+        # priorities of transitions that are not in the memory yet, e.g. for actors filling a remote memory
+        assert not self.stateful, "the priorities of stateful models need their states"
+        return self.sess.run(self.priorities, feed_dict={
+            self.from_observations: from_observations,
+            self.to_observations: to_observations,
+            self.actions: actions,
+            self.rewards: rewards,
+            self.terminals: terminals,
+            self.discounts: discounts
+        })
 
-        return q_targets
+    def get_weights(self):
+        return self.model.model.get_weights(), self.target_model.model.get_weights()
+
+    def set_weights(self, weights):
+        model_weights, target_model_weights = weights
+        self.model.model.set_weights(model_weights)
+        self.target_model.model.set_weights(target_model_weights)
+
+    def train_many(self, num_batches):
+        assert not self.stateful, "stateful models train one batch at a time"
+
+        # the batches are sampled like num_batches calls of train_once sample them, one at a time,
+        # from the prefetcher if there is one. the only difference: all of them are sampled before the training,
+        # so the later batches don't see the priorities the earlier steps of this call compute
+        if self.prefetcher is None:
+            samples = [self.memory.sample_batch() for i in range(num_batches)]
+        else:
+            samples = [self.prefetcher.get() for i in range(num_batches)]
+        training_indices, sample_weights, batches, number_writes = zip(*samples)
+
+        def stack(field):
+            # the field of all batches, with shape (num_batches, BATCH_SIZE, ...)
+            return np.stack([batch[field] for batch in batches])
+
+        # the batches are trained on in a single session call
+        priorities = self.sess.run(self.stacked_priorities, feed_dict={
+            self.stacked_from_observations: stack(0),
+            self.stacked_to_observations: stack(1),
+            self.stacked_actions: stack(4),
+            self.stacked_rewards: stack(5),
+            self.stacked_terminals: stack(6),
+            self.stacked_discounts: stack(7),
+            self.stacked_sample_weights: np.stack(sample_weights)[..., None]
+        })
+
+        if self.memory.priority_based_sampling:
+            for batch_indices, batch_priorities, batch_number_writes in zip(training_indices, priorities,
+                                                                            number_writes):
+                self.memory.update_priority(batch_indices, batch_priorities, batch_number_writes)
 
     def update_target_model(self):
         self.sess.run(self.assignments)
 
         self.target_updates += 1
 
-        # save the target network every N steps
-        if self.target_updates % params.SAVE_NETWORK_FREQ == 0:
-            self.target_model.model.save("checkpoints/dqn_model{}.hd5".format(self.target_updates + 120))
+    def get_state(self):
+        # everything the training depends on: the weights of both models and the optimizer slots
+        variables = self.__training_variables()
+        return {"variable_names": [variable.name for variable in variables],
+                "variable_values": self.sess.run(variables),
+                "target_updates": self.target_updates}
 
-    def train_once(self):
+    def set_state(self, state):
+        variables = {variable.name: variable for variable in self.__training_variables()}
+        assert set(variables) == set(state["variable_names"]), "the state doesn't match the models"
 
-        # sample batch with priority as weight, train on it
-        training_indices = self.memory.sample_indices()
-        batch = self.memory[training_indices]
+        for name, value in zip(state["variable_names"], state["variable_values"]):
+            variables[name].load(value, self.sess)
+        self.target_updates = state["target_updates"]
 
-        from_observations, to_observations, from_states, to_states, actions, rewards, terminals = batch
+    def __training_variables(self):
+        return self.model.model.weights + self.target_model.model.weights + self.optimizer.variables()
 
-        # create a one-hot mask for the actions
-        action_mask = np.zeros((actions.shape[0], params.NUM_ACTIONS))
-        action_mask[np.arange(actions.shape[0]), actions] = 1
+    def train_once(self):
+        if self.stateful and self.memory.sequence_mode:
+            self.__train_on_sequences()
+            return
 
-        q_targets = self.get_targets(to_observations, to_states, rewards, terminals)
+        # sample batch with priority as weight, train on it
+        if self.prefetcher is None:
+            training_indices, sample_weights, batch, number_writes = self.memory.sample_batch()
+        else:
+            training_indices, sample_weights, batch, number_writes = self.prefetcher.get()
+
+        from_observations, to_observations, from_states, to_states, actions, rewards, terminals, discounts = batch
+
+        if self.stateful:
+            priorities = self.__train_stateful(batch, sample_weights)
+        else:
+            priorities, _ = self.sess.run([self.priorities, self.minimize_step], feed_dict={
+                self.from_observations: from_observations,
+                self.to_observations: to_observations,
+                self.actions: actions,
+                self.rewards: rewards,
+                self.terminals: terminals,
+                self.discounts: discounts,
+                self.sample_weights: sample_weights.reshape((-1, 1))
+            })
+
+        if self.memory.priority_based_sampling:
+            # the batch may have been sampled a while ago, overwritten slots keep their new priority
+            self.memory.update_priority(training_indices, priorities, number_writes)
+
+    def __train_stateful(self, batch, sample_weights):
+        # one training step of a stateful model, returns the priorities of the batch
+        from_observations, to_observations, from_states, to_states, actions, rewards, terminals, discounts = batch
+
+        action_mask = np.eye(params.NUM_ACTIONS)[actions]
+        q_targets = self.get_targets(to_observations, to_states, rewards, terminals, discounts)
         q_targets = q_targets.reshape((-1, 1)) * action_mask
 
+        # like the fused graph, the priorities are computed from the q values before the update
+        q_predicted, _ = self.predict_q(from_observations, from_states)
+        errors = np.abs(q_targets - q_predicted * action_mask).sum(axis=-1)
+        priorities = np.power(errors + params.ERROR_BIAS, params.ERROR_POW)
+
         model_feed_dict = self.model.create_feed_dict(from_observations, from_states, action_mask)
         self.sess.run(self.minimize_step, feed_dict={
             **model_feed_dict,
-            self.q_target: q_targets
+            self.q_targets: q_targets,
+            self.sample_weights: np.reshape(sample_weights, (-1, 1))
         })
 
-        if (self.memory.priority_based_sampling):
-            q_predicted, _ = self.predict_q(from_observations, from_states)
-            q_predicted *= action_mask
-
-            errors = np.abs(q_targets - q_predicted)
-            errors = errors.sum(axis=-1)
-            priorities = np.power(errors + params.ERROR_BIAS, params.ERROR_POW)
-
-            self.memory.update_priority(training_indices, priorities)
+        return priorities
+
+    def __train_on_sequences(self):
+        # recurrent training from the sequences of the memory, only their start states are stored
+        # the model runs over every sequence to recompute the states of all its transitions
+        # the burn-in transitions only warm up the states, the others are trained on, as one batch
+        starts = self.memory.sample_sequences(params.BATCH_SIZE)
+        from_observations, to_observations, start_states, actions, rewards, terminals, valid = \
+            self.memory.get_sequences(starts)
+
+        num_sequences, length = actions.shape
+        initial_state = np.asarray(self.get_initial_state())
+
+        states = np.array(start_states)
+        from_states = np.empty((num_sequences, length, *states.shape[1:]), dtype=np.float32)
+        to_states = np.empty_like(from_states)
+        for t in range(length):
+            from_states[:, t] = states
+            _, states = self.predict_q(from_observations[:, t], states)
+            to_states[:, t] = states
+
+            # the next transition of a finished episode starts the next episode
+            episode_end = terminals[:, t].reshape((-1, *[1] * (states.ndim - 1)))
+            states = np.where(episode_end, initial_state, states)
+
+        # the n-step targets bootstrap from the to observation and state of a later transition of the sequence
+        last, rewards, terminals, discounts = self.memory.get_sequence_returns(rewards, terminals)
+        sequence_index = np.arange(num_sequences)[:, None]
+        to_observations = to_observations[sequence_index, last]
+        to_states = to_states[sequence_index, last]
+
+        def training_part(array):
+            return array[:, params.BURN_IN_LENGTH:].reshape((-1, *array.shape[2:]))
+
+        batch = (training_part(from_observations), training_part(to_observations), training_part(from_states),
+                 training_part(to_states), training_part(actions), training_part(rewards), training_part(terminals),
+                 training_part(discounts))
+
+        # the sequences are sampled uniformly, they have no priorities
+        # transitions after the end of the episode the sequence starts in are not trained on
+        self.__train_stateful(batch, training_part(valid).astype(np.float32))
@@ -0,0 +1,122 @@
+# checkpoints of the whole training state:
+# the weights of both models, the optimizer slots, the exploration, the counters and the random states
+# a snapshot is taken in memory, which only takes as long as copying the weights
+# a background thread writes it to disk, the training never waits for that
+# only the newest CHECKPOINT_KEEP checkpoints are kept
+#
+# the replay memory is not part of the checkpoints, it resumes from its own memory maps
+import os
+import pickle
+import threading
+
+import numpy as np
+
+import algorithms.dqn.params as params
+
+
+class Checkpointer:
+    def __init__(self, directory=params.CHECKPOINT_DIR, keep=params.CHECKPOINT_KEEP):
+        """
+        :param directory: checkpoint directory, relative to the working directory
+        :param keep: number of checkpoints that are kept
+        """
+        assert keep >= 1, "at least one checkpoint has to be kept"
+        self.directory = os.path.join(os.getcwd(), directory)
+        self.keep = keep
+        os.makedirs(self.directory, exist_ok=True)
+
+        # the snapshot waiting to be written
+        # if a new one arrives before the writer gets to it, only the new one is written
+        self.pending = None
+        self.writing = False
+        self.stopped = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, name="checkpoint_writer", daemon=True)
+        self.thread.start()
+
+    def snapshot(self, brain, agent, counters):
+        """
+        :param brain: its weights, optimizer slots and counters are copied
+        :param agent: its exploration and the random states of its environments are copied, can be None
+        :param counters: dict of the training loop's counters, e.g. the number of interactions
+        """
+        return {"counters": dict(counters),
+                "brain": brain.get_state(),
+                "agent": agent.get_state() if agent is not None else None,
+                "random_state": np.random.get_state()}
+
+    def save(self, snapshot):
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify_all()
+
+    def restore(self, snapshot, brain, agent):
+        # returns the counters of the training loop
+        brain.set_state(snapshot["brain"])
+        if agent is not None:
+            agent.set_state(snapshot["agent"])
+        np.random.set_state(snapshot["random_state"])
+
+        return snapshot["counters"]
+
+    def checkpoint_paths(self):
+        # oldest first, the names contain the number of the checkpoint
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith("checkpoint_") and name.endswith(".pkl"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def load_latest(self):
+        paths = self.checkpoint_paths()
+        if len(paths) == 0:
+            return None
+
+        with open(paths[-1], "rb") as file:
+            return pickle.load(file)
+
+    def clear(self):
+        for path in self.checkpoint_paths():
+            os.remove(path)
+
+    def close(self):
+        # waits until the last snapshot is on disk
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+                snapshot = self.pending
+                self.pending = None
+                self.writing = True
+
+            try:
+                self._write(snapshot)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def _write(self, snapshot):
+        # the checkpoints are numbered after the existing ones, which also works after a restart
+        paths = self.checkpoint_paths()
+        number = int(os.path.basename(paths[-1])[len("checkpoint_"):-len(".pkl")]) + 1 if paths else 0
+        path = os.path.join(self.directory, "checkpoint_{:08d}.pkl".format(number))
+
+        # write to a temporary file first, so that a crash never leaves a broken checkpoint
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        for old_path in self.checkpoint_paths()[:-self.keep]:
+            os.remove(old_path)
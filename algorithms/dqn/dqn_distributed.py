@@ -0,0 +1,221 @@
+# distributed prioritized replay, following the ape-x paper (horgan et al., 2018)
+# several actor processes interact with their own environments, using their own copies of the model
+# they compute the initial priorities of their transitions and send them in chunks to the learner
+# the learner owns the replay memory, trains on it and regularly sends its weights back to the actors
+#
+# every actor explores with its own fixed probability, from mostly random to mostly greedy
+import queue
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf  # if tf is not imported first, it crashes :)
+from tqdm import tqdm
+
+import algorithms.dqn.params as params
+from algorithms.dqn.agent import Agent
+from algorithms.dqn.brain import Brain
+from algorithms.dqn.checkpoint import Checkpointer
+from algorithms.dqn.memory import Priority_Memory
+from algorithms.dqn.models import DQN_Model
+from algorithms.dqn.prefetcher import BatchPrefetcher
+from environments.obstacle_car.environment_graphical import Environment_Graphical as Environment
+from util.loss_functions import huber_loss
+
+
+class LearnerMemory(Priority_Memory):
+    # the chunks of the actors are interleaved, so consecutive slots don't hold consecutive transitions
+    # this switches off frame deduplication and n-step returns
+    single_writer = False
+
+
+class ActorBuffer:
+    # takes the place of the memory in the actor's agent
+    # the transitions are collected until a chunk is full, then their priorities are computed in one batch
+    priority_based_sampling = True
+
+    def __init__(self, brain, chunk_queue):
+        self.brain = brain
+        self.chunk_queue = chunk_queue
+        self.num_chunks = 0
+        self.clear()
+
+    def clear(self):
+        self.from_observations = []
+        self.to_observations = []
+        self.actions = []
+        self.rewards = []
+        self.terminals = []
+
+    def push(self,
+             from_observation: np.array,
+             to_observation: np.array,
+             from_state: np.array,
+             to_state: np.array,
+             action: np.uint8,
+             reward: np.float32,
+             terminal: np.bool,
+             priority: float):
+        # the agent's observations are views into its frame stack, they change with the next step
+        self.from_observations.append(np.array(from_observation))
+        self.to_observations.append(np.array(to_observation))
+        self.actions.append(action)
+        self.rewards.append(reward)
+        self.terminals.append(terminal)
+
+        if len(self.actions) == params.ACTOR_CHUNK_SIZE:
+            self.send()
+
+    def send(self):
+        chunk = (np.array(self.from_observations, dtype=np.uint8),
+                 np.array(self.to_observations, dtype=np.uint8),
+                 np.array(self.actions, dtype=np.uint8),
+                 np.array(self.rewards, dtype=np.float32),
+                 np.array(self.terminals, dtype=np.bool))
+        self.clear()
+
+        # the priorities come from the actor's own, slightly outdated, weights
+        from_observations, to_observations, actions, rewards, terminals = chunk
+        discounts = np.full(actions.shape, params.GAMMA)
+        priorities = self.brain.compute_priorities(from_observations, to_observations, actions, rewards, terminals,
+                                                   discounts)
+
+        self.chunk_queue.put((*chunk, priorities))
+        self.num_chunks += 1
+
+
+def run_actor(actor_id, exploration, chunk_queue, weight_queue, stop_event):
+    # every actor needs its own random numbers, the brain seeds numpy when it is imported
+    np.random.seed(actor_id + 1)
+
+    brain = Brain(DQN_Model, None, loss_func=huber_loss)
+    buffer = ActorBuffer(brain, chunk_queue)
+    agent = Agent(buffer, brain, Environment(), exploration=exploration)
+
+    num_chunks = 0
+    while not stop_event.is_set():
+        agent.act()
+
+        # new weights are only looked for after sending a chunk
+        if buffer.num_chunks == num_chunks:
+            continue
+        num_chunks = buffer.num_chunks
+
+        try:
+            brain.set_weights(weight_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+
+def broadcast_weights(brain, weight_queues):
+    weights = brain.get_weights()
+    for weight_queue in weight_queues:
+        # an actor that didn't pick up the last weights gets the new ones instead
+        try:
+            weight_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            weight_queue.put_nowait(weights)
+        except queue.Full:
+            pass
+
+
+def push_chunk(memory, chunk):
+    from_observations, to_observations, actions, rewards, terminals, priorities = chunk
+    memory.push_many(from_observations, to_observations, None, None, actions, rewards, terminals, priorities)
+    return len(actions)
+
+
+if __name__ == "__main__":
+    # tensorflow doesn't survive forking, the actors start fresh interpreters
+    context = multiprocessing.get_context("spawn")
+    chunk_queue = context.Queue(maxsize=params.ACTOR_QUEUE_SIZE)
+    weight_queues = [context.Queue(maxsize=1) for i in range(params.NUM_ACTORS)]
+    stop_event = context.Event()
+
+    actors = []
+    for i in range(params.NUM_ACTORS):
+        exploration = params.ACTOR_EXPLORATION_BASE ** (
+                1 + params.ACTOR_EXPLORATION_ALPHA * i / max(params.NUM_ACTORS - 1, 1))
+        actor = context.Process(target=run_actor, args=(i, exploration, chunk_queue, weight_queues[i], stop_event),
+                                daemon=True)
+        actor.start()
+        actors.append(actor)
+
+    memory = LearnerMemory(DQN_Model)
+    prefetcher = BatchPrefetcher(memory) if params.PREFETCH_BATCHES else None
+    brain = Brain(DQN_Model, memory, loss_func=huber_loss, load_path=None, prefetcher=prefetcher)
+
+    # the actors have fixed explorations, only the learner is checkpointed
+    checkpointer = Checkpointer()
+    snapshot = checkpointer.load_latest() if params.RESUME_TRAINING else None
+    if snapshot is not None:
+        counters = checkpointer.restore(snapshot, brain, None)
+        print("resumed training at step {}".format(counters["training_step"]))
+    else:
+        checkpointer.clear()
+        counters = {"training_step": 0, "interactions": 0}
+
+    broadcast_weights(brain, weight_queues)
+
+    # the training steps of the single process training, the target network is updated equally often
+    total_training_steps = params.TOTAL_INTERACTIONS // params.TRAIN_SKIPS
+    target_update_freq = max(int(params.TARGET_NETWORK_UPDATE_FREQ) // params.TRAIN_SKIPS, 1)
+
+    interactions = counters["interactions"]
+    training_step = counters["training_step"]
+    next_memory_save = interactions + params.SAVE_MEMORY_FREQ
+    next_checkpoint = interactions + params.CHECKPOINT_FREQ
+    progress = tqdm(total=total_training_steps, initial=training_step, smoothing=1)
+    while training_step < total_training_steps:
+
+        # move what the actors sent into the memory, at most one full queue per training step
+        # until the memory is filled, the learner simply waits for the actors
+        for i in range(params.ACTOR_QUEUE_SIZE):
+            try:
+                waiting_for_data = len(memory) < params.REPLAY_START_SIZE
+                interactions += push_chunk(memory, chunk_queue.get(block=waiting_for_data))
+            except queue.Empty:
+                break
+
+        # keep the memory on disk, a restarted training resumes from here
+        if memory.memory_mapped and interactions >= next_memory_save:
+            memory.save()
+            next_memory_save += params.SAVE_MEMORY_FREQ
+
+        # the snapshot is taken now, writing it happens in the background
+        if interactions >= next_checkpoint:
+            checkpointer.save(checkpointer.snapshot(brain, None, {"training_step": training_step,
+                                                                   "interactions": interactions}))
+            next_checkpoint += params.CHECKPOINT_FREQ
+
+        if len(memory) < params.REPLAY_START_SIZE:
+            continue
+
+        brain.train_once()
+        training_step += 1
+        progress.update(1)
+
+        if training_step % target_update_freq == 0:
+            brain.update_target_model()
+
+        if training_step % params.WEIGHT_SYNC_FREQ == 0:
+            broadcast_weights(brain, weight_queues)
+            progress.set_postfix(interactions=interactions)
+
+    stop_event.set()
+    if prefetcher is not None:
+        prefetcher.stop()
+
+    checkpointer.save(checkpointer.snapshot(brain, None, {"training_step": training_step,
+                                                           "interactions": interactions}))
+    checkpointer.close()
+
+    # the actors might wait for a free place in the queue
+    for actor in actors:
+        while actor.is_alive():
+            try:
+                chunk_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        actor.join()
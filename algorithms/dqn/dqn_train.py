@@ -1,3 +1,5 @@
+import threading
+
 import numpy as np
 import tensorflow as tf  # if tf is not imported first, it crashes :)
 from tqdm import tqdm
@@ -6,12 +8,15 @@ print(tf.GRAPH_DEF_VERSION)  # and if I don't use it, autoformatting gets rid of
 
 import algorithms.dqn.params as params
 import environments.obstacle_car.params as env_params
-from algorithms.dqn.agent import Agent
+from algorithms.dqn.agent import Agent, VecAgent
 from algorithms.dqn.memory import Priority_Memory
 from environments.obstacle_car.environment_graphical import Environment_Graphical as Environment
 #from environments.obstacle_car.environment_vec import Environment_Vec as Environment
 from algorithms.dqn.brain import Brain
+from algorithms.dqn.checkpoint import Checkpointer
 from algorithms.dqn.models import DQN_Model, FullyConnectedModel
+from algorithms.dqn.prefetcher import BatchPrefetcher
+from algorithms.dqn.replay_ratio import ReplayRatioController
 
 from util.loss_functions import huber_loss
 
@@ -24,15 +29,62 @@ if vis:
     window = pygame.display.set_mode(env_params.screen_size)
     pygame.display.set_caption("observations")
 
-memory = Priority_Memory(DQN_Model)
-brain = Brain(DQN_Model, memory, loss_func=huber_loss, load_path=None)
-env = Environment()
-agent = Agent(memory, brain, env)
+memory = Priority_Memory(DQN_Model, num_streams=params.NUM_ENVIRONMENTS)
+# the sequences of stateful models are sampled by the brain itself
+prefetcher = BatchPrefetcher(memory) if params.PREFETCH_BATCHES and not memory.sequence_mode else None
+brain = Brain(DQN_Model, memory, loss_func=huber_loss, load_path=None, prefetcher=prefetcher)
+if params.NUM_ENVIRONMENTS > 1:
+    agent = VecAgent(memory, brain, [Environment() for i in range(params.NUM_ENVIRONMENTS)])
+else:
+    agent = Agent(memory, brain, Environment())
+
+# a preempted training continues from its newest checkpoint
+checkpointer = Checkpointer()
+snapshot = checkpointer.load_latest() if params.RESUME_TRAINING else None
+if snapshot is not None:
+    start_interaction = checkpointer.restore(snapshot, brain, agent)["interaction"]
+    print("resumed training at interaction {}".format(start_interaction))
+else:
+    checkpointer.clear()
+    start_interaction = 0
+
+
+def learn(brain, controller, errors):
+    # trains concurrently to the interactions, the controller keeps the replay ratio
+    # the target network is updated as often as in the sequential training
+    target_update_freq = max(int(params.TARGET_NETWORK_UPDATE_FREQ * params.REPLAY_RATIO), 1)
+
+    try:
+        # the graph is thread local, keras looks it up to find its session
+        with brain.sess.graph.as_default():
+            updates = 0
+            while controller.wait_for_update():
+                brain.train_once()
+                controller.update_done()
 
-for interaction in tqdm(range(params.TOTAL_INTERACTIONS), smoothing=1):
+                updates += 1
+                if updates % target_update_freq == 0:
+                    brain.update_target_model()
+    except BaseException as error:
+        # the main thread raises it again, an exception would only end this thread
+        errors.append(error)
+    finally:
+        # the acting side must not wait for updates that never come
+        controller.stop()
+
+
+if params.CONCURRENT_TRAINING:
+    controller = ReplayRatioController(params.REPLAY_RATIO, params.REPLAY_RATIO_TOLERANCE)
+    learner_errors = []
+    learner = threading.Thread(target=learn, args=(brain, controller, learner_errors), daemon=True)
+
+# every act is one interaction per environment
+progress = tqdm(total=params.TOTAL_INTERACTIONS, initial=start_interaction, smoothing=1)
+for interaction in range(start_interaction, params.TOTAL_INTERACTIONS, params.NUM_ENVIRONMENTS):
 
     # let the agent interact with the environment and memorize the result
     agent.act()
+    progress.update(params.NUM_ENVIRONMENTS)
 
     if vis:
         frame = agent.env.render()
@@ -42,18 +94,65 @@ for interaction in tqdm(range(params.TOTAL_INTERACTIONS), smoothing=1):
         pygame.display.update()
         clock.tick(10)
 
+    # keep the memory on disk, a restarted training resumes from here
+    if memory.memory_mapped and interaction % params.SAVE_MEMORY_FREQ < params.NUM_ENVIRONMENTS:
+        memory.save()
+
+    # the snapshot is taken now, writing it happens in the background
+    if interaction % params.CHECKPOINT_FREQ < params.NUM_ENVIRONMENTS and interaction > start_interaction:
+        checkpointer.save(checkpointer.snapshot(brain, agent, {"interaction": interaction}))
+
     # fill the memory before training
-    if interaction < params.REPLAY_START_SIZE:
+    # a resumed memory can already be full enough
+    if len(memory) < params.REPLAY_START_SIZE:
         continue
 
-    # train the network every N steps
-    if interaction % params.TRAIN_SKIPS != 0:
-        continue
+    if params.CONCURRENT_TRAINING:
+        # the interactions are counted from the start of the training
+        # acting waits here if the learner falls behind
+        if learner.ident is None:
+            learner.start()
+        controller.add_interactions(params.NUM_ENVIRONMENTS)
 
-    brain.train_once()
+        # the learner stops the controller if it fails
+        if controller.stopped:
+            break
 
-    # update the target network every N steps
-    if interaction % params.TARGET_NETWORK_UPDATE_FREQ != 0:
+        if interaction % 1000 < params.NUM_ENVIRONMENTS:
+            progress.set_postfix(replay_ratio=controller.ratio())
         continue
 
-    brain.update_target_model()
+    for step in range(interaction, interaction + params.NUM_ENVIRONMENTS):
+        # train the network every N steps
+        # several updates can be done at once, then the training runs less often
+        train_interval = params.TRAIN_SKIPS * params.TRAIN_BATCHES_PER_CALL
+        if step % train_interval != 0:
+            continue
+
+        if params.TRAIN_BATCHES_PER_CALL > 1:
+            brain.train_many(params.TRAIN_BATCHES_PER_CALL)
+        else:
+            brain.train_once()
+
+        # update the target network every N steps
+        if step % params.TARGET_NETWORK_UPDATE_FREQ >= train_interval:
+            continue
+
+        brain.update_target_model()
+
+        # time the training waited for sampled batches, if this grows, more prefetching threads are needed
+        if prefetcher is not None:
+            progress.set_postfix(batch_wait_ms=1000 * prefetcher.mean_wait_time())
+
+if params.CONCURRENT_TRAINING:
+    controller.stop()
+    learner.join()
+
+if prefetcher is not None:
+    prefetcher.stop()
+
+if params.CONCURRENT_TRAINING and learner_errors:
+    raise learner_errors[0]
+
+checkpointer.save(checkpointer.snapshot(brain, agent, {"interaction": params.TOTAL_INTERACTIONS}))
+checkpointer.close()
@@ -1,81 +1,495 @@
 # directory management:
-# delete all previous memory maps
-# and create dirs for checkpoints (if not present)
+# the memory maps are kept between runs, so that a restarted training can resume with a full memory
+# they are only deleted if they don't match the current memory layout
+import copy
+import json
+import multiprocessing
 import os
 import shutil
-from tempfile import mkstemp
+import threading
+from multiprocessing import shared_memory
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 import algorithms.dqn.params as params
+from util.compressed_array import CompressedArray
+from util.segment_tree import MinSegmentTree
 from util.sumtree import SumTree
 
+# increase this whenever the meaning of the stored arrays changes
+# memory maps written with another version are not resumed
+MEMORY_VERSION = 2
+
 
 class Memory():
+    # subclasses that keep their arrays somewhere else can switch off the memory maps
+    supports_memory_maps = True
+
+    # the compressed arrays are python objects, they can't be shared with other processes
+    supports_compression = True
 
-    def __init__(self, Model):
+    # frame deduplication and n-step returns expect consecutive transitions in consecutive slots
+    # a memory with several concurrent writers can't offer that
+    single_writer = True
 
-        # creating a new memory, remove existing memory maps
-        if os.path.exists(os.getcwd() + "/memory_maps/"):
-            shutil.rmtree(os.getcwd() + "/memory_maps/")
-        os.mkdir(os.getcwd() + "/memory_maps/")
+    def __init__(self, Model, num_streams=1):
+        """
+        :param Model: the memory stores observations and states for this model
+        :param num_streams: number of environments that push their transitions together, using push_many
+        """
 
         OBSERVATION_SHAPE = Model.OBSERVATION_SHAPE
 
-        if params.MEMORY_MAPPED:
-            self.from_observation_memory = np.memmap(mkstemp(dir="memory_maps")[0], dtype=np.uint8, mode="w+",
-                                                     shape=(params.REPLAY_MEMORY_SIZE, *OBSERVATION_SHAPE))
-            self.to_observation_memory = np.memmap(mkstemp(dir="memory_maps")[0], dtype=np.uint8, mode="w+",
-                                                   shape=(params.REPLAY_MEMORY_SIZE, *OBSERVATION_SHAPE))
+        # the transitions of one environment (a stream) are num_streams slots apart
+        # this way, frame deduplication and n-step returns still find the next transition of the same episode
+        self.num_streams = num_streams
+        assert params.REPLAY_MEMORY_SIZE % num_streams == 0, "the memory size has to be a multiple of the streams"
+        assert self.single_writer or num_streams == 1, "a memory with several writers only supports one stream"
+
+        # pushing, sampling and priority updates can happen in different threads
+        # the lock keeps the counters, the trees and the written slots consistent
+        self.lock = self._create_lock()
+
+        # the observations can be kept compressed in ram, usually most of the memory fits in there then
+        # without the observations, the memory maps couldn't be resumed, so they are switched off
+        self.compress_observations = params.COMPRESS_OBSERVATIONS and self.supports_compression
+        self.memory_mapped = params.MEMORY_MAPPED and self.supports_memory_maps and not self.compress_observations
+
+        # stacked observations share all but one frame with their predecessor
+        # instead of storing the full stacks, every frame can be written exactly once to a ring buffer
+        # the stacks are rebuilt when sampling
+        self.deduplicate_frames = (self.single_writer and params.DEDUPLICATE_FRAMES and params.FRAME_STACK
+                                   and len(OBSERVATION_SHAPE) == 3)
+        assert self.single_writer or params.N_STEP == 1, "n-step returns need a memory with a single writer"
+
+        # name, shape and dtype of every array in the memory
+        layout = {}
+
+        if self.deduplicate_frames:
+            FRAME_SHAPE = OBSERVATION_SHAPE[:-1]
+
+            # every transition writes one new frame, the newest frame of its to observation
+            # its from frame is the to frame of the previous transition of the same stream
+            # only the first transition of an episode writes its from frame,
+            # into the slot of the to frame of the terminal transition before
+            # the from stacks reach FRAME_STACK - 1 frames of the stream back, and every stream needs a slot for its
+            # very first frame, the additional slots make sure that frames of the oldest transition are never overwritten
+            self.frame_memory_size = params.REPLAY_MEMORY_SIZE + (params.FRAME_STACK + 1) * num_streams
+            layout["frame_memory"] = ((self.frame_memory_size, *FRAME_SHAPE), np.uint8)
+
+            # the slot of the previous frame in the same episode, the first frame of an episode points to itself
+            layout["frame_previous"] = ((self.frame_memory_size,), np.int64)
+
+            # for every transition, the slots of the newest frames of its from and to observation
+            layout["frame_index_memory"] = ((params.REPLAY_MEMORY_SIZE,), np.int64)
+            layout["to_frame_index_memory"] = ((params.REPLAY_MEMORY_SIZE,), np.int64)
+
+            # the next frame slot to write, and the newest frame of every stream (-1 before the first transition)
+            self.frame_write_index = 0
+            self.frame_index = np.full((num_streams,), -1, dtype=np.int64)
+            self.episode_start = np.ones((num_streams,), dtype=np.bool)
         else:
-            self.from_observation_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE, *OBSERVATION_SHAPE),
-                                                    dtype=np.uint8)
-            self.to_observation_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE, *OBSERVATION_SHAPE), dtype=np.uint8)
+            layout["from_observation_memory"] = ((params.REPLAY_MEMORY_SIZE, *OBSERVATION_SHAPE), np.uint8)
+            layout["to_observation_memory"] = ((params.REPLAY_MEMORY_SIZE, *OBSERVATION_SHAPE), np.uint8)
 
         self.stateful = Model.STATEFUL
-        if self.stateful:
+
+        # recurrent models can be trained on contiguous sequences instead of single transitions
+        # only the state at the beginning of every sequence is stored, the model recomputes the others
+        self.sequence_mode = self.stateful and params.SEQUENCE_LENGTH > 0
+        if self.sequence_mode:
+            assert self.single_writer and num_streams == 1, \
+                "sequences need consecutive transitions in consecutive slots"
+            assert params.REPLAY_MEMORY_SIZE % params.SEQUENCE_LENGTH == 0, \
+                "the memory size has to be a multiple of the sequence length"
+
+        if self.sequence_mode:
             STATE_SHAPE = Model.STATE_SHAPE
 
-            if params.MEMORY_MAPPED:
-                self.from_state_memory = np.memmap(mkstemp(dir="memory_maps")[0], dtype=np.uint8, mode="w+",
-                                                   shape=(params.REPLAY_MEMORY_SIZE, *STATE_SHAPE))
-                self.to_state_memory = np.memmap(mkstemp(dir="memory_maps")[0], dtype=np.uint8, mode="w+",
-                                                 shape=(params.REPLAY_MEMORY_SIZE, *STATE_SHAPE))
+            # the state before the from observation of every SEQUENCE_LENGTH-th slot
+            layout["start_state_memory"] = ((params.REPLAY_MEMORY_SIZE // params.SEQUENCE_LENGTH, *STATE_SHAPE),
+                                            np.float32)
+        elif self.stateful:
+            STATE_SHAPE = Model.STATE_SHAPE
 
-            else:
-                self.from_state_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE, *STATE_SHAPE),
-                                                  dtype=np.uint8)
-                self.to_state_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE, *STATE_SHAPE), dtype=np.uint8)
+            layout["from_state_memory"] = ((params.REPLAY_MEMORY_SIZE, *STATE_SHAPE), np.float32)
+            layout["to_state_memory"] = ((params.REPLAY_MEMORY_SIZE, *STATE_SHAPE), np.float32)
 
-        # these other parts of the memory consume only very little memory and can be kept in ram
-        self.action_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE), dtype=np.uint8)
-        self.reward_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE,), dtype=np.int16)
-        self.terminal_memory = np.empty(shape=(params.REPLAY_MEMORY_SIZE,), dtype=np.bool)
+        # these other parts of the memory consume only very little memory
+        # they are memory mapped anyways, to be able to resume the memory
+        layout["action_memory"] = ((params.REPLAY_MEMORY_SIZE,), np.uint8)
+        layout["reward_memory"] = ((params.REPLAY_MEMORY_SIZE,), np.int16)
+        layout["terminal_memory"] = ((params.REPLAY_MEMORY_SIZE,), np.bool)
 
         self.replay_index = 0
         self.number_writes = 0
 
+        # the memory maps are named after the arrays, the metadata stores the counters
+        # if both are present and match the current layout, we simply reattach to the files
+        self.memory_dir = os.path.join(os.getcwd(), params.MEMORY_DIR)
+        self.metadata_path = os.path.join(self.memory_dir, "metadata_v{}.npz".format(MEMORY_VERSION))
+        self.layout = {name: [list(shape), np.dtype(dtype).str] for name, (shape, dtype) in layout.items()}
+
+        metadata = self._load_metadata() if self.memory_mapped and params.RESUME_MEMORY else None
+        self.resumed = metadata is not None
+
+        if self.memory_mapped and not self.resumed:
+            # creating a new memory, remove existing memory maps
+            if os.path.exists(self.memory_dir):
+                shutil.rmtree(self.memory_dir)
+            os.mkdir(self.memory_dir)
+
+        for name, (shape, dtype) in layout.items():
+            setattr(self, name, self._allocate(name, shape, dtype))
+
+        if self.resumed:
+            self._set_state(metadata)
+            print("resumed replay memory with {} transitions".format(len(self)))
+
+    def _create_lock(self):
+        return threading.RLock()
+
+    def _allocate(self, name, shape, dtype):
+        if self.compress_observations and name in ["frame_memory", "from_observation_memory",
+                                                   "to_observation_memory"]:
+            return CompressedArray(shape, dtype,
+                                   compression_level=params.COMPRESSION_LEVEL,
+                                   cache_size=params.DECODE_CACHE_SIZE,
+                                   num_threads=params.DECODE_THREADS)
+
+        # the arrays can be memory mapped to disk
+        if self.memory_mapped:
+            path = os.path.join(self.memory_dir, "{}_v{}.mmap".format(name, MEMORY_VERSION))
+            mode = "r+" if self.resumed else "w+"
+            return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+        else:
+            return np.empty(shape=shape, dtype=dtype)
+
+    def _load_metadata(self):
+        if not os.path.exists(self.metadata_path):
+            return None
+
+        metadata = dict(np.load(self.metadata_path))
+        if json.loads(str(metadata["layout"])) != self.layout or int(metadata["num_streams"]) != self.num_streams:
+            print("the stored replay memory doesn't match the current parameters, creating a new one")
+            return None
+
+        return metadata
+
+    def _get_state(self):
+        # everything that is not in the memory maps
+        state = {"layout": json.dumps(self.layout),
+                 "replay_index": self.replay_index,
+                 "number_writes": self.number_writes,
+                 "num_streams": self.num_streams}
+
+        if self.deduplicate_frames:
+            state["frame_write_index"] = self.frame_write_index
+            state["frame_index"] = self.frame_index
+            state["episode_start"] = self.episode_start
+
+        return state
+
+    def _set_state(self, state):
+        self.replay_index = int(state["replay_index"])
+        self.number_writes = int(state["number_writes"])
+
+        if self.deduplicate_frames:
+            self.frame_write_index = int(state["frame_write_index"])
+            self.frame_index = state["frame_index"].astype(np.int64)
+            self.episode_start = state["episode_start"].astype(np.bool)
+
+    def save(self):
+        # flushes the memory maps to disk and writes the metadata
+        # after a crash, the memory maps can contain writes that are newer than the metadata
+        # those slots are simply overwritten again after resuming
+        assert self.memory_mapped, "only memory mapped memories can be saved"
+
+        with self.lock:
+            for name in self.layout:
+                getattr(self, name).flush()
+
+            # write to a temporary file first, so that a crash never leaves a broken metadata file
+            tmp_path = self.metadata_path + ".tmp"
+            with open(tmp_path, "wb") as file:
+                np.savez(file, **self._get_state())
+            os.replace(tmp_path, self.metadata_path)
+
     def __len__(self):
         return min(self.number_writes, params.REPLAY_MEMORY_SIZE)
 
+    def sample_batch(self, size=params.BATCH_SIZE):
+        # samples indices and reads the transitions
+        # the number of writes at sampling time is returned as well,
+        # it tells which of the slots have been overwritten in the meantime
+        with self.lock:
+            number_writes = self.number_writes
+            indices, weights = self.sample_indices(size)
+
+        return indices, weights, self[indices], number_writes
+
+    def overwritten_since(self, indices, number_writes):
+        # the writes after number_writes went to the slots following the ring buffer position at that time
+        # a slot has been overwritten if its distance to that position is below the number of new writes
+        new_writes = self.number_writes - number_writes
+        if new_writes >= params.REPLAY_MEMORY_SIZE:
+            return np.ones(np.shape(indices), dtype=np.bool)
+
+        distance = (np.asarray(indices) - number_writes) % params.REPLAY_MEMORY_SIZE
+        return distance < new_writes
+
     def __getitem__(self, index):
         assert type(index) in [int, np.ndarray, list], "you are using an unsupported index type"
-        assert max(index) < len(self), "index out of range"
+        assert np.max(index) < len(self), "index out of range"
+        index = np.asarray(index)
 
-        from_observations = self.from_observation_memory[index]
-        to_observations = self.to_observation_memory[index]
+        # for n-step targets, the rewards are accumulated over the following transitions
+        # the to observation is then taken from the last transition of that window
+        if params.N_STEP > 1:
+            to_index, rewards, terminal, discounts = self._n_step_returns(index)
+        else:
+            to_index = index
+            rewards = self.reward_memory[index]
+            terminal = self.terminal_memory[index]
+            discounts = np.full(index.shape, params.GAMMA)
+
+        if self.deduplicate_frames:
+            from_observations = self._stack_frames(self.frame_index_memory[index])
+            to_observations = self._stack_frames(self.to_frame_index_memory[to_index])
+        else:
+            from_observations = self.from_observation_memory[index]
+            to_observations = self.to_observation_memory[to_index]
         actions = self.action_memory[index]
-        rewards = self.reward_memory[index]
-        terminal = self.terminal_memory[index]
 
-        if self.stateful:
+        if self.stateful and not self.sequence_mode:
             from_states = self.from_state_memory[index]
-            to_states = self.to_state_memory[index]
+            to_states = self.to_state_memory[to_index]
         else:
             from_states = None
             to_states = None
 
-        return from_observations, to_observations, from_states, to_states, actions, rewards, terminal
+        return from_observations, to_observations, from_states, to_states, actions, rewards, terminal, discounts
+
+    def sample_sequences(self, size=params.BATCH_SIZE):
+        # sequences start at multiples of SEQUENCE_LENGTH, where the start states are stored
+        # they are extended by BURN_IN_LENGTH transitions, so neighbouring sequences overlap
+        # the model runs over these first transitions only to get a good state for the remaining ones
+        # a sequence can be sampled if it lies completely within the written part of the memory
+        assert self.sequence_mode, "the memory doesn't store sequences"
+        length = params.BURN_IN_LENGTH + params.SEQUENCE_LENGTH
+
+        with self.lock:
+            oldest = self.replay_index if self.number_writes >= params.REPLAY_MEMORY_SIZE else 0
+            starts = np.arange(0, params.REPLAY_MEMORY_SIZE, params.SEQUENCE_LENGTH)
+            available = starts[(starts - oldest) % params.REPLAY_MEMORY_SIZE + length <= len(self)]
+
+        assert size <= len(available), "trying to sample more sequences than available"
+        return np.random.choice(available, size, replace=False)
+
+    def get_sequences(self, starts):
+        """
+        :param starts: first slots of the sequences, as returned by sample_sequences
+        :return: from and to observations, actions, rewards and terminals with shape (sequences, length, ...),
+            the states at the starts of the sequences, and a mask of the transitions belonging to the episode
+            the sequence starts in
+        """
+        starts = np.asarray(starts)
+        length = params.BURN_IN_LENGTH + params.SEQUENCE_LENGTH
+        assert np.all(starts % params.SEQUENCE_LENGTH == 0), "sequences have to start at stored states"
+
+        if self.deduplicate_frames:
+            # the frame stacks are rebuilt as usual
+            from_observations = self._stack_frames(self._read_windows(self.frame_index_memory, starts, length))
+            to_observations = self._stack_frames(self._read_windows(self.to_frame_index_memory, starts, length))
+        else:
+            from_observations = self._read_windows(self.from_observation_memory, starts, length)
+            to_observations = self._read_windows(self.to_observation_memory, starts, length)
+
+        actions = self._read_windows(self.action_memory, starts, length)
+        rewards = self._read_windows(self.reward_memory, starts, length)
+        terminals = self._read_windows(self.terminal_memory, starts, length)
+        start_states = self.start_state_memory[starts // params.SEQUENCE_LENGTH]
+
+        # transitions after a terminal transition belong to the next episode, they don't get the start state
+        valid = (np.cumsum(terminals, axis=-1) - terminals) == 0
+
+        return from_observations, to_observations, start_states, actions, rewards, terminals, valid
+
+    def get_sequence_returns(self, rewards, terminals):
+        """
+        :param rewards: rewards of the sequences, as returned by get_sequences
+        :param terminals: terminals of the sequences, as returned by get_sequences
+        :return: for every transition the position of the transition the n-step target bootstraps from,
+            the n-step rewards, terminals and discounts, all with shape (sequences, length)
+        """
+        # like _n_step_returns, but the windows end at the end of the sequence
+        # the states are only recomputed within the sequence, the target needs the state of its last transition
+        length = rewards.shape[1]
+        offsets = np.arange(params.N_STEP)
+        window = np.arange(length)[:, None] + offsets
+        valid = window < length
+        window = np.minimum(window, length - 1)
+
+        # transitions after a terminal transition belong to the next episode
+        window_terminals = terminals[:, window]
+        after_terminal = (np.cumsum(window_terminals, axis=-1) - window_terminals) > 0
+        valid = valid & ~after_terminal
+
+        # the valid steps are always a prefix of the window
+        discounted_rewards = rewards[:, window] * np.power(params.GAMMA, offsets) * valid
+        num_steps = valid.sum(axis=-1)
+
+        last = np.arange(length) + num_steps - 1
+        terminal = np.any(window_terminals & valid, axis=-1)
+        discounts = np.power(params.GAMMA, num_steps)
+
+        return last, discounted_rewards.sum(axis=-1), terminal, discounts
+
+    def _read_windows(self, array, starts, length):
+        # reads array[start:start + length] for all starts
+        # windows starting at multiples of SEQUENCE_LENGTH form a strided view of the array,
+        # so every window is copied as one contiguous block instead of gathering single rows
+        if isinstance(array, np.ndarray) and np.all(starts + length <= len(array)):
+            num_windows = (len(array) - length) // params.SEQUENCE_LENGTH + 1
+            windows = as_strided(array,
+                                 shape=(num_windows, length, *array.shape[1:]),
+                                 strides=(params.SEQUENCE_LENGTH * array.strides[0], *array.strides),
+                                 writeable=False)
+            return windows[starts // params.SEQUENCE_LENGTH]
+
+        # windows wrapping around the end of the ring buffer, and arrays that are no numpy arrays
+        indices = (starts[:, None] + np.arange(length)) % len(array)
+        return array[indices]
+
+    def _n_step_returns(self, index):
+        # gathers the windows of N_STEP transitions starting at the given indices, all at once
+        # a window ends early at the end of an episode, or at the newest transition in the memory
+        # the next transition of the same stream is num_streams slots further
+        offsets = np.arange(params.N_STEP)
+        window = (index[..., None] + offsets * self.num_streams) % params.REPLAY_MEMORY_SIZE
+
+        # number of transitions of the same stream that have been written after the index
+        newest = (self.replay_index - 1) % params.REPLAY_MEMORY_SIZE
+        available = ((newest - index) % params.REPLAY_MEMORY_SIZE) // self.num_streams
+        valid = offsets <= available[..., None]
+
+        # transitions after a terminal transition belong to the next episode
+        terminals = self.terminal_memory[window]
+        after_terminal = (np.cumsum(terminals, axis=-1) - terminals) > 0
+        valid &= ~after_terminal
+
+        # the valid steps are always a prefix of the window
+        discounted_rewards = self.reward_memory[window] * np.power(params.GAMMA, offsets) * valid
+        rewards = discounted_rewards.sum(axis=-1)
+        num_steps = valid.sum(axis=-1)
+
+        to_index = np.take_along_axis(window, num_steps[..., None] - 1, axis=-1)[..., 0]
+        terminal = np.any(terminals & valid, axis=-1)
+        discounts = np.power(params.GAMMA, num_steps)
+
+        return to_index, rewards, terminal, discounts
+
+    def _stack_frames(self, frame_indices):
+        # rebuilds the stacked observations ending in the given frame slots
+        # walking backwards, a stack stops at the first frame of its episode and repeats that frame
+        # this is exactly what the agent does after a reset
+        frame_indices = np.asarray(frame_indices)
+
+        stack_indices = np.empty((*frame_indices.shape, params.FRAME_STACK), dtype=np.int64)
+        stack_indices[..., -1] = frame_indices
+        for i in range(params.FRAME_STACK - 2, -1, -1):
+            stack_indices[..., i] = self.frame_previous[stack_indices[..., i + 1]]
+
+        # frames have shape (..., FRAME_STACK, height, width), the observations are channels last
+        frames = self.frame_memory[stack_indices]
+        return np.moveaxis(frames, -3, -1)
+
+    def _write(self,
+               from_observation: np.array,
+               to_observation: np.array,
+               from_state: np.array,
+               to_state: np.array,
+               action: np.uint8,
+               reward: np.float32,
+               terminal: np.bool,
+               slot=None):
+
+        # by default, the transition goes to the current position of the ring buffer
+        if slot is None:
+            slot = self.replay_index
+
+        if self.stateful:
+            from_state = np.asarray(from_state)[None]
+            to_state = np.asarray(to_state)[None]
+
+        self._write_many(np.asarray(from_observation)[None], np.asarray(to_observation)[None], from_state, to_state,
+                         np.asarray([action]), np.asarray([reward]), np.asarray([terminal]), np.asarray([slot]))
+
+    def _write_many(self, from_observations, to_observations, from_states, to_states, actions, rewards, terminals,
+                    slots):
+        # writes the transitions to the given slots
+        # with frame deduplication, these have to be one transition per stream
+        # otherwise, they can also be consecutive transitions of a single stream
+
+        # write observation to memory
+        if self.deduplicate_frames:
+            assert len(slots) == self.num_streams, "every stream has to push exactly one transition"
+
+            # the very first transition of a stream needs an additional slot for its from frame
+            from_frames = self.frame_index.copy()
+            first_frames = from_frames < 0
+            num_new_frames = np.count_nonzero(first_frames) + len(slots)
+            new_frames = (self.frame_write_index + np.arange(num_new_frames)) % self.frame_memory_size
+            self.frame_write_index = int((self.frame_write_index + num_new_frames) % self.frame_memory_size)
+
+            from_frames[first_frames] = new_frames[:np.count_nonzero(first_frames)]
+            to_frames = new_frames[np.count_nonzero(first_frames):]
+
+            # the from frame has already been written as the to frame of the previous transition
+            # only the first transitions of episodes have to write it
+            # for terminal transitions, the to frame is overwritten by the next reset
+            # that's fine, terminal transitions never use the value of their to observation
+            for stream in np.flatnonzero(self.episode_start):
+                self.frame_memory[from_frames[stream]] = from_observations[stream, ..., -1]
+                self.frame_previous[from_frames[stream]] = from_frames[stream]
+
+            for stream in range(len(slots)):
+                self.frame_memory[to_frames[stream]] = to_observations[stream, ..., -1]
+            self.frame_previous[to_frames] = from_frames
+
+            self.frame_index_memory[slots] = from_frames
+            self.to_frame_index_memory[slots] = to_frames
+
+            self.frame_index = to_frames
+            self.episode_start = np.array(terminals, dtype=np.bool)
+        else:
+            for stream, slot in enumerate(slots):
+                self.from_observation_memory[slot] = from_observations[stream]
+                self.to_observation_memory[slot] = to_observations[stream]
+        self.action_memory[slots] = actions
+        self.reward_memory[slots] = rewards
+        self.terminal_memory[slots] = terminals
+
+        if not self.stateful:
+            assert from_states is None
+            assert to_states is None
+        elif self.sequence_mode:
+            starts = slots % params.SEQUENCE_LENGTH == 0
+            self.start_state_memory[slots[starts] // params.SEQUENCE_LENGTH] = from_states[starts]
+        else:
+            self.from_state_memory[slots] = from_states
+            self.to_state_memory[slots] = to_states
+
+    def _advance(self, count=1):
+        # this acts like a ringbuffer
+        self.replay_index += count
+        self.replay_index %= params.REPLAY_MEMORY_SIZE
+
+        self.number_writes += count
+
+    def _next_slots(self, count):
+        return (self.replay_index + np.arange(count)) % params.REPLAY_MEMORY_SIZE
 
 
 class Equal_Memory(Memory):
@@ -87,7 +501,11 @@ class Equal_Memory(Memory):
 
         selected_indices = np.random.choice(len(self), size, replace=replace)
 
-        return selected_indices
+        return selected_indices, self.importance_weights(selected_indices)
+
+    def importance_weights(self, indices):
+        # uniform sampling doesn't need an importance sampling correction
+        return np.ones(np.shape(indices))
 
     def push(self,
              from_observation: np.array,
@@ -97,42 +515,74 @@ class Equal_Memory(Memory):
              action: np.uint8,
              reward: np.float32,
              terminal: np.bool):
-        # write observation to memory
-        self.from_observation_memory[self.replay_index] = from_observation
-        self.to_observation_memory[self.replay_index] = to_observation
-        self.action_memory[self.replay_index] = action
-        self.reward_memory[self.replay_index] = reward
-        self.terminal_memory[self.replay_index] = terminal
+        with self.lock:
+            self._write(from_observation, to_observation, from_state, to_state, action, reward, terminal)
+            self._advance()
 
-        if not self.stateful:
-            assert from_state is None
-            assert to_state is None
-        else:
-            self.from_state_memory[self.replay_index] = from_state
-            self.to_state_memory[self.replay_index] = to_state
-
-        # this acts like a ringbuffer
-        self.replay_index += 1
-        self.replay_index %= params.REPLAY_MEMORY_SIZE
-
-        self.number_writes += 1
+    def push_many(self, from_observations, to_observations, from_states, to_states, actions, rewards, terminals):
+        # one transition per stream, or consecutive transitions of a single stream without frame deduplication
+        # all arrays have the transitions as first axis
+        with self.lock:
+            slots = self._next_slots(len(actions))
+            self._write_many(from_observations, to_observations, from_states, to_states, actions, rewards, terminals,
+                             slots)
+            self._advance(len(slots))
 
 
 class Priority_Memory(Memory):
     priority_based_sampling = True
 
-    def __init__(self, Model):
-        Memory.__init__(self, Model)
-
+    def __init__(self, Model, num_streams=1):
+        # the trees have to exist before Memory.__init__, which restores them when resuming
         self.priority_sumtree = SumTree(params.REPLAY_MEMORY_SIZE)
 
+        # the smallest priority is needed to normalize the importance sampling weights
+        # the min tree keeps it in its root, so we never have to scan the whole buffer
+        self.priority_mintree = MinSegmentTree(params.REPLAY_MEMORY_SIZE)
+
+        # exponent of the importance sampling weights, annealed towards IS_BETA_FINAL
+        self.is_beta = params.IS_BETA_START
+
+        Memory.__init__(self, Model, num_streams)
+
+    def _get_state(self):
+        state = Memory._get_state(self)
+        state["priority_sumtree"] = self.priority_sumtree._data
+        state["priority_mintree"] = self.priority_mintree._data
+        state["is_beta"] = self.is_beta
+        return state
+
+    def _set_state(self, state):
+        Memory._set_state(self, state)
+
+        assert state["priority_sumtree"].shape == self.priority_sumtree._data.shape
+        assert state["priority_mintree"].shape == self.priority_mintree._data.shape
+        self.priority_sumtree._data[:] = state["priority_sumtree"]
+        self.priority_mintree._data[:] = state["priority_mintree"]
+        self.is_beta = float(state["is_beta"])
+
     def sample_indices(self, size=params.BATCH_SIZE, replace=False):
         if not replace:
             assert size <= len(self), "trying to sample more samples than available"
 
-        selected_indices = self.priority_sumtree.sample(size, replace)
+        with self.lock:
+            selected_indices = self.priority_sumtree.sample(size, replace, stratified=params.STRATIFIED_SAMPLING)
+            weights = self.importance_weights(selected_indices)
+
+            # the exponent grows by IS_BETA_STEP per batch of BATCH_SIZE transitions
+            self.is_beta = min(self.is_beta + params.IS_BETA_STEP * size / params.BATCH_SIZE, params.IS_BETA_FINAL)
+
+        return selected_indices, weights
 
-        return selected_indices
+    def importance_weights(self, indices):
+        # importance sampling weights, compare (1) in the prioritized experience replay paper
+        # w_i = (N * P(i)) ** -beta / max_j w_j
+        # the maximum weight belongs to the minimum priority, so N and the sum of priorities cancel out
+        with self.lock:
+            priorities = self.priority_sumtree.get(indices)
+            min_priority = self.priority_mintree.reduce()
+
+        return np.power(priorities / min_priority, -self.is_beta)
 
     def push(self,
              from_observation: np.array,
@@ -142,30 +592,244 @@ class Priority_Memory(Memory):
              action: np.uint8,
              reward: np.float32,
              terminal: np.bool,
-             priority: np.float):
+             priority: float):
+        with self.lock:
+            self._write(from_observation, to_observation, from_state, to_state, action, reward, terminal)
+
+            self.priority_sumtree.push(self.replay_index, priority)
+            self.priority_mintree.update(self.replay_index, priority)
+
+            self._advance()
+
+    def push_many(self, from_observations, to_observations, from_states, to_states, actions, rewards, terminals,
+                  priorities):
+        # one transition per stream, or consecutive transitions of a single stream without frame deduplication
+        # all arrays have the transitions as first axis
+        with self.lock:
+            slots = self._next_slots(len(actions))
+            self._write_many(from_observations, to_observations, from_states, to_states, actions, rewards, terminals,
+                             slots)
+
+            self.priority_sumtree.update_many(slots, priorities)
+            self.priority_mintree.update_many(slots, priorities)
+
+            self._advance(len(slots))
+
+    def update_priority(self, indices, priorities, number_writes=None):
+        """
+        :param number_writes: number of writes when the indices were sampled,
+            if given, slots that have been overwritten since then keep the priority of their new transition
+        """
+        indices = np.asarray(indices)
+        priorities = np.asarray(priorities)
+
+        with self.lock:
+            if number_writes is not None:
+                current = ~self.overwritten_since(indices, number_writes)
+                indices = indices[current]
+                priorities = priorities[current]
+
+            self.priority_sumtree.update_many(indices, priorities)
+            self.priority_mintree.update_many(indices, priorities)
+
+
+# a priority memory in shared memory, several processes can push to it concurrently
+# all arrays, the trees and the write counter live in multiprocessing.shared_memory blocks
+# the memory can be passed to other processes, they reattach to the same blocks
+#
+# writing uses a small claim protocol:
+#  - under the lock, a writer claims the next slot, marks it as being written and sets its priority to 0
+#  - the transition is written without holding the lock
+#  - under the lock, the slot is marked as complete and gets its priority
+# every slot has a version counter, odd versions mean that the slot is being written
+# readers compare the versions before and after reading and read torn slots again
+class SharedPriorityMemory(Priority_Memory):
+    supports_memory_maps = False
+    supports_compression = False
+    single_writer = False
+
+    def __init__(self, Model, context=None):
+        """
+        :param context: multiprocessing context of the processes the memory is shared with, by default the one of
+        the platform. tensorflow doesn't survive forking, the lock has to be created in a spawn context then
+        """
+        self.context = context if context is not None else multiprocessing.get_context()
+
+        # name -> (block, shape, dtype) for everything that lives in shared memory
+        self._shared = {}
+
+        # only the creating process frees the shared memory
+        self._owner_pid = os.getpid()
+
+        # counts all writes, including those that are still in progress
+        self._counters = self._create_shared("_counters", (1,), np.int64)
+        self._counters[:] = 0
+
+        Priority_Memory.__init__(self, Model)
+
+        # the tree data is moved to shared memory as well
+        self._sumtree_data = self._create_shared("_sumtree_data", self.priority_sumtree._data.shape, np.float64)
+        self._sumtree_data[:] = self.priority_sumtree._data
+        self.priority_sumtree._data = self._sumtree_data
+
+        self._mintree_data = self._create_shared("_mintree_data", self.priority_mintree._data.shape, np.float64)
+        self._mintree_data[:] = self.priority_mintree._data
+        self.priority_mintree._data = self._mintree_data
+
+        self._slot_versions = self._create_shared("_slot_versions", (params.REPLAY_MEMORY_SIZE,), np.int64)
+        self._slot_versions[:] = 0
+
+    def _create_lock(self):
+        # protects the write counter and the trees of all processes
+        return self.context.RLock()
+
+    def _create_shared(self, name, shape, dtype):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._shared[name] = (block, shape, np.dtype(dtype).str)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def _allocate(self, name, shape, dtype):
+        return self._create_shared(name, shape, dtype)
+
+    def _load_metadata(self):
+        # shared memory isn't persisted
+        return None
+
+    # the ring buffer position is derived from the shared write counter
+    @property
+    def number_writes(self):
+        return int(self._counters[0])
+
+    @number_writes.setter
+    def number_writes(self, value):
+        self._counters[0] = value
+
+    @property
+    def replay_index(self):
+        return int(self._counters[0] % params.REPLAY_MEMORY_SIZE)
+
+    @replay_index.setter
+    def replay_index(self, value):
+        # only Memory.__init__ sets this, the index always follows number_writes
+        assert value == self.replay_index
+
+    def __getstate__(self):
+        # the shared arrays are not pickled, the other process attaches to the blocks by name
+        state = self.__dict__.copy()
+        state["_shared"] = {name: (block.name, shape, dtype) for name, (block, shape, dtype) in self._shared.items()}
+        for name in self._shared:
+            state[name] = None
+
+        state["priority_sumtree"] = copy.copy(self.priority_sumtree)
+        state["priority_sumtree"]._data = None
+        state["priority_mintree"] = copy.copy(self.priority_mintree)
+        state["priority_mintree"]._data = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        shared = {}
+        for name, (block_name, shape, dtype) in state["_shared"].items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared[name] = (block, shape, dtype)
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+        self._shared = shared
+
+        self.priority_sumtree._data = self._sumtree_data
+        self.priority_mintree._data = self._mintree_data
+
+    def close(self):
+        # every process closes its view, the process that created the memory also frees it
+        for name in self._shared:
+            setattr(self, name, None)
+        self.priority_sumtree._data = None
+        self.priority_mintree._data = None
+
+        for block, _, _ in self._shared.values():
+            block.close()
+            if os.getpid() == self._owner_pid:
+                block.unlink()
+        self._shared = {}
 
-        # write observation to memory
-        self.from_observation_memory[self.replay_index] = from_observation
-        self.to_observation_memory[self.replay_index] = to_observation
-        self.action_memory[self.replay_index] = action
-        self.reward_memory[self.replay_index] = reward
-        self.terminal_memory[self.replay_index] = terminal
+    def __getitem__(self, index):
+        index = np.asarray(index)
 
-        if not self.stateful:
-            assert from_state is None
-            assert to_state is None
-        else:
-            self.from_state_memory[self.replay_index] = from_state
-            self.to_state_memory[self.replay_index] = to_state
+        versions = self._slot_versions[index].copy()
+        batch = list(Priority_Memory.__getitem__(self, index))
 
-        self.priority_sumtree.push(self.replay_index, priority)
+        # slots that have been written while we were reading them are read again
+        # writing a slot takes very little time, so this loop ends quickly
+        while True:
+            new_versions = self._slot_versions[index]
+            torn = (versions != new_versions) | (versions % 2 == 1)
+            if not np.any(torn):
+                return tuple(batch)
 
-        # this acts like a ringbuffer
-        self.replay_index += 1
-        self.replay_index %= params.REPLAY_MEMORY_SIZE
+            versions[torn] = new_versions[torn]
+            reread = Priority_Memory.__getitem__(self, index[torn])
+            for entry, reread_entry in zip(batch, reread):
+                if entry is not None:
+                    entry[torn] = reread_entry
+
+    def push(self,
+             from_observation: np.array,
+             to_observation: np.array,
+             from_state: np.array,
+             to_state: np.array,
+             action: np.uint8,
+             reward: np.float32,
+             terminal: np.bool,
+             priority: float):
+
+        # claim a slot, it can't be sampled while it is written
+        with self.lock:
+            slot = self.replay_index
+            self._counters[0] += 1
+            self._slot_versions[slot] += 1
+
+            self.priority_sumtree.update_many([slot], [0])
+            self.priority_mintree.update_many([slot], [self.priority_mintree.neutral_element])
+
+        self._write(from_observation, to_observation, from_state, to_state, action, reward, terminal, slot)
+
+        # publish the slot
+        with self.lock:
+            self._slot_versions[slot] += 1
+
+            self.priority_sumtree.update_many([slot], [priority])
+            self.priority_mintree.update_many([slot], [priority])
+
+    def push_many(self, from_observations, to_observations, from_states, to_states, actions, rewards, terminals,
+                  priorities):
+        # the same claim protocol as push, for consecutive slots
+        count = len(actions)
+        assert count <= params.REPLAY_MEMORY_SIZE, "can't push more transitions than the memory holds"
+
+        with self.lock:
+            slots = self._next_slots(count)
+            self._counters[0] += count
+            self._slot_versions[slots] += 1
+
+            self.priority_sumtree.update_many(slots, np.zeros((count,)))
+            self.priority_mintree.update_many(slots, np.full((count,), self.priority_mintree.neutral_element))
+
+        self._write_many(from_observations, to_observations, from_states, to_states, actions, rewards, terminals,
+                         slots)
+
+        # publish the slots
+        with self.lock:
+            self._slot_versions[slots] += 1
+
+            self.priority_sumtree.update_many(slots, priorities)
+            self.priority_mintree.update_many(slots, priorities)
 
-        self.number_writes += 1
+    def update_priority(self, indices, priorities, number_writes=None):
+        indices = np.asarray(indices)
+        priorities = np.asarray(priorities)
 
-    def update_priority(self, indices, priorities):
-        for idx, prio in zip(indices, priorities):
-            self.priority_sumtree.push(idx, prio)
+        with self.lock:
+            # slots that are being written keep priority 0 until the writer publishes them
+            complete = self._slot_versions[indices] % 2 == 0
+            Priority_Memory.update_priority(self, indices[complete], priorities[complete], number_writes)
@@ -0,0 +1,69 @@
+# measures the push and sample throughput of the replay memory, with and without compressed observations
+# the frames imitate the obstacle car environment: a plain background with a few moving rectangles
+import time
+
+import numpy as np
+
+import algorithms.dqn.params as params
+from algorithms.dqn.memory import Priority_Memory
+
+MEMORY_SIZE = 2 ** 16
+NUM_PUSHES = 2 ** 16
+NUM_BATCHES = 500
+EPISODE_LENGTH = 500
+
+
+class BenchmarkModel:
+    OBSERVATION_SHAPE = (84, 84, params.FRAME_STACK)
+    STATEFUL = False
+
+
+def create_frame(step):
+    frame = np.full((84, 84), 40, dtype=np.uint8)
+    for i in range(4):
+        x = (step * (i + 1) + 20 * i) % 74
+        y = (13 * i + step // 3) % 74
+        frame[y:y + 10, x:x + 10] = 200 + i
+    return frame
+
+
+def benchmark(compress):
+    params.COMPRESS_OBSERVATIONS = compress
+    memory = Priority_Memory(BenchmarkModel)
+
+    frames = [create_frame(step) for step in range(EPISODE_LENGTH + params.FRAME_STACK)]
+
+    start_time = time.time()
+    observation = np.stack(frames[:params.FRAME_STACK], axis=-1)
+    for interaction in range(NUM_PUSHES):
+        step = interaction % EPISODE_LENGTH
+        to_observation = np.concatenate([observation[..., 1:], frames[step + params.FRAME_STACK][..., None]],
+                                        axis=-1)
+        done = step == EPISODE_LENGTH - 1
+        memory.push(observation, to_observation, None, None, 0, 0, done, params.DEFAULT_PRIO)
+        observation = np.stack(frames[:params.FRAME_STACK], axis=-1) if done else to_observation
+    push_time = time.time() - start_time
+
+    start_time = time.time()
+    for batch in range(NUM_BATCHES):
+        memory.sample_batch()
+    sample_time = time.time() - start_time
+
+    # both numpy arrays and compressed arrays report their size in nbytes
+    if memory.deduplicate_frames:
+        frame_bytes = memory.frame_memory.nbytes
+    else:
+        frame_bytes = memory.from_observation_memory.nbytes + memory.to_observation_memory.nbytes
+
+    print("compressed: {}".format(compress))
+    print("  pushes per second: {:.0f}".format(NUM_PUSHES / push_time))
+    print("  batches per second: {:.0f}".format(NUM_BATCHES / sample_time))
+    print("  observation memory: {:.1f} MB".format(frame_bytes / 2 ** 20))
+
+
+if __name__ == "__main__":
+    params.REPLAY_MEMORY_SIZE = MEMORY_SIZE
+    params.MEMORY_MAPPED = False
+
+    benchmark(compress=False)
+    benchmark(compress=True)
@@ -9,6 +9,7 @@ from keras.regularizers import *
 import lycon
 
 import algorithms.dqn.params as params
+from util.preprocessing import FrameStack, GrayscaleResizer, preprocess_batch
 
 
 class DQN_Model():
@@ -41,11 +42,28 @@ class DQN_Model():
         self.q_values_masked = q_values_masked
 
     def preprocess(self, observation):
+        # environments rendering at the resolution of the model don't need preprocessing
+        # they reuse their canvas, so it is copied anyway
+        if observation.shape == self.OBSERVATION_SHAPE[:2]:
+            return np.array(observation, dtype=np.uint8)
+
         downsampled = lycon.resize(observation, width=self.OBSERVATION_SHAPE[0], height=self.OBSERVATION_SHAPE[1],
                                    interpolation=lycon.Interpolation.NEAREST)
         grayscale = downsampled.mean(axis=-1).astype(np.uint8)
         return grayscale
 
+    def preprocess_batch(self, observations, out=None):
+        # preprocess for many observations at once, e.g. of several environments
+        height, width = self.OBSERVATION_SHAPE[:2]
+        return preprocess_batch(observations, (width, height), out=out, num_threads=params.PREPROCESS_THREADS)
+
+    def create_pipeline(self, num_envs=None):
+        # preprocessing and frame stacking into preallocated buffers, the same result as preprocess and np.stack
+        # the frames of several environments are preprocessed in one batch
+        height, width = self.OBSERVATION_SHAPE[:2]
+        return FrameStack((height, width), params.FRAME_STACK, preprocess=GrayscaleResizer((width, height)),
+                          dtype=np.uint8, num_envs=num_envs, preprocess_batch=self.preprocess_batch)
+
     def predict(self, observation, state=None):
         if not state is None:
             raise AssertionError("this model is not stateful")
@@ -94,6 +112,15 @@ class FullyConnectedModel():
     def preprocess(self, observation):
         return observation
 
+    def preprocess_batch(self, observations, out=None):
+        if out is None:
+            return np.asarray(observations)
+        out[:] = observations
+        return out
+
+    def create_pipeline(self, num_envs=None):
+        return FrameStack(self.OBSERVATION_SHAPE, params.FRAME_STACK, dtype=np.float32, num_envs=num_envs)
+
     def get_initial_state(self):
         raise AssertionError("this model is not stateful")
 
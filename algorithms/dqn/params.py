@@ -12,6 +12,7 @@ BATCH_SIZE = 32
 
 # parameters for the reinforcement process
 GAMMA = 0.99  # discount factor for future updates
+N_STEP = 1  # number of rewards accumulated for the q targets, 1 is the classic dqn target
 REWARD_SCALE = 1
 
 # parameters for the optimizer
@@ -25,9 +26,16 @@ L2_REG_FULLY = 0  # 1e-3
 # parameters for the training
 TOTAL_INTERACTIONS = int(3e6)  # after this many interactions, the training stops
 TRAIN_SKIPS = 2  # interact with the environment X times, update the network once
+TRAIN_BATCHES_PER_CALL = 1  # number of updates in one session call, the training runs every TRAIN_SKIPS * X interactions
 
 TARGET_NETWORK_UPDATE_FREQ = 1e4  # update the target network every X training steps
-SAVE_NETWORK_FREQ = 5  # save every Xth version of the target network
+CONCURRENT_TRAINING = False  # train in a separate thread, while the agent keeps interacting
+REPLAY_RATIO = 1 / TRAIN_SKIPS  # gradient updates per interaction, replaces TRAIN_SKIPS for concurrent training
+REPLAY_RATIO_TOLERANCE = 16  # number of updates acting and learning may drift apart before one side waits
+CHECKPOINT_FREQ = int(1e5)  # write a checkpoint of the training every X interactions
+CHECKPOINT_DIR = "checkpoints"  # relative to the working directory
+CHECKPOINT_KEEP = 3  # number of checkpoints kept, older ones are deleted
+RESUME_TRAINING = True  # continue from the newest checkpoint, if there is one
 
 # parameters for interacting with the environment
 INITIAL_EXPLORATION = 1.0  # initial chance of sampling a random action
@@ -36,14 +44,40 @@ FINAL_EXPLORATION_FRAME = int(TOTAL_INTERACTIONS // 2)  # frame at which final v
 EXPLORATION_STEP = (INITIAL_EXPLORATION - FINAL_EXPLORATION) / FINAL_EXPLORATION_FRAME
 
 REPEAT_ACTION_MAX = 10  # maximum number of repeated actions before sampling random action
+NUM_ENVIRONMENTS = 1  # number of environments the agent interacts with in lockstep
+PREPROCESS_THREADS = 0  # number of threads preprocessing the frames of all environments, 0 uses the acting thread
+
+# parameters for the distributed training, dqn_distributed.py
+NUM_ACTORS = 4  # number of actor processes, each with its own environment and model
+ACTOR_CHUNK_SIZE = 50  # transitions an actor collects before computing their priorities and sending them
+ACTOR_QUEUE_SIZE = 64  # maximum number of chunks waiting for the learner
+ACTOR_EXPLORATION_BASE = 0.4  # actor i explores with probability BASE ** (1 + ALPHA * i / (NUM_ACTORS - 1))
+ACTOR_EXPLORATION_ALPHA = 7
+WEIGHT_SYNC_FREQ = 100  # the learner sends its weights to the actors every X training steps
 
 # parameters for the memory
 REPLAY_MEMORY_SIZE = int(2 ** 20)
 REPLAY_START_SIZE = int(5e4)
 MEMORY_MAPPED = True
+MEMORY_DIR = "memory_maps"  # directory of the memory maps, relative to the working directory
+RESUME_MEMORY = True  # reattach to the memory maps of a previous run, if they match the current parameters
+SAVE_MEMORY_FREQ = int(1e4)  # write the memory metadata every X interactions, a restart resumes from there
+DEDUPLICATE_FRAMES = True  # store every frame once, rebuild the frame stacks when sampling
+COMPRESS_OBSERVATIONS = False  # keep the observations zlib compressed in ram, switches off the memory maps
+COMPRESSION_LEVEL = 1  # zlib level, 1 is the fastest
+DECODE_CACHE_SIZE = 4096  # number of decompressed frames kept in a lru cache
+DECODE_THREADS = 0  # number of threads decompressing the sampled frames, 0 decompresses in the sampling thread
+SEQUENCE_LENGTH = 0  # stateful models train on sequences of this length, 0 trains on single transitions
+BURN_IN_LENGTH = 0  # transitions before every sequence that only update the state of the model
 ERROR_BIAS = 0.05
 ERROR_POW = 0.7
 DEFAULT_PRIO = 1
+STRATIFIED_SAMPLING = True  # draw one sample from each of BATCH_SIZE equally sized priority segments
+IS_BETA_START = 0.4  # exponent of the importance sampling weights
+IS_BETA_FINAL = 1.0  # value at the end of training, full correction of the sampling bias
+IS_BETA_STEP = (IS_BETA_FINAL - IS_BETA_START) / (TOTAL_INTERACTIONS // TRAIN_SKIPS)  # increment per sampled batch
+PREFETCH_BATCHES = 4  # number of batches sampled ahead in background threads, 0 samples synchronously
+PREFETCH_THREADS = 1  # number of threads sampling the batches
 
 # parameters for the behaviour of tensorflow
 TF_ALLOW_GROWTH = True
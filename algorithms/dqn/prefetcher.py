@@ -0,0 +1,116 @@
+# samples and reads the next batches in background threads, while the brain trains on the current one
+# reading a batch means gathering random rows from the (possibly memory mapped) replay memory,
+# which is slow and doesn't need the gpu, so it can overlap with the training step
+#
+# the batches in the queue are sampled from a memory that keeps changing:
+#  - new transitions can overwrite sampled slots while they are read, those batches are sampled again
+#  - priorities can be updated while a batch waits in the queue,
+#    the importance sampling weights are therefore computed when the batch is taken from the queue
+#  - the number of writes at sampling time is passed on to the priority update,
+#    which skips the slots that have been overwritten by then
+import queue
+import threading
+import time
+
+import numpy as np
+
+import algorithms.dqn.params as params
+
+
+class BatchPrefetcher:
+    def __init__(self, memory, batch_size=params.BATCH_SIZE, num_batches=params.PREFETCH_BATCHES,
+                 num_threads=params.PREFETCH_THREADS):
+        """
+        :param memory: the batches are sampled from this memory
+        :param batch_size: number of transitions per batch
+        :param num_batches: maximum number of batches waiting in the queue
+        :param num_threads: number of threads sampling batches
+        """
+        self.memory = memory
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.threads = []
+        self.running = False
+
+        # time the learner spent waiting for batches, and the number of batches it took
+        self.wait_time = 0.
+        self.num_batches = 0
+
+        # batches that were sampled again, because their slots have been overwritten while reading them
+        self.num_resampled = 0
+
+    def start(self):
+        self.running = True
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run, name="batch_prefetcher_{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+
+        # unblock the threads waiting for a free place in the queue
+        while any(thread.is_alive() for thread in self.threads):
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            time.sleep(0.01)
+        self.threads = []
+
+    def _run(self):
+        while self.running:
+            # errors are passed on to the learner, which raises them in get
+            try:
+                batch = self._sample()
+            except Exception as error:
+                batch = error
+
+            # the timeout gives the thread the chance to notice that it was stopped
+            while self.running:
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _sample(self):
+        while True:
+            indices, _, batch, number_writes = self.memory.sample_batch(self.batch_size)
+
+            # a slot that has been overwritten while reading can contain parts of both transitions
+            # holding the lock, no write can be in progress
+            with self.memory.lock:
+                overwritten = self.memory.overwritten_since(indices, number_writes)
+
+            if not np.any(overwritten):
+                return indices, batch, number_writes
+
+            self.num_resampled += 1
+
+    def get(self):
+        """
+        :return: indices, importance sampling weights, batch and the number of writes at sampling time
+        """
+        # the threads are started with the first request, the memory is filled by then
+        if not self.running:
+            self.start()
+
+        start_time = time.time()
+        batch = self.queue.get()
+        self.wait_time += time.time() - start_time
+
+        if isinstance(batch, Exception):
+            raise batch
+
+        indices, batch, number_writes = batch
+        self.num_batches += 1
+
+        weights = self.memory.importance_weights(indices)
+
+        return indices, weights, batch, number_writes
+
+    def mean_wait_time(self):
+        return self.wait_time / max(self.num_batches, 1)
@@ -0,0 +1,61 @@
+# keeps acting and learning at a fixed replay ratio, when they run concurrently
+# the replay ratio is the number of gradient updates per interaction with the environment
+# whichever side gets ahead by more than the tolerance waits for the other one
+import threading
+import time
+
+
+class ReplayRatioController:
+    def __init__(self, replay_ratio, tolerance):
+        """
+        :param replay_ratio: gradient updates per interaction
+        :param tolerance: number of updates the learner may be ahead of or behind the ratio
+        """
+        self.replay_ratio = replay_ratio
+        self.tolerance = tolerance
+
+        self.interactions = 0
+        self.updates = 0
+        self.stopped = False
+
+        # time both sides spent waiting for each other, in seconds
+        self.acting_wait_time = 0.
+        self.learning_wait_time = 0.
+
+        self.condition = threading.Condition()
+
+    def add_interactions(self, count=1):
+        # called by the acting side, blocks while the learner is too far behind
+        with self.condition:
+            self.interactions += count
+            self.condition.notify_all()
+
+            start_time = time.time()
+            while not self.stopped and self.updates < self.replay_ratio * self.interactions - self.tolerance:
+                self.condition.wait()
+            self.acting_wait_time += time.time() - start_time
+
+    def wait_for_update(self):
+        # called by the learning side before every update, blocks while the learner is too far ahead
+        # returns False if the controller has been stopped
+        with self.condition:
+            start_time = time.time()
+            while not self.stopped and self.updates + 1 > self.replay_ratio * self.interactions + self.tolerance:
+                self.condition.wait()
+            self.learning_wait_time += time.time() - start_time
+
+            return not self.stopped
+
+    def update_done(self):
+        with self.condition:
+            self.updates += 1
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def ratio(self):
+        # the effective replay ratio
+        return self.updates / max(self.interactions, 1)
@@ -1,9 +1,11 @@
 import lycon
+import tensorflow as tf
 from keras.layers import *
 from keras.models import *
 from keras.regularizers import l2
 
 import algorithms.ppo_sequential.params as params
+from util.preprocessing import preprocess_batch
 
 
 class ConvLSTMModel():
@@ -11,8 +13,10 @@ class ConvLSTMModel():
         # some parameters now belong to the model
         self.FRAME_SIZE = (84, 84)
         self.INPUT_SHAPE = (*self.FRAME_SIZE, 3)
+        self.OBSERVATION_DTYPE = np.uint8
         self.DENSE_SIZE = 128
         self.RNN_SIZE = 128
+        self.STATE_SHAPE = (self.RNN_SIZE,)
 
         # build a model to predict action probabilities and values
         self.input_observation = Input(shape=(*self.INPUT_SHAPE,))
@@ -58,12 +62,20 @@ class ConvLSTMModel():
         self.loss_regularization = loss_regularization
 
     def preprocess(self, observation):
+        # environments rendering at the resolution of the model don't need preprocessing
+        if observation.shape == self.INPUT_SHAPE:
+            return np.array(observation, dtype=np.uint8)
+
         downsampled = lycon.resize(observation, width=self.FRAME_SIZE[0], height=self.FRAME_SIZE[1],
                                    interpolation=lycon.Interpolation.NEAREST)
 
         # grayscale = downsampled.mean(axis=-1)
         return downsampled.reshape((self.INPUT_SHAPE))
 
+    def preprocess_batch(self, observations, out=None):
+        # preprocess for many observations at once, the colors are kept like above
+        return preprocess_batch(observations, self.FRAME_SIZE, out=out, grayscale=False)
+
     def get_initial_state(self):
         # this model has a state: the rnn cell
         # the initial state of this rnn cell is given by the following code
@@ -84,3 +96,9 @@ class ConvLSTMModel():
     def create_feed_dict(self, observation, state):
         return {self.input_observation: observation,
                 self.input_state: state}
+
+    def apply(self, observation, state):
+        # the same model on other tensors, e.g. minibatches gathered inside the graph
+        # the observations can be kept as uint8 there, the model gets floats
+        pred_policy, pred_value, _ = self.model([tf.cast(observation, tf.float32), state])
+        return pred_policy, pred_value
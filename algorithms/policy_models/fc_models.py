@@ -1,3 +1,5 @@
+import numpy as np
+
 from keras.layers import *
 from keras.models import *
 from keras.regularizers import l2
@@ -5,6 +7,9 @@ from keras.regularizers import l2
 
 class FCModel():
     INPUT_SHAPE = (7,)
+    OBSERVATION_DTYPE = np.float32
+    # the model has no state, the agents store empty ones
+    STATE_SHAPE = (0,)
     FC_SIZES=[64]
     NUM_ACTIONS = 1
 
@@ -49,6 +54,12 @@ class FCModel():
     def preprocess(self, observation):
         return observation
 
+    def preprocess_batch(self, observations, out=None):
+        if out is None:
+            return np.asarray(observations)
+        out[:] = observations
+        return out
+
     def get_initial_state(self):
         return []
 
@@ -62,6 +73,11 @@ class FCModel():
     def create_feed_dict(self, observation, state):
         return {self.input_observation: observation}
 
+    def apply(self, observation, state):
+        # the same model on other tensors, e.g. minibatches gathered inside the graph
+        pred_policy, pred_value = self.model(observation)
+        return pred_policy, pred_value
+
 class FCCartPole(FCModel):
     INPUT_SHAPE = (4,)
     FC_SIZES = [16]
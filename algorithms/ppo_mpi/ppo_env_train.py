@@ -75,7 +75,7 @@ if rank == params.rank_memory:
                 print("probe for observation message successful")
                 batch = comm.recv(source=rank_agent, tag=params.message_observation)
                 print("observation message received")
-                memory.push(batch)
+                memory.push_many(batch)
 
 if rank in params.rank_agents:
     # set up an agent
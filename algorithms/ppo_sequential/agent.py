@@ -5,6 +5,8 @@ np.seterr(all="raise")
 import algorithms.ppo_sequential.params as params
 from algorithms.ppo_sequential.brain import Brain
 from algorithms.ppo_sequential.memory import Memory
+from environments.subproc_vec_env import DummyVecEnv, SubprocVecEnv
+from util.trajectory_buffer import TrajectoryBuffer
 
 import pygame
 from moviepy.editor import ImageSequenceClip
@@ -22,17 +24,11 @@ class Agent():
         self.env = Env()
 
         # a local memory, to store observations made by this agent
-        # action 0 and reward 0 are between state 0 and 1
-        self.seen_observations = []  # state of the environment
-        self.seen_values = []  # corresponding estimated values (given by network)
-        self.seen_policies = []  # policies predicted by the network
-        self.seen_states = []  # state of the model
-        self.seen_actions = []  # actions taken
-        self.seen_rewards = []  # rewards given
-        self.n_step_reward = 0  # reward for n consecutive steps
+        # the observations, states, values, policies, actions and rewards of the current segment
+        self.trajectory = TrajectoryBuffer(params.NUM_STEPS, params.GAMMA, params.LAMBDA)
 
         # this is globally shared between agents
-        # local observations will be successively pushed to the shared memory
+        # local observations are pushed to the shared memory in one piece
         # as soon as we have enough for the N-step target
         self.brain = brain
         self.shared_memory = shared_memory
@@ -59,24 +55,14 @@ class Agent():
 
     def reset(self):
         # clear all local memory
-        self.seen_observations = []  # state of the environment
-        self.seen_values = []  # corresponding estimated values (given by network)
-        self.seen_policies = []  # policies predicted by the network
-        self.seen_states = []  # state of the model
-        self.seen_actions = []  # actions taken
-        self.seen_rewards = []  # rewards given
-
-        # reset n-step reward calculation
-        self.n_step_reward = 0  # reward for n consecutive steps
+        self.trajectory.clear()
 
         # reset environment
         self.observation = self.env.reset()
         self.observation = self.brain.preprocess(self.observation)
-        self.seen_observations = [self.observation]
 
         # reset model
         self.state = self.brain.get_initial_state()
-        self.seen_states = [self.state]
 
         self.total_reward = 0
 
@@ -97,6 +83,7 @@ class Agent():
     def act(self, greedy = False):
 
         # show current state to network and get predicted policy
+        from_state = self.state
         policy, value, self.state = self.brain.predict(self.observation, self.state)
 
         # flatten the output
@@ -122,29 +109,16 @@ class Agent():
         actions_onehot[action] = 1
 
         # append observations to local memory
-        self.seen_values.append(value)
-        self.seen_states.append(self.state)
-        self.seen_policies.append(policy)
-        self.seen_actions.append(actions_onehot)
-        self.seen_rewards.append(reward)
-        self.seen_observations.append(new_observation)
-        self.n_step_reward = (self.n_step_reward + reward * params.GAMMA ** params.NUM_STEPS) / params.GAMMA
-
-        assert len(self.seen_actions) <= params.NUM_STEPS, "as soon as N steps are reached, " \
-                                                           "local memory must be moved to shared memory"
+        self.trajectory.record(self.observation, from_state, policy, value, actions_onehot, reward, done,
+                               new_observation, self.state)
 
         # update state of agent
         self.observation = new_observation
         self.total_reward += reward
 
         # move local memory to shared memory
-        if done:
-            while len(self.seen_rewards) > 0:
-                self.move_to_memory(done)
-                self.n_step_reward /= params.GAMMA
-
-        elif len(self.seen_actions) == params.NUM_STEPS:
-            self.move_to_memory(done)
+        if done or len(self.trajectory) == params.NUM_STEPS:
+            self.move_to_memory()
 
         # TODO: implement openai render() on custom envs
         if self.vis:
@@ -175,47 +149,111 @@ class Agent():
                 print("episode {} ended, {} wins, {} fails, {:.2f} overall positive rate".format(self.num_episodes, self.wins, self.fails, self.wins/(self.wins + self.fails)))
 
 
-    def move_to_memory(self, terminal):
-        # removes one set of observations from local memory
-        # and pushes it to shared memory
+    def move_to_memory(self):
+        # pushes the current segment to the shared memory
+        # the advantages of all its steps are computed in one backward pass
+        self.shared_memory.push_many(self.trajectory.flush())
+
+
+class VecAgent():
+    def __init__(self,
+                 brain: Brain,
+                 shared_memory: Memory,
+                 Env,
+                 num_envs=params.NUM_ENVIRONMENTS,
+                 subprocesses=params.ENV_SUBPROCESSES):
+        """
+        steps several environments in lockstep
+        the policies of all environments are predicted in one batch, the actions are sampled in one draw
+        :param num_envs: number of environments
+        :param subprocesses: if True, every environment steps in its own process
+        """
+
+        if subprocesses:
+            # the shared observation array needs the shape of the observations, a local environment tells it
+            observation = np.asarray(Env().reset())
+
+            # tensorflow is already imported, the workers have to start fresh interpreters
+            self.envs = SubprocVecEnv([Env] * num_envs, observation.shape, observation.dtype, start_method="spawn")
+        else:
+            self.envs = DummyVecEnv([Env] * num_envs)
+        self.num_envs = num_envs
+
+        # a local memory for the segments of all environments
+        # a segment is cut so that a rollout of MEM_SIZE transitions needs MEM_SIZE / num_envs predictions
+        segment_length = max(min(params.NUM_STEPS, params.MEM_SIZE // num_envs), 1)
+        self.trajectory = TrajectoryBuffer(segment_length, params.GAMMA, params.LAMBDA, num_envs=num_envs)
+
+        self.brain = brain
+        self.shared_memory = shared_memory
+
+        self.reset_metadata()
+
+    def reset(self):
+        # clear all local memory
+        self.trajectory.clear()
 
-        #  read the length first, before popping anything
-        length = len(self.seen_actions)
+        # reset environments and models
+        self.observations = self.brain.preprocess_batch(self.envs.reset())
+        self.states = np.array([self.brain.get_initial_state() for i in range(self.num_envs)])
 
-        advantage_gae = self.compute_gae(np.array(self.seen_rewards), np.array(self.seen_values), terminal)
+        self.total_rewards = np.zeros((self.num_envs,))
 
-        from_observation = self.seen_observations.pop(0)
-        from_state = self.seen_states.pop(0)
-        to_observation = self.seen_observations[-1]
-        to_state = self.seen_states[-1]
-        action = self.seen_actions.pop(0)
-        reward = self.seen_rewards.pop(0)
-        pred_value = self.seen_values.pop(0)
-        pred_policy = self.seen_policies.pop(0)
+    def reset_metadata(self):
+        self.num_episodes = 0
+        self.episode_rewards = []
 
-        batch = (
-            from_observation, from_state, to_observation, to_state, pred_policy, pred_value, action, reward,
-            advantage_gae,
-            terminal, length)
-        self.shared_memory.push(batch)
+    def act(self, greedy=False):
+        """
+        one step in every environment
+        """
 
-        self.n_step_reward = (self.n_step_reward - reward)
+        # show current states to network and get predicted policies, all in one batch
+        from_states = self.states
+        policies, values, states = self.brain.predict(self.observations, self.states)
+        values = values[:, 0]
+
+        # models without a state return an empty list
+        if len(states) > 0:
+            self.states = np.asarray(states)
+
+        if greedy:
+            actions = np.argmax(policies, axis=-1)
+        else:
+            # a categorical draw for every environment: the first action whose cumulative probability is above
+            cumulative_policies = np.cumsum(policies, axis=-1)
+            samples = np.random.rand(self.num_envs, 1) * cumulative_policies[:, -1:]
+            actions = np.minimum((samples >= cumulative_policies).sum(axis=-1), params.NUM_ACTIONS - 1)
 
-    def compute_gae(self, rewards, values, terminal):
-        length = len(rewards)
+        # finished environments are reset by the pool,
+        # for them the new observations are already the first ones of the next episodes
+        new_observations, rewards, dones, _ = self.envs.step(actions)
+        rewards = rewards * params.REWARD_SCALE
 
-        # delta functions are 1 step TD lambda
-        padded_values = np.zeros((length + 1,))
-        padded_values[:-1] = values
-        padded_values[-1] = values[-1] * (1 - terminal)
+        new_observations = self.brain.preprocess_batch(new_observations)
 
-        deltas = rewards + params.GAMMA * padded_values[1:] - padded_values[:-1]
+        # like the single agent, the observation after the end of an episode is zeros
+        next_observations = new_observations.copy()
+        next_observations[dones] = 0
 
-        # gae advantage uses a weighted sum of deltas,
-        # compare (16) in the gae paper
-        discount_factor = params.GAMMA * params.LAMBDA
-        weights = np.geomspace(1, discount_factor ** (len(deltas) - 1), len(deltas))
-        weighted_series = deltas * weights
-        advantage_gae = weighted_series.sum()
+        actions_onehot = np.eye(params.NUM_ACTIONS)[actions]
 
-        return advantage_gae
+        # append observations to local memory
+        self.trajectory.record(self.observations, from_states, policies, values, actions_onehot, rewards, dones,
+                               next_observations, self.states)
+
+        # update state of agent
+        self.total_rewards += rewards
+        self.observations = new_observations
+
+        # finished environments start their next episode right away
+        for i in np.flatnonzero(dones):
+            self.states[i] = self.brain.get_initial_state()
+
+            self.num_episodes += 1
+            self.episode_rewards.append(self.total_rewards[i])
+            self.total_rewards[i] = 0
+
+        # move local memory to shared memory
+        if len(self.trajectory) == self.trajectory.num_steps:
+            self.shared_memory.push_many(self.trajectory.flush())
@@ -1,3 +1,5 @@
+import threading
+
 import tensorflow as tf
 from colorama import Fore, Style
 from keras.models import *
@@ -5,11 +7,12 @@ from tqdm import tqdm
 
 import algorithms.ppo_sequential.params as params
 from algorithms.policy_models.conv_models import ConvLSTMModel
+from util.graph_rollout import GraphRollout
 
 
 class Brain:
 
-    def __init__(self, ModelClass: ConvLSTMModel, cpu_cores = 4):
+    def __init__(self, ModelClass: ConvLSTMModel, cpu_cores = 4, pipelined=params.PIPELINED_TRAINING):
 
         # use this to influence the tensorflow behaviour
         config = tf.ConfigProto(
@@ -26,6 +29,19 @@ class Brain:
         # set up a model for policy and
         self.model = ModelClass()
 
+        # the agent predicts with the acting model
+        # for pipelined training, that is a copy which keeps the weights the current rollout is collected with,
+        # while the model is optimized in the background
+        self.pipelined = pipelined
+        if pipelined:
+            self.acting_model = ModelClass()
+            self.sync_acting_model = tf.group(*[tf.assign(acting_weight, weight) for acting_weight, weight in
+                                                zip(self.acting_model.model.weights, self.model.model.weights)])
+        else:
+            self.acting_model = self.model
+        self.optimization = None
+        self.optimization_error = None
+
         # the model only contains the function approximator
         # the loss function for training is set up here
         self.__setup_training()
@@ -34,25 +50,38 @@ class Brain:
         # and freezing the resulting graph
         # this is the sequential version, but intuitively, freezing the graph sounds like a performance improvement
         # TODO: check if this is useful
-        self.model.model._make_predict_function()
+        self.acting_model.model._make_predict_function()
         self.session.run(tf.global_variables_initializer())
         self.default_graph = tf.get_default_graph()
+        self.update_acting_model()
         #self.default_graph.finalize()
 
     def __setup_training(self):
         # due to keras' restrictions on loss functions,
         # we use tensorflow to create a minimization step for the custom loss
 
-        # placeholders
-        self.action_mask = Input(shape=(params.NUM_ACTIONS,), name="action_mask")
+        # the rollout of an update is uploaded once, the minibatches are gathered from it inside the graph
+        self.rollout = GraphRollout({
+            "observations": (self.model.INPUT_SHAPE, self.model.OBSERVATION_DTYPE),
+            "states": (self.model.STATE_SHAPE, tf.float32),
+            "policies": ((params.NUM_ACTIONS,), tf.float32),
+            "values": ((1,), tf.float32),
+            "action_mask": ((params.NUM_ACTIONS,), tf.float32),
+            "advantages": ((1,), tf.float32),
+            "target_values": ((1,), tf.float32)})
+        minibatch = self.rollout.minibatch
+
+        self.action_mask = minibatch["action_mask"]
+        self.target_value = minibatch["target_values"]
 
-        self.target_value = Input(shape=(1,), name="target_value")
-        self.advantage = Input(shape=(1,), name="advantage")
+        # z-normalization of the advantages, within every minibatch
+        advantage_mean, advantage_variance = tf.nn.moments(minibatch["advantages"], axes=[0])
+        self.advantage = (minibatch["advantages"] - advantage_mean) / (tf.sqrt(advantage_variance) + 1e-8)
 
         # the policies as predicted by old and new network
-        # old policy should be cached in the memory, we can feed it here
-        self.old_policy = Input(shape=(params.NUM_ACTIONS,), name="old_policy")
-        new_policy = self.model.pred_policy
+        # old policy is cached in the memory, it is part of the rollout
+        self.old_policy = minibatch["policies"]
+        new_policy, new_value = self.model.apply(minibatch["observations"], minibatch["states"])
 
         # masking them, only looking at the action that was actually taken
         old_action = self.old_policy * self.action_mask
@@ -68,9 +97,8 @@ class Brain:
         loss_policy = - tf.reduce_mean(tf.minimum(loss1, loss2))
 
         # the values as predicted by old and new,
-        # again we can feed the cached prediction
-        self.old_value = Input(shape=(1,), name="old_value")
-        new_value = self.model.pred_value
+        # again the cached prediction is part of the rollout
+        self.old_value = minibatch["values"]
         new_value_clipped = self.old_value + tf.clip_by_value(new_value - self.old_value, -params.VALUE_CLIP_RANGE,
                                                               params.VALUE_CLIP_RANGE)
         value_loss_1 = (new_value - self.target_value) ** 2
@@ -107,17 +135,7 @@ class Brain:
          advantages,
          terminals, lengths) = batch
 
-        from_observations = np.array(from_observations)
-        from_states = np.array(from_states)
-        to_observations = np.array(to_observations)
-        to_states = np.array(to_states)
-        pred_policies = np.array(pred_policies).reshape((-1, params.NUM_ACTIONS))
-        pred_values = np.array(pred_values).reshape((-1, 1))
-        actions = np.vstack(actions).reshape((-1, params.NUM_ACTIONS))
-        rewards = np.vstack(rewards)
-        terminals = np.vstack(terminals)
-        advantages = np.vstack(advantages).reshape((-1, 1))
-        lengths = np.vstack(lengths)
+        # the memory keeps every field in an array, with one row per transition
 
         num_samples = from_observations.shape[0]
 
@@ -129,6 +147,16 @@ class Brain:
         target_values = advantages + pred_values
         # advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
 
+        # the whole rollout is copied into the graph once, the minibatches only feed their indices
+        self.rollout.upload(self.session, {
+            "observations": from_observations,
+            "states": from_states,
+            "policies": pred_policies,
+            "values": pred_values,
+            "action_mask": actions,
+            "advantages": advantages,
+            "target_values": target_values})
+
         indices = np.arange(num_samples)
 
         for epoch in tqdm(range(params.NUM_EPOCHS), desc="training on collected data"):
@@ -139,27 +167,7 @@ class Brain:
                 upper_idx = (idx + 1) * params.BATCH_SIZE
                 batch_indices = indices[lower_idx:upper_idx]
 
-                batch_observations = from_observations[batch_indices]
-                batch_states = from_states[batch_indices]
-                batch_policies = pred_policies[batch_indices]
-                batch_values = pred_values[batch_indices]
-                batch_action_mask = actions[batch_indices]
-                batch_advantages = advantages[batch_indices]
-                batch_target_values = target_values[batch_indices]
-
-                # z-normalization
-                batch_advantages = (batch_advantages - batch_advantages.mean()) / (batch_advantages.std() + 1e-8)
-
-                # the model is responsible for plugging in observations and states as needed
-                new_model_feed_dict = self.model.create_feed_dict(batch_observations, batch_states)
-
-                self.session.run(self.minimize_step, feed_dict={
-                    **new_model_feed_dict,
-                    self.old_policy: batch_policies,
-                    self.old_value: batch_values,
-                    self.action_mask: batch_action_mask,
-                    self.advantage: batch_advantages,
-                    self.target_value: batch_target_values})
+                self.session.run(self.minimize_step, feed_dict=self.rollout.create_feed_dict(batch_indices))
 
         print(Fore.RED)
         print("policy updated")
@@ -170,18 +178,58 @@ class Brain:
                 os.mkdir(os.getcwd()+"/algorithms/ppo_sequential/checkpoints/")
             self.model.model.save_weights(os.getcwd()+"/algorithms/ppo_sequential/checkpoints/weights.hdf5")
 
+    def optimize_in_background(self, batch, save=True):
+        """
+        optimizes on the batch in a background thread, while the agent collects the next batch
+        waits for the previous optimization, the next batch is collected with its result
+        the ppo ratio is taken against the cached policies of the batch, so the batch may come from older weights
+        """
+        self.wait_for_optimization()
+        self.update_acting_model()
+
+        def run():
+            try:
+                # the default graph is local to every thread
+                with self.default_graph.as_default():
+                    self.optimize(batch, save)
+            except BaseException as error:
+                self.optimization_error = error
+
+        self.optimization = threading.Thread(target=run, name="ppo_optimization", daemon=True)
+        self.optimization.start()
+
+    def wait_for_optimization(self):
+        if self.optimization is None:
+            return
+        self.optimization.join()
+        self.optimization = None
+
+        # errors of the background thread are raised in the training loop
+        if self.optimization_error is not None:
+            error, self.optimization_error = self.optimization_error, None
+            raise error
+
+    def update_acting_model(self):
+        # copies the weights of the optimized model to the acting model
+        if self.pipelined:
+            self.session.run(self.sync_acting_model)
+
     def load_weights(self):
         self.model.model.load_weights(os.getcwd() + "/algorithms/ppo_sequential/checkpoints/weights.hdf5")
+        self.update_acting_model()
 
 
     # the following methods will simply be routed to the model
     # this routing is not really elegant but I didn't want to expose the model outside of the brain
     def predict(self, observation, state):
         with self.default_graph.as_default():
-            return self.model.predict(observation, state)
+            return self.acting_model.predict(observation, state)
 
     def preprocess(self, observation):
         return self.model.preprocess(observation)
 
+    def preprocess_batch(self, observations, out=None):
+        return self.model.preprocess_batch(observations, out)
+
     def get_initial_state(self):
         return self.model.get_initial_state()
@@ -20,8 +20,14 @@ NUM_BATCHES = 64
 BATCH_SIZE = 64
 NUM_EPOCHS = 10  # number of times we iterate through the observed data
 
+# optimize on one rollout in the background while the next one is collected with the previous weights
+# a rollout is then one update older than the weights it is optimized with
+PIPELINED_TRAINING = False
+
 # parameters for the setup
 NUM_UPDATES = 5000
+NUM_ENVIRONMENTS = 1  # number of environments stepped in lockstep, with batched predictions
+ENV_SUBPROCESSES = False  # step each of these environments in its own process, for expensive environments
 
 # params for the memory
 MEM_SIZE = NUM_BATCHES * BATCH_SIZE
@@ -2,7 +2,7 @@ import numpy as np
 np.seterr(all='raise')
 np.random.seed(0)
 
-from algorithms.ppo_sequential.agent import Agent
+from algorithms.ppo_sequential.agent import Agent, VecAgent
 from algorithms.ppo_sequential.brain import Brain
 from algorithms.policy_models.conv_models import ConvLSTMModel
 from algorithms.policy_models.fc_models import FCRadialCar, FCCartPole
@@ -21,7 +21,10 @@ memory = Memory()
 brain = Brain(Model)
 
 vis = False
-agent = Agent(brain, memory, Environment, vis=vis)
+if params.NUM_ENVIRONMENTS > 1 and not vis:
+    agent = VecAgent(brain, memory, Environment)
+else:
+    agent = Agent(brain, memory, Environment, vis=vis)
 if vis:
     brain.load_weights()
     agent.reset()
@@ -35,7 +38,7 @@ for update in range(params.NUM_UPDATES):
     pbar = tqdm(total=params.MEM_SIZE, desc="collecting observations")
     while len(memory) < params.MEM_SIZE:
         agent.act(greedy = False)
-        pbar.update()
+        pbar.update(params.NUM_ENVIRONMENTS if isinstance(agent, VecAgent) else 1)
     pbar.close()
 
     # pop training data for brain
@@ -50,12 +53,6 @@ for update in range(params.NUM_UPDATES):
      advantages,
      terminals, lengths) = training_data
 
-    pred_policies = np.array(pred_policies).reshape((-1, params.NUM_ACTIONS))
-    pred_values = np.array(pred_values).reshape((-1, 1))
-    actions = np.vstack(actions).reshape((-1, params.NUM_ACTIONS))
-    rewards = np.vstack(rewards)
-    advantages = np.vstack(advantages).reshape((-1, 1))
-
     print(Fore.BLUE)
     print("average predicted value is {}".format(pred_values.mean()))
     print("average empirical reward is {}".format(rewards.mean()))
@@ -70,4 +67,10 @@ for update in range(params.NUM_UPDATES):
     print(Style.RESET_ALL)
 
     # optimize brain on training data
-    brain.optimize(training_data)
+    if params.PIPELINED_TRAINING:
+        brain.optimize_in_background(training_data)
+    else:
+        brain.optimize(training_data)
+
+if params.PIPELINED_TRAINING:
+    brain.wait_for_optimization()
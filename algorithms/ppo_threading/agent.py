@@ -7,6 +7,7 @@ import time, threading
 import algorithms.ppo_threading.params as params
 from algorithms.ppo_threading.brain import Brain
 from algorithms.ppo_threading.memory import Memory
+from util.trajectory_buffer import TrajectoryBuffer
 
 # from environments.obstacle_car.environment import Environment_Graphical as Environment
 from environments.obstacle_car.environment_vec import Environment_Vec as Environment
@@ -27,14 +28,8 @@ class Agent(threading.Thread):
         self.env = Environment()
 
         # a local memory, to store observations made by this agent
-        # action 0 and reward 0 are between state 0 and 1
-        self.seen_observations = []  # state of the environment
-        self.seen_values = []  # corresponding estimated values (given by network)
-        self.seen_policies = []  # policies predicted by the network
-        self.seen_states = []  # state of the model
-        self.seen_actions = []  # actions taken
-        self.seen_rewards = []  # rewards given
-        self.n_step_reward = 0  # reward for n consecutive steps
+        # the observations, states, values, policies, actions and rewards of the current segment
+        self.trajectory = TrajectoryBuffer(params.NUM_STEPS, params.GAMMA, params.LAMBDA)
 
         # this is globally shared between agents
         # local observations will be successively pushed to the shared memory
@@ -56,24 +51,14 @@ class Agent(threading.Thread):
 
     def reset(self):
         # clear all local memory
-        self.seen_observations = []  # state of the environment
-        self.seen_values = []  # corresponding estimated values (given by network)
-        self.seen_policies = []  # policies predicted by the network
-        self.seen_states = []  # state of the model
-        self.seen_actions = []  # actions taken
-        self.seen_rewards = []  # rewards given
-
-        # reset n-step reward calculation
-        self.n_step_reward = 0  # reward for n consecutive steps
+        self.trajectory.clear()
 
         # reset environment
         self.observation = self.env.reset()
         self.observation = self.brain.preprocess(self.observation)
-        self.seen_observations = [self.observation]
 
         # reset model
         self.state = self.brain.get_initial_state()
-        self.seen_states = [self.state]
 
     def run_one_episode(self):
 
@@ -96,6 +81,7 @@ class Agent(threading.Thread):
                 return
 
             # show current state to network and get predicted policy
+            from_state = self.state
             policy, value, self.state = self.brain.predict(self.observation, self.state)
 
             # flatten the output
@@ -119,16 +105,8 @@ class Agent(threading.Thread):
             actions_onehot[action] = 1
 
             # append observations to local memory
-            self.seen_values.append(value)
-            self.seen_states.append(self.state)
-            self.seen_policies.append(policy)
-            self.seen_actions.append(actions_onehot)
-            self.seen_rewards.append(reward)
-            self.seen_observations.append(new_observation)
-            self.n_step_reward = (self.n_step_reward + reward * params.GAMMA ** params.NUM_STEPS) / params.GAMMA
-
-            assert len(self.seen_actions) <= params.NUM_STEPS, "as soon as N steps are reached, " \
-                                                               "local memory must be moved to shared memory"
+            self.trajectory.record(self.observation, from_state, policy, value, actions_onehot, reward, done,
+                                   new_observation, self.state)
 
 
             # update state of agent
@@ -136,14 +114,8 @@ class Agent(threading.Thread):
             total_reward += reward
 
             # move local memory to shared memory
-            if done:
-                while len(self.seen_rewards) > 0:
-                    self.move_to_memory(done)
-                    self.n_step_reward /= params.GAMMA
-                    time.sleep(params.WAITING_TIME)
-
-            elif len(self.seen_actions) == params.NUM_STEPS:
-                self.move_to_memory(done)
+            if done or len(self.trajectory) == params.NUM_STEPS:
+                self.move_to_memory()
 
             # TODO: implement openai render() on custom envs
             if self.vis:
@@ -172,53 +144,15 @@ class Agent(threading.Thread):
         while not self.stop:
             self.run_one_episode()
 
-    def move_to_memory(self, terminal):
-        # removes one set of observations from local memory
-        # and pushes it to shared memory
+    def move_to_memory(self):
+        # pushes the current segment to the shared memory
+        # the advantages of all its steps are computed in one backward pass
 
         # we check wether collect_data is set on every loop entry
         # but if an episode has ended, all the local memory is offloaded to memory
         # this check prevents this
         if not self.collect_data.is_set():
+            self.trajectory.clear()
             return
 
-        #  read the length first, before popping anything
-        length = len(self.seen_actions)
-
-        advantage_gae = self.compute_gae(np.array(self.seen_rewards), np.array(self.seen_values), terminal)
-
-        from_observation = self.seen_observations.pop(0)
-        from_state = self.seen_states.pop(0)
-        to_observation = self.seen_observations[-1]
-        to_state = self.seen_states[-1]
-        action = self.seen_actions.pop(0)
-        reward = self.seen_rewards.pop(0)
-        pred_value = self.seen_values.pop(0)
-        pred_policy = self.seen_policies.pop(0)
-
-        batch = (
-            from_observation, from_state, to_observation, to_state, pred_policy, pred_value, action, reward,
-            advantage_gae,
-            terminal, length)
-        self.shared_memory.push(batch)
-
-        self.n_step_reward = (self.n_step_reward - reward)
-
-    def compute_gae(self, rewards, values, terminal):
-        length = len(rewards)
-
-        # delta functions are 1 step TD lambda
-        padded_values = np.zeros((length + 1,))
-        padded_values[:-1] = values
-        padded_values[-1] = values[-1] * (1 - terminal)
-
-        deltas = rewards + params.GAMMA * padded_values[1:] - padded_values[:-1]
-
-        # gae advantage uses a weighted sum of deltas,
-        # compare (16) in the gae paper
-        discount_factor = params.GAMMA * params.LAMBDA
-        weights = np.geomspace(1, discount_factor ** (len(deltas) - 1), len(deltas))
-        weighted_series = deltas * weights
-        advantage_gae = weighted_series.sum()
-
-        return advantage_gae
+        self.shared_memory.push_many(self.trajectory.flush())
@@ -7,51 +7,70 @@ from skimage.transform import resize
 
 import environments.obstacle_car.params as params
 from environments.obstacle_car.car import Car
-from np_draw.sprite import Sprite
+from np_draw.sprite import Sprite, render
+
+
+def to_grayscale(img):
+    # integer grayscale, the same as the preprocessing of the models
+    return (img.sum(axis=-1, dtype=np.uint16) // img.shape[-1]).astype(np.uint8)
+
+
+def draw(sprite, canvas):
+    # draws a sprite without touching the rest of the canvas, sprites outside of the canvas are skipped
+    visible = sprite.cut_to_canvas(canvas.shape)
+    if visible is None:
+        return
+    upperleft, img_visible, mask_visible = visible
+    render(img_visible, mask_visible, upperleft, canvas)
 
 
 class Environment_Graphical(gym.Env):
-    def __init__(self):
+    def __init__(self, observation_size=params.observation_size, observation_channels=params.observation_channels):
+        """
+        :param observation_size: the observations are rendered at this size, None renders at the screen size
+        :param observation_channels: 3 renders colors, 1 renders grayscale without a channel axis
+        """
 
         # fillcolor
         self.fillvalue = 255
 
+        # the world, dynamics and collisions always use screen coordinates
+        # only the observations are rendered at their own size, with sprites that are scaled once
+        self.observation_size = tuple(observation_size) if observation_size is not None else params.screen_size
+        self.observation_channels = observation_channels
+        self.scale = np.array(self.observation_size) / np.array(params.screen_size)
+        self.native_resolution = self.observation_size != tuple(params.screen_size)
+        channel_shape = (observation_channels,) if observation_channels > 1 else ()
+
         # set up numpy arrays to be drawn to
-        self.canvas = np.zeros((*params.screen_size, 3), dtype=np.uint8)
+        self.canvas = np.zeros((*self.observation_size, *channel_shape), dtype=np.uint8)
+        self.background = np.zeros((*self.observation_size, *channel_shape), dtype=np.uint8)
 
-        self.obstacle_layer = np.zeros((*params.screen_size, 3), dtype=np.uint8)
+        # the occupation masks of obstacles and goal, they are used for collisions
         self.obstacle_mask = np.zeros((*params.screen_size,), dtype=np.bool)
-
-        self.goal_layer = np.zeros((*params.screen_size, 3), dtype=np.uint8)
         self.goal_mask = np.zeros((*params.screen_size,), dtype=np.bool)
 
-        self.background = np.zeros((*params.screen_size, 3), dtype=np.uint8)
-
-        self.car_layer = np.zeros((*params.screen_size, 3), dtype=np.uint8)
-        self.car_mask = np.zeros((*params.screen_size,), dtype=np.bool)
-
         # load images and set up their masks
         car_img_transp = imread("environments/obstacle_car/assets/car.png")
         car_img_transp = np.transpose(car_img_transp, [1, 0, 2])
-        car_img_transp = resize(car_img_transp, params.car_size)
-        car_img = car_img_transp[:, :, :3]  # cut away alpha
-        car_img = (car_img * 255).astype(np.uint8)
-        car_mask = (car_img_transp[:, :, 3] > 0).astype(np.bool)
-
-        obstacle_img = np.zeros((*params.obstacle_size, 3), dtype=np.uint8)
-        obstacle_img[:, :, 0] = (
-                255 * np.sin(np.linspace(0, 2 * np.pi, params.obstacle_size[0])).reshape((-1, 1))).astype(np.uint8)
-        goal_img = np.zeros((*params.goal_size, 3), dtype=np.uint8)
-        goal_img[:, :, 1] = (255 * np.sin(np.linspace(0, 4 * np.pi, params.goal_size[1]))).astype(np.uint8)
-
-        obstacle_mask = np.ones(params.obstacle_size, dtype=np.bool)
-        goal_mask = np.ones(params.goal_size, dtype=np.bool)
 
         # the position will be overwritten later
         default_pos = np.zeros((2,))
-        self.car_sprite = Sprite(car_img, car_mask, default_pos, 0)
-        self.obstacle_sprite = Sprite(obstacle_img, obstacle_mask, default_pos, 0)
-        self.goal_sprite = Sprite(goal_img, goal_mask, default_pos, 0)
+        self.car_sprite = self.create_car_sprite(car_img_transp, params.car_size, default_pos)
+        self.obstacle_sprite = self.create_obstacle_sprite(params.obstacle_size, default_pos)
+        self.goal_sprite = self.create_goal_sprite(params.goal_size, default_pos)
+
+        # the sprites that are drawn to the observations
+        if self.native_resolution:
+            self.car_sprite_scaled = self.create_car_sprite(car_img_transp, self.scaled(params.car_size),
+                                                            default_pos)
+            self.obstacle_sprite_scaled = self.create_obstacle_sprite(self.scaled(params.obstacle_size),
+                                                                      default_pos)
+            self.goal_sprite_scaled = self.create_goal_sprite(self.scaled(params.goal_size), default_pos)
+        else:
+            self.car_sprite_scaled = self.car_sprite
+            self.obstacle_sprite_scaled = self.obstacle_sprite
+            self.goal_sprite_scaled = self.goal_sprite
 
         # car and car_sprite are not the same
         # one is just for graphics, the other is for dynamic movement of the car
@@ -63,6 +82,35 @@ class Environment_Graphical(gym.Env):
 
         self.seed()
 
+    def scaled(self, size):
+        # a size in screen coordinates, in pixels of the observation
+        return tuple(np.maximum(np.round(np.array(size) * self.scale), 1).astype(np.int64))
+
+    def to_channels(self, img):
+        if self.observation_channels == 1:
+            return to_grayscale(img)
+        return img
+
+    def create_car_sprite(self, car_img_transp, size, pos):
+        car_img_transp = resize(car_img_transp, size)
+        car_img = car_img_transp[:, :, :3]  # cut away alpha
+        car_img = (car_img * 255).astype(np.uint8)
+        car_mask = (car_img_transp[:, :, 3] > 0).astype(np.bool)
+        return Sprite(self.to_channels(car_img), car_mask, pos, 0)
+
+    def create_obstacle_sprite(self, size, pos):
+        obstacle_img = np.zeros((*size, 3), dtype=np.uint8)
+        obstacle_img[:, :, 0] = (
+                255 * np.sin(np.linspace(0, 2 * np.pi, size[0])).reshape((-1, 1))).astype(np.uint8)
+        obstacle_mask = np.ones(size, dtype=np.bool)
+        return Sprite(self.to_channels(obstacle_img), obstacle_mask, pos, 0)
+
+    def create_goal_sprite(self, size, pos):
+        goal_img = np.zeros((*size, 3), dtype=np.uint8)
+        goal_img[:, :, 1] = (255 * np.sin(np.linspace(0, 4 * np.pi, size[1]))).astype(np.uint8)
+        goal_mask = np.ones(size, dtype=np.bool)
+        return Sprite(self.to_channels(goal_img), goal_mask, pos, 0)
+
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
         return [seed]
@@ -73,6 +121,7 @@ class Environment_Graphical(gym.Env):
 
         # set up values for dynamics
         self.car_sprite.set_rotation(0)
+        self.car_sprite_scaled.set_rotation(0)
         self.car.rot = 0
         self.car.speed = 0
 
@@ -81,12 +130,14 @@ class Environment_Graphical(gym.Env):
         car_position[0] = self.np_random.uniform(params.car_size[0] / 2, params.screen_size[0] - params.car_size[0] / 2)
         car_position[1] = params.screen_size[1] - params.car_size[1] / 2
         self.car_sprite.set_position(car_position)
+        self.car_sprite_scaled.set_position(car_position * self.scale)
         self.car.pos = car_position
 
         goal_position = np.array([0, 0])
         goal_position[0] = self.np_random.uniform(0, params.screen_size[0] - params.goal_size[0])
         goal_position[1] = params.goal_size[1] / 2
         self.goal_sprite.set_position(goal_position)
+        self.goal_sprite_scaled.set_position(goal_position * self.scale)
 
         min_dist = (1.5 * self.car_sprite.dim + min(self.goal_sprite.size))
 
@@ -104,38 +155,39 @@ class Environment_Graphical(gym.Env):
                     self.obstacle_positions.append(obstacle_position)
                     break
 
-        # render to background
-        self.goal_layer[:] = self.fillvalue
+        # render the masks, they are the same for the whole episode
         self.goal_mask[:] = False
-        self.goal_sprite.render(self.goal_layer, self.goal_mask)
+        self.render_mask(self.goal_sprite, self.goal_mask)
 
-        self.obstacle_layer[:] = self.fillvalue
         self.obstacle_mask[:] = False
         for obstacle_position in self.obstacle_positions:
             self.obstacle_sprite.set_position(obstacle_position)
-            self.obstacle_sprite.render(self.obstacle_layer, self.obstacle_mask)
+            self.render_mask(self.obstacle_sprite, self.obstacle_mask)
 
+        # render to background, the goal is on top of the obstacles
         self.background[:] = self.fillvalue
-        self.background[self.obstacle_mask] = self.obstacle_layer[self.obstacle_mask]
-        self.background[self.goal_mask] = self.goal_layer[self.goal_mask]
+        for obstacle_position in self.obstacle_positions:
+            self.obstacle_sprite_scaled.set_position(obstacle_position * self.scale)
+            draw(self.obstacle_sprite_scaled, self.background)
+        draw(self.goal_sprite_scaled, self.background)
 
         return self.render()
 
+    def render_mask(self, sprite, mask):
+        visible = sprite.cut_to_canvas(mask.shape)
+        if visible is None:
+            return
+        upperleft, img_visible, mask_visible = visible
+        render(mask_visible, mask_visible, upperleft, mask)
+
     def render(self):
         # TODO: after inheriting from gym.Env this is supposed to do something different
         # refactor to gym interface
 
-        # reset canvas and foreground,
-        # background is not rerendered
+        # reset canvas, background is not rerendered
+        # the car is the only sprite in the foreground, it is drawn directly to the canvas
         self.canvas[:] = self.background
-        self.car_layer[:] = self.fillvalue
-        self.car_mask[:] = False
-
-        # plot the car
-        self.car_sprite.render(self.car_layer, self.car_mask)
-
-        # overlay foreground to canvas
-        self.canvas[self.car_mask] = self.car_layer[self.car_mask]
+        draw(self.car_sprite_scaled, self.canvas)
 
         return self.canvas
 
@@ -180,10 +232,10 @@ class Environment_Graphical(gym.Env):
         # sync dynamics and graphics
         self.car_sprite.set_position(self.car.pos)
         self.car_sprite.set_rotation(-self.car.rot)
+        self.car_sprite_scaled.set_position(self.car.pos * self.scale)
+        self.car_sprite_scaled.set_rotation(-self.car.rot)
 
         # update rendering
-        # attention: this has an important side effect:
-        # it also updates the occupation masks for foreground and background
         observation = self.render()
 
         if border_collision and params.stop_on_border_collision:
@@ -201,9 +253,17 @@ class Environment_Graphical(gym.Env):
         return observation, params.reward_timestep + dist_reward, False
 
     def check_collisions(self):
-        if np.any(self.car_mask[self.obstacle_mask]):
+        # pixel precise, in screen coordinates, but only the pixels around the car are compared
+        visible = self.car_sprite.cut_to_canvas(self.obstacle_mask.shape)
+        if visible is None:
+            return 0, False
+        upperleft, _, car_mask = visible
+        window = (slice(upperleft[0], upperleft[0] + car_mask.shape[0]),
+                  slice(upperleft[1], upperleft[1] + car_mask.shape[1]))
+
+        if np.any(self.obstacle_mask[window][car_mask]):
             return params.reward_collision, True
-        if np.any(self.car_mask[self.goal_mask]):
+        if np.any(self.goal_mask[window][car_mask]):
             return params.reward_goal, True
 
         return 0, False
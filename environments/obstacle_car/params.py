@@ -8,6 +8,11 @@ obs_x_spread = 200
 goal_size = (40, 40)
 
 num_obstacles = 8
+
+# the graphical environment can render its observations directly at the resolution of the model
+# None renders at screen_size, 1 channel renders grayscale, like the preprocessing of the models
+observation_size = None
+observation_channels = 3
 distance_rescale = R / 4  # only used in radial environment
 x_tolerance = R / 4
 
@@ -0,0 +1,195 @@
+# runs several environments in worker processes, so that stepping them scales across cores
+# the observations are never pickled: every worker writes its observation to its row of a shared array
+# only actions, rewards, done flags and infos go through the pipes
+#
+# finished environments are reset by their worker right away,
+# the observation returned for them is the first one of the next episode
+import multiprocessing
+
+import numpy as np
+
+
+def _worker(remote, parent_remote, env_fn, index, observation_buffer, observation_shape, observation_dtype):
+    parent_remote.close()
+
+    env = env_fn()
+    observations = np.frombuffer(observation_buffer, dtype=observation_dtype).reshape(observation_shape)
+
+    try:
+        while True:
+            command, data = remote.recv()
+
+            if command == "step":
+                observation, reward, done, info = env.step(data)
+                if done:
+                    observation = env.reset()
+                observations[index] = observation
+                remote.send((reward, done, info))
+            elif command == "reset":
+                observations[index] = env.reset()
+                remote.send(None)
+            elif command == "seed":
+                remote.send(env.seed(data))
+            elif command == "sample_action":
+                remote.send(env.sample_action())
+            elif command == "num_actions":
+                remote.send(env.num_actions)
+            elif command == "close":
+                break
+            else:
+                raise ValueError("unknown command {}".format(command))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class DummyVecEnv:
+    # the same interface, but all environments run in this process, one after the other
+    # for cheap environments, where the pipes would cost more than the steps
+    def __init__(self, env_fns):
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.num_actions = self.envs[0].num_actions
+        self.actions = None
+
+    def __len__(self):
+        return self.num_envs
+
+    def seed(self, seed=None):
+        return [env.seed(None if seed is None else seed + i) for i, env in enumerate(self.envs)]
+
+    def reset(self):
+        return np.array([env.reset() for env in self.envs])
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        observations, rewards, dones, infos = [], [], [], []
+        for env, action in zip(self.envs, self.actions):
+            observation, reward, done, info = env.step(action)
+            if done:
+                observation = env.reset()
+            observations.append(observation)
+            rewards.append(reward)
+            dones.append(done)
+            infos.append(info)
+        self.actions = None
+
+        return np.array(observations), np.array(rewards), np.array(dones, dtype=np.bool_), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def sample_action(self):
+        return np.array([env.sample_action() for env in self.envs])
+
+    def close(self):
+        pass
+
+
+class SubprocVecEnv:
+    def __init__(self, env_fns, observation_shape, observation_dtype=np.uint8, start_method=None):
+        """
+        :param env_fns: one function per environment, creating it in the worker, e.g. the environment class
+        with the spawn start method, they have to be picklable
+        :param observation_shape: shape of the observation of a single environment
+        :param observation_dtype: dtype of the observations
+        :param start_method: of the worker processes, by default the one of the platform
+        tensorflow doesn't survive forking, use "spawn" if it has been imported
+        """
+        self.num_envs = len(env_fns)
+        self.observation_dtype = np.dtype(observation_dtype)
+        self.observation_shape = (self.num_envs, *observation_shape)
+
+        context = multiprocessing.get_context(start_method)
+
+        # a raw array has no lock, every worker only writes its own row
+        # and only while the main process waits for it
+        num_bytes = int(np.prod(self.observation_shape)) * self.observation_dtype.itemsize
+        self.observation_buffer = context.RawArray("b", max(num_bytes, 1))
+        self.observations = np.frombuffer(self.observation_buffer, dtype=self.observation_dtype,
+                                          count=int(np.prod(self.observation_shape))).reshape(self.observation_shape)
+
+        self.remotes, worker_remotes = zip(*[context.Pipe() for i in range(self.num_envs)])
+        self.processes = []
+        for index, (worker_remote, remote, env_fn) in enumerate(zip(worker_remotes, self.remotes, env_fns)):
+            process = context.Process(target=_worker,
+                                      args=(worker_remote, remote, env_fn, index, self.observation_buffer,
+                                            self.observation_shape, self.observation_dtype),
+                                      daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        # the workers keep their own ends of the pipes
+        for worker_remote in worker_remotes:
+            worker_remote.close()
+
+        self.waiting = False
+        self.closed = False
+
+        self.remotes[0].send(("num_actions", None))
+        self.num_actions = self.remotes[0].recv()
+
+    def __len__(self):
+        return self.num_envs
+
+    def seed(self, seed=None):
+        # every environment gets its own seed
+        for i, remote in enumerate(self.remotes):
+            remote.send(("seed", None if seed is None else seed + i))
+        return [remote.recv() for remote in self.remotes]
+
+    def reset(self):
+        """
+        :return: the first observations of all environments
+        """
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+
+        # the next step overwrites the shared array, the caller gets a copy
+        return self.observations.copy()
+
+    def step_async(self, actions):
+        # the environments step while the caller does something else, e.g. training
+        assert not self.waiting, "step_wait has to be called before the next step"
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", int(action)))
+        self.waiting = True
+
+    def step_wait(self):
+        """
+        :return: observations, rewards, dones and infos of all environments
+        """
+        assert self.waiting, "step_async has to be called first"
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+
+        rewards, dones, infos = zip(*results)
+        return self.observations.copy(), np.array(rewards), np.array(dones, dtype=np.bool_), list(infos)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def sample_action(self):
+        # one random action per environment
+        for remote in self.remotes:
+            remote.send(("sample_action", None))
+        return np.array([remote.recv() for remote in self.remotes])
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
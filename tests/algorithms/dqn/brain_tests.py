@@ -0,0 +1,165 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from keras.layers import Concatenate, Dense, Input, Multiply
+from keras.models import Model
+
+import algorithms.dqn.params as params
+from algorithms.dqn.brain import Brain
+from algorithms.dqn.memory import Equal_Memory
+from algorithms.dqn.models import FullyConnectedModel
+from util.loss_functions import huber_loss
+
+
+class RecurrentModel:
+    # a minimal stateful model: the q values and the next state depend on the observation and the state
+    OBSERVATION_SHAPE = (3,)
+    STATEFUL = True
+    STATE_SHAPE = (2,)
+
+    def __init__(self):
+        self.input_observation = Input(shape=self.OBSERVATION_SHAPE)
+        self.input_state = Input(shape=self.STATE_SHAPE)
+        self.mask_layer = Input(shape=(params.NUM_ACTIONS,))
+
+        hidden = Concatenate()([self.input_observation, self.input_state])
+        q_values = Dense(params.NUM_ACTIONS)(hidden)
+        next_state = Dense(self.STATE_SHAPE[0], activation="tanh")(hidden)
+        self.q_values_masked = Multiply()([q_values, self.mask_layer])
+
+        self.model = Model(inputs=[self.input_observation, self.input_state, self.mask_layer],
+                           outputs=[self.q_values_masked, next_state])
+        self.loss_regularization = 0.
+        self.trainable_weights = self.model.trainable_weights
+
+    def get_initial_state(self):
+        return np.zeros(self.STATE_SHAPE)
+
+    def predict(self, observation, state):
+        return self.model.predict([observation, state, np.ones((len(observation), params.NUM_ACTIONS))])
+
+    def create_feed_dict(self, observation, state, mask):
+        return {self.input_observation: observation, self.input_state: state, self.mask_layer: mask}
+
+
+def random_batch(size):
+    # observations, actions, rewards, terminals and discounts like the memory samples them
+    from_observations = np.random.rand(size, *FullyConnectedModel.OBSERVATION_SHAPE).astype(np.float32)
+    to_observations = np.random.rand(size, *FullyConnectedModel.OBSERVATION_SHAPE).astype(np.float32)
+    actions = np.random.randint(0, params.NUM_ACTIONS, size)
+    rewards = np.random.rand(size)
+    terminals = np.random.rand(size) < 0.3
+    discounts = np.full((size,), params.GAMMA) ** np.random.randint(1, 4, size)
+    return from_observations, to_observations, actions, rewards, terminals, discounts
+
+
+class ReplayedMemory:
+    # hands out the given batches in order, like sample_batch, and records the priority updates
+    priority_based_sampling = True
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.updates = []
+
+    def sample_batch(self):
+        from_observations, to_observations, actions, rewards, terminals, discounts = self.batches.pop(0)
+        indices = np.arange(len(actions))
+        batch = (from_observations, to_observations, None, None, actions, rewards, terminals, discounts)
+        return indices, np.linspace(0.5, 1, len(actions)), batch, 0
+
+    def update_priority(self, indices, priorities, number_writes=None):
+        self.updates.append(np.array(priorities))
+
+
+class TestBrain(TestCase):
+
+    def setUp(self):
+        # every test gets a graph of its own
+        self.graph = tf.Graph()
+        self.context = self.graph.as_default()
+        self.context.__enter__()
+        self.brain = Brain(FullyConnectedModel, None, loss_func=huber_loss)
+
+        # a small memory in ram, the memory creates its directories in the working directory
+        self.params_backup = {name: getattr(params, name) for name in ["REPLAY_MEMORY_SIZE", "MEMORY_MAPPED",
+                                                                       "BATCH_SIZE", "SEQUENCE_LENGTH",
+                                                                       "BURN_IN_LENGTH"]}
+        params.REPLAY_MEMORY_SIZE = 16
+        params.MEMORY_MAPPED = False
+
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+        for name, value in self.params_backup.items():
+            setattr(params, name, value)
+
+        self.brain.sess.close()
+        K.clear_session()
+        self.context.__exit__(None, None, None)
+
+    def testDoubleDQN(self):
+        from_observations, to_observations, actions, rewards, terminals, discounts = random_batch(16)
+
+        # the reference: the model chooses the next action, the target model evaluates it
+        q, _ = self.brain.predict_q(from_observations, None)
+        next_q, _ = self.brain.predict_q(to_observations, None)
+        next_q_target, _ = self.brain.predict_q_target(to_observations, None)
+        chosen_q = next_q_target[np.arange(16), next_q.argmax(axis=-1)]
+        targets = rewards + discounts * chosen_q * (1 - terminals)
+        priorities = np.power(np.abs(targets - q[np.arange(16), actions]) + params.ERROR_BIAS, params.ERROR_POW)
+
+        self.assertTrue(np.allclose(self.brain.get_targets(to_observations, None, rewards, terminals, discounts),
+                                    targets, atol=1e-5))
+
+        fused_priorities = self.brain.compute_priorities(from_observations, to_observations, actions, rewards,
+                                                         terminals, discounts)
+        self.assertTrue(np.allclose(fused_priorities, priorities, atol=1e-5))
+
+    def testTrainMany(self):
+        batches = [random_batch(8) for i in range(3)]
+        state = self.brain.get_state()
+
+        # three steps in one session call
+        self.brain.memory = ReplayedMemory(batches)
+        self.brain.train_many(3)
+        stacked_weights = self.brain.model.model.get_weights()
+        stacked_priorities = self.brain.memory.updates
+
+        # have to give the same weights and priorities as three single steps on the same batches
+        self.brain.set_state(state)
+        self.brain.memory = ReplayedMemory(batches)
+        for i in range(3):
+            self.brain.train_once()
+
+        for stacked, single in zip(stacked_weights, self.brain.model.model.get_weights()):
+            self.assertTrue(np.allclose(stacked, single, atol=1e-5))
+        for stacked, single in zip(stacked_priorities, self.brain.memory.updates):
+            self.assertTrue(np.allclose(stacked, single, atol=1e-5))
+
+    def testSequences(self):
+        params.BATCH_SIZE = 2
+        params.SEQUENCE_LENGTH = 4
+        params.BURN_IN_LENGTH = 2
+        memory = Equal_Memory(RecurrentModel)
+        brain = Brain(RecurrentModel, memory, loss_func=huber_loss)
+
+        for step in range(16):
+            observation = np.random.rand(3)
+            state = np.random.rand(2)
+            memory.push(observation, np.random.rand(3), state, state, step % params.NUM_ACTIONS, 1., step == 9)
+
+        # the brain trains on the sequences, the stored start states are all it needs
+        weights = brain.model.model.get_weights()
+        brain.train_once()
+        new_weights = brain.model.model.get_weights()
+        self.assertTrue(any(not np.allclose(old, new) for old, new in zip(weights, new_weights)))
+        brain.sess.close()
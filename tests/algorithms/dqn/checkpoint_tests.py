@@ -0,0 +1,69 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from algorithms.dqn.checkpoint import Checkpointer
+
+
+class StateHolder:
+    # brains and agents only need get_state and set_state for checkpoints
+    def __init__(self, state):
+        self.state = state
+
+    def get_state(self):
+        return dict(self.state)
+
+    def set_state(self, state):
+        self.state = state
+
+
+class TestCheckpointer(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def testRotation(self):
+        directory = os.path.join(self.tmp_dir.name, "checkpoints")
+        checkpointer = Checkpointer(directory, keep=2)
+
+        brain = StateHolder({"weights": np.zeros((3,))})
+        for interaction in range(5):
+            brain.state["weights"] = np.full((3,), interaction)
+            checkpointer.save(checkpointer.snapshot(brain, None, {"interaction": interaction}))
+        checkpointer.close()
+
+        # the newest snapshot is always written, intermediate ones may be skipped
+        paths = checkpointer.checkpoint_paths()
+        self.assertLessEqual(len(paths), 2)
+        snapshot = checkpointer.load_latest()
+        self.assertEqual(snapshot["counters"]["interaction"], 4)
+        self.assertTrue(np.all(snapshot["brain"]["weights"] == 4))
+
+        checkpointer.clear()
+        self.assertEqual(checkpointer.checkpoint_paths(), [])
+
+    def testRestore(self):
+        directory = os.path.join(self.tmp_dir.name, "checkpoints")
+        checkpointer = Checkpointer(directory)
+
+        brain = StateHolder({"target_updates": 3})
+        agent = StateHolder({"exploration": 0.5})
+        checkpointer.save(checkpointer.snapshot(brain, agent, {"interaction": 100}))
+        checkpointer.close()
+        expected_random = np.random.rand(3)
+
+        # a new process would start with other random numbers and a fresh brain and agent
+        np.random.rand(10)
+        brain = StateHolder({})
+        agent = StateHolder({})
+        counters = Checkpointer(directory).restore(checkpointer.load_latest(), brain, agent)
+
+        self.assertEqual(counters["interaction"], 100)
+        self.assertEqual(brain.state["target_updates"], 3)
+        self.assertEqual(agent.state["exploration"], 0.5)
+        self.assertTrue(np.all(np.random.rand(3) == expected_random))
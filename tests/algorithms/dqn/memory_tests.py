@@ -0,0 +1,373 @@
+import multiprocessing
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+import algorithms.dqn.params as params
+from algorithms.dqn.memory import Equal_Memory, Priority_Memory, SharedPriorityMemory
+from algorithms.dqn.prefetcher import BatchPrefetcher
+
+
+class ImageModel:
+    OBSERVATION_SHAPE = (4, 4, params.FRAME_STACK)
+    STATEFUL = False
+
+
+class VectorModel:
+    OBSERVATION_SHAPE = (3,)
+    STATEFUL = False
+
+
+class StatefulModel:
+    OBSERVATION_SHAPE = (3,)
+    STATEFUL = True
+    STATE_SHAPE = (2,)
+
+
+def push_transitions(memory, value):
+    # an actor process, pushing transitions whose observations, actions and rewards are all equal to value
+    # module level, so that spawned processes can import it
+    for i in range(5):
+        observation = np.full((3,), value, dtype=np.uint8)
+        memory.push(observation, observation, None, None, value, value, False, 1)
+    memory.close()
+
+
+class TestMemory(TestCase):
+
+    def setUp(self):
+        # a small memory in ram, the memory creates its directories in the working directory
+        self.params_backup = {name: getattr(params, name) for name in ["REPLAY_MEMORY_SIZE", "MEMORY_MAPPED",
+                                                                       "DEDUPLICATE_FRAMES", "N_STEP",
+                                                                       "COMPRESS_OBSERVATIONS", "SEQUENCE_LENGTH",
+                                                                       "BURN_IN_LENGTH"]}
+        params.REPLAY_MEMORY_SIZE = 16
+        params.MEMORY_MAPPED = False
+
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+        for name, value in self.params_backup.items():
+            setattr(params, name, value)
+
+    def fill(self, memory, num_transitions, episode_length):
+        # pushes transitions like the agent does, with stacked frames and resets
+        # returns the stacks that have been pushed
+        from_observations, to_observations = [], []
+
+        # the priority memory expects a priority for every transition
+        priority = (1,) if memory.priority_based_sampling else ()
+
+        observation = None
+        for step in range(num_transitions):
+            if observation is None:
+                frame = np.random.randint(0, 255, (4, 4), dtype=np.uint8)
+                observation = np.stack([frame] * params.FRAME_STACK, axis=-1)
+
+            frame = np.random.randint(0, 255, (4, 4), dtype=np.uint8)
+            to_observation = np.zeros_like(observation)
+            to_observation[:, :, :-1] = observation[:, :, 1:]
+            to_observation[:, :, -1] = frame
+
+            done = (step + 1) % episode_length == 0
+            memory.push(observation, to_observation, None, None, 0, 0, done, *priority)
+
+            from_observations.append(observation)
+            to_observations.append(to_observation)
+
+            observation = None if done else to_observation
+
+        return np.array(from_observations), np.array(to_observations)
+
+    def testFrameDeduplication(self):
+        params.DEDUPLICATE_FRAMES = True
+        memory = Equal_Memory(ImageModel)
+        self.assertTrue(memory.deduplicate_frames)
+
+        # more transitions than the memory can hold, the ring buffer wraps around
+        from_observations, to_observations = self.fill(memory, 40, episode_length=5)
+
+        # the transitions still in memory are the last 16, starting at replay index 40 % 16
+        indices = (np.arange(16) + 40) % 16
+        sampled_from, sampled_to, _, _, _, _, terminals, _ = memory[indices]
+
+        self.assertTrue(np.all(sampled_from == from_observations[-16:]))
+
+        # the to observations of terminal transitions are not stored
+        non_terminal = ~terminals
+        self.assertTrue(np.all(sampled_to[non_terminal] == to_observations[-16:][non_terminal]))
+
+    def testFullStorage(self):
+        params.DEDUPLICATE_FRAMES = False
+        memory = Equal_Memory(ImageModel)
+        self.assertFalse(memory.deduplicate_frames)
+
+        from_observations, to_observations = self.fill(memory, 20, episode_length=7)
+
+        indices = (np.arange(16) + 20) % 16
+        sampled_from, sampled_to, _, _, _, _, _, _ = memory[indices]
+
+        self.assertTrue(np.all(sampled_from == from_observations[-16:]))
+        self.assertTrue(np.all(sampled_to == to_observations[-16:]))
+
+    def testCompressedObservations(self):
+        params.COMPRESS_OBSERVATIONS = True
+        params.MEMORY_MAPPED = True
+
+        for deduplicate_frames in [True, False]:
+            params.DEDUPLICATE_FRAMES = deduplicate_frames
+            memory = Equal_Memory(ImageModel)
+            self.assertFalse(memory.memory_mapped)
+
+            from_observations, to_observations = self.fill(memory, 20, episode_length=7)
+
+            indices = (np.arange(16) + 20) % 16
+            sampled_from, sampled_to, _, _, _, _, terminals, _ = memory[indices]
+
+            self.assertTrue(np.all(sampled_from == from_observations[-16:]))
+            self.assertTrue(np.all(sampled_to[~terminals] == to_observations[-16:][~terminals]))
+
+    def testSequences(self):
+        params.SEQUENCE_LENGTH = 4
+        params.BURN_IN_LENGTH = 2
+        memory = Equal_Memory(StatefulModel)
+        self.assertTrue(memory.sequence_mode)
+        self.assertEqual(memory.start_state_memory.shape, (4, 2))
+
+        # the observations, states and actions count the transitions
+        for step in range(13):
+            observation = np.full((3,), step, dtype=np.uint8)
+            state = np.full((2,), step, dtype=np.float32)
+            memory.push(observation, observation + 1, state, state + 1, step, step, step == 9)
+
+        # 13 transitions, sequences of length 6 can start at slot 0, 4 and 8 but 8 would reach slot 13
+        self.assertEqual(sorted(memory.sample_sequences(2)), [0, 4])
+
+        from_observations, to_observations, start_states, actions, rewards, terminals, valid = \
+            memory.get_sequences(np.array([4, 0]))
+        self.assertEqual(from_observations.shape, (2, 6, 3))
+        self.assertTrue(np.all(actions[0] == np.arange(4, 10)))
+        self.assertTrue(np.all(to_observations[1][:, 0] == np.arange(1, 7)))
+        self.assertTrue(np.all(start_states == [[4, 4], [0, 0]]))
+        self.assertTrue(np.all(valid))
+
+        # after wrapping around, the sequence starting at 12 reaches into slot 1
+        for step in range(13, 22):
+            observation = np.full((3,), step, dtype=np.uint8)
+            state = np.full((2,), step, dtype=np.float32)
+            memory.push(observation, observation + 1, state, state + 1, step, step, step == 9)
+
+        _, _, start_states, actions, _, _, valid = memory.get_sequences(np.array([12]))
+        self.assertTrue(np.all(actions[0] == np.arange(12, 18)))
+        self.assertTrue(np.all(start_states[0] == 12))
+
+        # the sequence starting at 8 contains the end of an episode
+        _, _, _, _, _, terminals, valid = memory.get_sequences(np.array([8]))
+        self.assertTrue(np.all(valid[0] == [True, True, False, False, False, False]))
+
+        # the n-step windows end at the end of the episode and at the end of the sequence
+        params.N_STEP = 3
+        rewards = np.ones((1, 6))
+        last, rewards, terminals, discounts = memory.get_sequence_returns(rewards, terminals)
+        gamma = params.GAMMA
+        self.assertTrue(np.all(last[0] == [1, 1, 4, 5, 5, 5]))
+        self.assertTrue(np.all(terminals[0] == [True, True, False, False, False, False]))
+        self.assertTrue(np.allclose(discounts[0], gamma ** np.array([2, 1, 3, 3, 2, 1])))
+        self.assertTrue(np.allclose(rewards[0], [1 + gamma, 1, 1 + gamma + gamma ** 2, 1 + gamma + gamma ** 2,
+                                                 1 + gamma, 1]))
+
+    def testResume(self):
+        params.DEDUPLICATE_FRAMES = True
+        params.MEMORY_MAPPED = True
+
+        memory = Priority_Memory(ImageModel)
+        self.assertFalse(memory.resumed)
+        self.fill(memory, 20, episode_length=6)
+        memory.update_priority([3, 4], [5, 7])
+        memory.save()
+
+        # a second memory reattaches to the same files
+        resumed = Priority_Memory(ImageModel)
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(resumed.number_writes, memory.number_writes)
+        self.assertEqual(resumed.replay_index, memory.replay_index)
+        self.assertEqual(resumed.priority_sumtree._data[0], memory.priority_sumtree._data[0])
+
+        indices = np.arange(16)
+        for original, restored in zip(memory[indices], resumed[indices]):
+            if original is not None:
+                self.assertTrue(np.all(original == restored))
+
+        # pushing continues in the same episode
+        self.fill(resumed, 1, episode_length=1)
+        self.assertEqual(resumed.number_writes, 21)
+
+    def testNStepReturns(self):
+        params.DEDUPLICATE_FRAMES = True
+        params.N_STEP = 3
+        memory = Equal_Memory(ImageModel)
+
+        # one episode of 4 transitions with rewards 1, 2, 3, 4 and the start of the next one
+        observation = np.zeros((4, 4, params.FRAME_STACK), dtype=np.uint8)
+        for step, reward in enumerate([1, 2, 3, 4, 5]):
+            to_observation = np.full_like(observation, step + 1)
+            memory.push(observation, to_observation, None, None, 0, reward, step == 3)
+            observation = to_observation
+
+        gamma = params.GAMMA
+        _, to_observations, _, _, _, rewards, terminals, discounts = memory[np.arange(5)]
+
+        # a full window
+        self.assertAlmostEqual(rewards[0], 1 + 2 * gamma + 3 * gamma ** 2)
+        self.assertAlmostEqual(discounts[0], gamma ** 3)
+        self.assertFalse(terminals[0])
+        self.assertTrue(np.all(to_observations[0][..., -1] == 3))
+
+        # windows are cut at the end of the episode
+        self.assertAlmostEqual(rewards[2], 3 + 4 * gamma)
+        self.assertAlmostEqual(discounts[2], gamma ** 2)
+        self.assertTrue(terminals[2])
+
+        # and at the newest transition in the memory
+        self.assertAlmostEqual(rewards[4], 5)
+        self.assertAlmostEqual(discounts[4], gamma)
+        self.assertFalse(terminals[4])
+        self.assertTrue(np.all(to_observations[4][..., -1] == 5))
+
+    def testStreams(self):
+        params.DEDUPLICATE_FRAMES = True
+        params.N_STEP = 2
+        memory = Priority_Memory(ImageModel, num_streams=2)
+
+        # two environments with episodes of 3 and 5 transitions
+        episode_lengths = np.array([3, 5])
+        observations = np.random.randint(0, 255, (2, 4, 4, params.FRAME_STACK), dtype=np.uint8)
+        steps = np.zeros((2,), dtype=np.int64)
+        pushed = []
+        for interaction in range(20):
+            frames = np.random.randint(0, 255, (2, 4, 4), dtype=np.uint8)
+            to_observations = np.concatenate([observations[..., 1:], frames[..., None]], axis=-1)
+            dones = (steps + 1) % episode_lengths == 0
+
+            memory.push_many(observations, to_observations, None, None, [0, 1], [1, 1], dones, [1, 1])
+            pushed.extend(zip(observations, to_observations, dones))
+
+            steps += 1
+            observations = to_observations.copy()
+            for stream in np.flatnonzero(dones):
+                frame = np.random.randint(0, 255, (4, 4), dtype=np.uint8)
+                observations[stream] = np.stack([frame] * params.FRAME_STACK, axis=-1)
+
+        # the last 16 transitions, starting at replay index 40 % 16
+        indices = (np.arange(16) + 40) % 16
+        from_observations, to_observations, _, _, actions, rewards, terminals, discounts = memory[indices]
+
+        self.assertTrue(np.all(actions == np.arange(16) % 2))
+        self.assertTrue(np.all(from_observations == [from_observation for from_observation, _, _ in pushed[-16:]]))
+
+        # the n-step windows follow the transitions of the same stream
+        for i, (_, _, done) in enumerate(pushed[-16:]):
+            if done:
+                self.assertTrue(terminals[i])
+                self.assertAlmostEqual(rewards[i], 1)
+            elif i < 14:
+                self.assertAlmostEqual(rewards[i], 1 + params.GAMMA)
+                self.assertTrue(np.all(to_observations[i] == pushed[-16:][i + 2][1]) or terminals[i])
+
+    def testChunks(self):
+        params.DEDUPLICATE_FRAMES = False
+        memory = Priority_Memory(VectorModel)
+
+        # consecutive transitions of one stream can be pushed at once, when frames are not deduplicated
+        for chunk in range(3):
+            observations = np.arange(5 * chunk, 5 * chunk + 5, dtype=np.uint8)[:, None].repeat(3, axis=1)
+            memory.push_many(observations, observations + 1, None, None, np.zeros((5,)), np.ones((5,)),
+                             np.zeros((5,), dtype=np.bool), np.arange(5) + 1)
+
+        self.assertEqual(len(memory), 15)
+        self.assertEqual(memory.priority_sumtree._data[0], 3 * 15)
+        from_observations, to_observations, _, _, _, _, _, _ = memory[np.arange(15)]
+        self.assertTrue(np.all(from_observations[:, 0] == np.arange(15)))
+
+    def testStalePriorityUpdates(self):
+        memory = Priority_Memory(ImageModel)
+        self.fill(memory, 16, 5)
+
+        indices, _, _, number_writes = memory.sample_batch(16)
+
+        # the three oldest slots are overwritten before the priorities arrive
+        self.fill(memory, 3, 5)
+        memory.update_priority(indices, np.full((16,), 2.), number_writes)
+
+        self.assertTrue(np.all(memory.priority_sumtree.get([0, 1, 2]) == 1))
+        self.assertTrue(np.all(memory.priority_sumtree.get(np.arange(3, 16)) == 2))
+        self.assertEqual(memory.priority_mintree.reduce(), 1)
+
+    def testPrefetcher(self):
+        memory = Priority_Memory(ImageModel)
+        self.fill(memory, 16, 5)
+
+        prefetcher = BatchPrefetcher(memory, batch_size=8, num_batches=2, num_threads=2)
+        for i in range(5):
+            indices, weights, batch, number_writes = prefetcher.get()
+            self.assertEqual(len(indices), 8)
+            self.assertEqual(batch[0].shape, (8, *ImageModel.OBSERVATION_SHAPE))
+            self.assertTrue(np.all((weights > 0) & (weights <= 1)))
+
+            # priorities that change while batches wait in the queue are reflected in the weights
+            memory.update_priority(indices, np.full(indices.shape, 2.), number_writes)
+        prefetcher.stop()
+
+        self.assertEqual(prefetcher.num_batches, 5)
+        self.assertEqual(len(prefetcher.threads), 0)
+
+    def testSharedMemory(self):
+        for start_method in ["fork", "spawn"]:
+            with self.subTest(start_method=start_method):
+                self.checkSharedMemory(multiprocessing.get_context(start_method))
+
+    def checkSharedMemory(self, context):
+        # spawned processes get a pickled memory, which reattaches to the shared blocks
+        memory = SharedPriorityMemory(VectorModel, context)
+        self.assertFalse(memory.deduplicate_frames)
+
+        # two processes push concurrently
+        actors = [context.Process(target=push_transitions, args=(memory, value)) for value in [1, 2]]
+        for actor in actors:
+            actor.start()
+        for actor in actors:
+            actor.join()
+
+        self.assertEqual(len(memory), 10)
+        self.assertTrue(np.all(memory._slot_versions[:10] == 2))
+        self.assertEqual(memory.priority_sumtree._data[0], 10)
+
+        # every slot holds a complete transition of one of the actors
+        indices, weights = memory.sample_indices(10)
+        from_observations, _, _, _, actions, _, _, _ = memory[indices]
+        self.assertTrue(np.all(from_observations == actions[:, None]))
+        self.assertTrue(np.all(weights == 1))
+
+        memory.close()
+
+    def testSharedMemoryPushMany(self):
+        memory = SharedPriorityMemory(VectorModel)
+
+        observations = np.arange(12, dtype=np.uint8).reshape((4, 3))
+        memory.push_many(observations, observations, None, None, np.arange(4), np.zeros(4), np.zeros(4, np.bool_),
+                         np.arange(1, 5))
+
+        self.assertEqual(len(memory), 4)
+        self.assertTrue(np.all(memory._slot_versions[:4] == 2))
+        self.assertEqual(memory.priority_sumtree._data[0], 1 + 2 + 3 + 4)
+        self.assertEqual(memory.priority_mintree.reduce(), 1)
+        self.assertTrue(np.all(memory[np.arange(4)][0] == observations))
+
+        memory.close()
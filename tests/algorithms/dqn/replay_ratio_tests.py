@@ -0,0 +1,44 @@
+import threading
+from unittest import TestCase
+
+from algorithms.dqn.replay_ratio import ReplayRatioController
+
+
+class TestReplayRatioController(TestCase):
+
+    def testRatio(self):
+        controller = ReplayRatioController(replay_ratio=0.25, tolerance=2)
+
+        # the learner runs as fast as it can, it is throttled by the interactions
+        def learn():
+            while controller.wait_for_update():
+                # the learner never gets ahead more than the tolerance
+                self.assertLessEqual(controller.updates + 1, 0.25 * controller.interactions + 2)
+                controller.update_done()
+
+        learner = threading.Thread(target=learn)
+        learner.start()
+
+        for interaction in range(400):
+            controller.add_interactions()
+
+            # and the actor never gets ahead more than the tolerance
+            self.assertGreaterEqual(controller.updates, 0.25 * controller.interactions - 2)
+
+        controller.stop()
+        learner.join()
+
+        self.assertGreaterEqual(controller.updates, 100 - 2)
+        self.assertLessEqual(controller.updates, 100 + 2)
+
+    def testStop(self):
+        controller = ReplayRatioController(replay_ratio=1, tolerance=0)
+
+        # without interactions, the learner waits until it is stopped
+        result = []
+        learner = threading.Thread(target=lambda: result.append(controller.wait_for_update()))
+        learner.start()
+        controller.stop()
+        learner.join()
+
+        self.assertEqual(result, [False])
@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+import numpy as np
+
+import algorithms.ppo_sequential.params as params
+from algorithms.ppo_sequential.agent import VecAgent
+from algorithms.ppo_sequential.memory import Memory
+
+
+class CountingEnvironment:
+    # the observation counts the steps, every episode has three of them
+    num_actions = params.NUM_ACTIONS
+
+    def __init__(self):
+        self.steps = 0
+
+    def reset(self):
+        self.steps = 0
+        return np.zeros((3,))
+
+    def step(self, action):
+        self.steps += 1
+        return np.full((3,), self.steps), 1., self.steps == 3, {}
+
+    def sample_action(self):
+        return 0
+
+
+class UniformBrain:
+    # the parts of the brain the agent uses: uniform policies, no states
+    def predict(self, observations, states):
+        num_envs = len(observations)
+        return np.full((num_envs, params.NUM_ACTIONS), 1 / params.NUM_ACTIONS), np.zeros((num_envs, 1)), []
+
+    def preprocess_batch(self, observations, out=None):
+        return np.array(observations, dtype=np.float32)
+
+    def get_initial_state(self):
+        return []
+
+
+class TestVecAgent(TestCase):
+
+    def testActing(self):
+        memory = Memory()
+        agent = VecAgent(UniformBrain(), memory, CountingEnvironment, num_envs=3, subprocesses=False)
+
+        agent.reset()
+        for i in range(5):
+            agent.act()
+
+        # every environment finished one episode and started the next one
+        self.assertEqual(agent.num_episodes, 3)
+        self.assertEqual(agent.episode_rewards, [3., 3., 3.])
+        self.assertTrue(np.all(agent.observations == 2))
+        self.assertEqual(len(agent.trajectory), 5)
@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+import algorithms.ppo_sequential.params as params
+from algorithms.ppo_sequential.brain import Brain
+from algorithms.policy_models.fc_models import FCRadialCar
+
+
+def random_rollout(num_transitions):
+    # the fields of the memory, in the order of util.rollout_buffer.FIELDS
+    observations = np.random.rand(num_transitions, *FCRadialCar.INPUT_SHAPE)
+    states = np.empty((num_transitions, 0))
+    policies = np.random.rand(num_transitions, params.NUM_ACTIONS) + 0.1
+    policies /= policies.sum(axis=-1, keepdims=True)
+    actions = np.eye(params.NUM_ACTIONS)[np.random.randint(0, params.NUM_ACTIONS, num_transitions)]
+    column = lambda: np.random.rand(num_transitions, 1)
+    return (observations, states, observations, states, policies, column(), actions, column(), column(),
+            np.zeros((num_transitions, 1), dtype=np.bool_), np.ones((num_transitions, 1)))
+
+
+class TestPipelinedBrain(TestCase):
+
+    def setUp(self):
+        # every test gets a graph of its own
+        self.graph = tf.Graph()
+        self.context = self.graph.as_default()
+        self.context.__enter__()
+        self.brain = Brain(FCRadialCar, pipelined=True)
+
+    def tearDown(self):
+        self.brain.session.close()
+        K.clear_session()
+        self.context.__exit__(None, None, None)
+
+    def testActingModel(self):
+        old_weights = self.brain.model.model.get_weights()
+
+        self.brain.optimize_in_background(random_rollout(2 * params.BATCH_SIZE), save=False)
+        self.brain.wait_for_optimization()
+
+        # the agent keeps acting with the weights the rollout was collected with
+        optimized_weights = self.brain.model.model.get_weights()
+        self.assertTrue(any(not np.allclose(old, new) for old, new in zip(old_weights, optimized_weights)))
+        for old, acting in zip(old_weights, self.brain.acting_model.model.get_weights()):
+            self.assertTrue(np.allclose(old, acting))
+
+        # until the next rollout starts
+        self.brain.update_acting_model()
+        for optimized, acting in zip(optimized_weights, self.brain.acting_model.model.get_weights()):
+            self.assertTrue(np.allclose(optimized, acting))
+
+    def testErrors(self):
+        # a batch without all fields fails in the background thread
+        self.brain.optimize_in_background(random_rollout(8)[:5], save=False)
+        with self.assertRaises(ValueError):
+            self.brain.wait_for_optimization()
+
+        # the error is raised only once
+        self.brain.wait_for_optimization()
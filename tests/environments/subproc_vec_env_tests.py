@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import numpy as np
+
+from environments.subproc_vec_env import DummyVecEnv, SubprocVecEnv
+
+
+class CountingEnvironment:
+    # the observation counts the steps, every episode has three of them
+    num_actions = 2
+
+    def __init__(self):
+        self.steps = 0
+        self.offset = 0
+
+    def seed(self, seed=None):
+        self.offset = seed
+        return [seed]
+
+    def reset(self):
+        self.steps = 0
+        return np.full((2, 3), self.offset, dtype=np.uint8)
+
+    def step(self, action):
+        self.steps += 1
+        observation = np.full((2, 3), self.offset + self.steps, dtype=np.uint8)
+        return observation, float(action), self.steps == 3, {"steps": self.steps}
+
+    def sample_action(self):
+        return 1
+
+
+class TestSubprocVecEnv(TestCase):
+
+    def setUp(self):
+        self.envs = SubprocVecEnv([CountingEnvironment] * 3, (2, 3), np.uint8)
+
+    def tearDown(self):
+        self.envs.close()
+
+    def testSteps(self):
+        self.envs.seed(10)
+        observations = self.envs.reset()
+        self.assertEqual(observations.shape, (3, 2, 3))
+        self.assertTrue(np.array_equal(observations[:, 0, 0], [10, 11, 12]))
+
+        observations, rewards, dones, infos = self.envs.step([0, 1, 1])
+        self.assertTrue(np.array_equal(observations[:, 0, 0], [11, 12, 13]))
+        self.assertTrue(np.array_equal(rewards, [0, 1, 1]))
+        self.assertFalse(np.any(dones))
+        self.assertEqual(infos[0]["steps"], 1)
+        self.assertEqual(self.envs.num_actions, 2)
+
+    def testAutomaticReset(self):
+        self.envs.seed(10)
+        self.envs.reset()
+        for i in range(2):
+            self.envs.step([0, 0, 0])
+
+        # the returned observations are copies, the next step doesn't change them
+        self.envs.step_async([0, 0, 0])
+        observations, rewards, dones, infos = self.envs.step_wait()
+        self.envs.step([0, 0, 0])
+
+        self.assertTrue(np.all(dones))
+        self.assertTrue(np.array_equal(observations[:, 0, 0], [10, 11, 12]))
+
+
+class TestDummyVecEnv(TestSubprocVecEnv):
+    # the in process version has to behave the same
+
+    def setUp(self):
+        self.envs = DummyVecEnv([CountingEnvironment] * 3)
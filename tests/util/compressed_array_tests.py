@@ -0,0 +1,66 @@
+from unittest import TestCase
+
+import numpy as np
+from compressed_array import CompressedArray
+
+
+class TestCompressedArray(TestCase):
+
+    def testReadWrite(self):
+        array = CompressedArray((10, 4, 3), np.uint8)
+        values = np.random.randint(0, 255, (10, 4, 3), dtype=np.uint8)
+        for i in range(10):
+            array[i] = values[i]
+
+        self.assertTrue(np.all(array[np.arange(10)] == values))
+        self.assertTrue(np.all(array[3] == values[3]))
+
+        # fancy indices keep their shape, repeated indices are fine
+        indices = np.array([[1, 2], [2, 9]])
+        self.assertEqual(array[indices].shape, (2, 2, 4, 3))
+        self.assertTrue(np.all(array[indices] == values[indices]))
+
+    def testUnwrittenItems(self):
+        array = CompressedArray((3, 2), np.int16)
+        self.assertTrue(np.all(array[[0, 1, 2]] == 0))
+
+    def testCache(self):
+        array = CompressedArray((4, 2), np.uint8, cache_size=2)
+        for i in range(4):
+            array[i] = [i, i]
+
+        array[[0, 1, 2]]
+        self.assertEqual(list(array._cache.keys()), [1, 2])
+
+        # overwritten items are never read from the cache
+        array[2] = [7, 7]
+        self.assertTrue(np.all(array[2] == 7))
+
+    def testWriteWhileDecoding(self):
+        array = CompressedArray((4, 2), np.uint8, cache_size=2)
+        array[1] = [1, 1]
+
+        # a writer that overwrites the item while a reader decodes the old one
+        decode = array._decode
+
+        def decode_and_write(item):
+            value = decode(item)
+            array._decode = decode
+            array[1] = [9, 9]
+            return value
+
+        array._decode = decode_and_write
+        self.assertTrue(np.all(array[[1]] == 1))
+
+        # the old item must not end up in the cache
+        self.assertTrue(np.all(array[[1]] == 9))
+
+    def testThreads(self):
+        array = CompressedArray((100, 8, 8), np.uint8, cache_size=0, num_threads=2)
+        values = np.random.randint(0, 4, (100, 8, 8), dtype=np.uint8)
+        for i in range(100):
+            array[i] = values[i]
+
+        indices = np.random.randint(0, 100, (64,))
+        self.assertTrue(np.all(array[indices] == values[indices]))
+        self.assertLess(array.nbytes, values.nbytes)
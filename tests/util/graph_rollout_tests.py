@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+from graph_rollout import GraphRollout
+
+# the fields of the conv and fc models: uint8 observations, and the fc models have states without width
+FIELDS = {"observations": ((4, 4, 3), np.uint8),
+          "states": ((0,), tf.float32),
+          "advantages": ((1,), tf.float32)}
+
+
+def create_arrays(num_transitions):
+    return {"observations": np.random.randint(0, 256, (num_transitions, 4, 4, 3)).astype(np.uint8),
+            "states": np.empty((num_transitions, 0), dtype=np.float32),
+            "advantages": np.random.rand(num_transitions, 1).astype(np.float32)}
+
+
+class TestGraphRollout(TestCase):
+
+    def testGather(self):
+        with tf.Graph().as_default(), tf.Session() as session:
+            rollout = GraphRollout(FIELDS)
+            session.run(tf.global_variables_initializer())
+
+            arrays = create_arrays(10)
+            rollout.upload(session, arrays)
+
+            indices = np.array([7, 0, 3, 3])
+            minibatch = session.run(rollout.minibatch, feed_dict=rollout.create_feed_dict(indices))
+
+            for name, array in arrays.items():
+                self.assertEqual(minibatch[name].dtype, array.dtype)
+                self.assertTrue(np.array_equal(minibatch[name], array[indices]))
+
+            # the static shapes are known, the models can be applied to the minibatches
+            self.assertEqual(rollout.minibatch["observations"].shape.as_list(), [None, 4, 4, 3])
+            self.assertEqual(rollout.minibatch["states"].shape.as_list(), [None, 0])
+
+    def testUploadReplaces(self):
+        with tf.Graph().as_default(), tf.Session() as session:
+            rollout = GraphRollout(FIELDS)
+            session.run(tf.global_variables_initializer())
+            rollout.upload(session, create_arrays(10))
+
+            # the next update has a different number of transitions
+            arrays = create_arrays(6)
+            rollout.upload(session, arrays)
+
+            minibatch = session.run(rollout.minibatch, feed_dict=rollout.create_feed_dict(np.arange(6)))
+            for name, array in arrays.items():
+                self.assertTrue(np.array_equal(minibatch[name], array))
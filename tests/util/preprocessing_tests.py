@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+import numpy as np
+from preprocessing import FrameStack, preprocess_batch
+
+
+class TestPreprocessing(TestCase):
+
+    def setUp(self):
+        self.frames = np.random.randint(0, 256, size=(6, 40, 60, 3), dtype=np.uint8)
+
+    def testBatchGrayscale(self):
+        out = preprocess_batch(self.frames, (20, 10))
+
+        expected = self.frames[:, ::4, ::3].mean(axis=-1).astype(np.uint8)
+        self.assertEqual(out.shape, (6, 10, 20))
+        self.assertTrue(np.array_equal(out, expected))
+
+    def testBatchColors(self):
+        out = np.zeros((6, 20, 30, 3), dtype=np.uint8)
+        preprocess_batch(self.frames, (30, 20), out=out, grayscale=False)
+
+        self.assertTrue(np.array_equal(out, self.frames[:, ::2, ::2]))
+
+    def testBatchNativeResolution(self):
+        # frames that already have the final size are only copied
+        frames = self.frames[..., 0]
+        out = preprocess_batch(frames, (60, 40))
+
+        self.assertTrue(np.array_equal(out, frames))
+
+    def testBatchThreads(self):
+        out = preprocess_batch(self.frames, (20, 10), num_threads=3)
+
+        self.assertTrue(np.array_equal(out, preprocess_batch(self.frames, (20, 10))))
+
+    def testFrameStack(self):
+        stack = FrameStack((2, 2), 4)
+        observation = stack.reset(np.full((2, 2), 1))
+
+        expected = np.stack([np.full((2, 2), 1)] * 4, axis=-1)
+        self.assertTrue(np.array_equal(observation, expected))
+
+        # more steps than the buffer has slots
+        for step in range(2, 12):
+            from_observation, to_observation = stack.push(np.full((2, 2), step))
+
+            self.assertTrue(np.array_equal(from_observation, expected))
+            expected = np.concatenate([expected[..., 1:], np.full((2, 2, 1), step)], axis=-1)
+            self.assertTrue(np.array_equal(to_observation, expected))
+            self.assertTrue(np.array_equal(stack.observation(), expected))
+
+    def testFrameStackEnvironments(self):
+        stack = FrameStack((3,), 2, num_envs=2, preprocess_batch=lambda frames, out: np.copyto(out, frames, casting="unsafe"))
+        stack.reset(np.full((3,), 1), env=0)
+        stack.reset(np.full((3,), 2), env=1)
+
+        from_observations, to_observations = stack.push(np.array([[3, 3, 3], [4, 4, 4]]))
+        self.assertEqual(to_observations.shape, (2, 3, 2))
+        self.assertTrue(np.array_equal(to_observations[1, 0], [2, 4]))
+
+        # only the environment that is reset changes
+        observations = stack.reset(np.full((3,), 5), env=0)
+        self.assertTrue(np.array_equal(observations[0, 0], [5, 5]))
+        self.assertTrue(np.array_equal(observations[1, 0], [2, 4]))
@@ -0,0 +1,72 @@
+from unittest import TestCase
+
+import numpy as np
+from rollout_buffer import RolloutBuffer
+
+
+def transition(i):
+    # observation, state, to observation, to state, policy, value, action, reward, advantage, terminal, length
+    return (np.full((3,), i), [], np.full((3,), i + 1), [], np.full((2,), 0.5), float(i), np.eye(2)[i % 2],
+            float(i), 0.1 * i, i % 5 == 4, 1)
+
+
+class TestRolloutBuffer(TestCase):
+
+    def testShapes(self):
+        buffer = RolloutBuffer(8)
+        for i in range(5):
+            buffer.push(transition(i))
+
+        batch = buffer.pop()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(batch[0].shape, (5, 3))
+        self.assertEqual(batch[1].shape, (5, 0))
+        self.assertEqual(batch[6].shape, (5, 2))
+
+        # scalars get a column of their own, like np.vstack did
+        self.assertEqual(batch[5].shape, (5, 1))
+        self.assertEqual(batch[9].dtype, np.bool_)
+        self.assertTrue(np.array_equal(batch[7].ravel(), np.arange(5)))
+
+    def testSegments(self):
+        buffer = RolloutBuffer(4)
+        buffer.push(transition(0))
+
+        # a segment that doesn't fit, the arrays grow
+        segment = [np.array(field) for field in zip(*[transition(i) for i in range(1, 7)])]
+        buffer.push_many(segment)
+
+        self.assertEqual(len(buffer), 7)
+        self.assertTrue(np.array_equal(buffer.pop(3)[7].ravel(), [0, 1, 2]))
+        self.assertTrue(np.array_equal(buffer.pop()[7].ravel(), [3, 4, 5, 6]))
+
+    def testPoppedViews(self):
+        buffer = RolloutBuffer(4)
+        for i in range(4):
+            buffer.push(transition(i))
+
+        batch = buffer.pop(2)
+
+        # later writes don't change what has been popped, until the next pop
+        for i in range(10, 20):
+            buffer.push(transition(i))
+        self.assertTrue(np.array_equal(batch[7].ravel(), [0, 1]))
+
+        batch = buffer.pop(3)
+        for i in range(20, 40):
+            buffer.push(transition(i))
+        self.assertTrue(np.array_equal(batch[7].ravel(), [2, 3, 10]))
+
+    def testNoReallocation(self):
+        buffer = RolloutBuffer(4)
+        columns = []
+        for update in range(4):
+            for i in range(4):
+                buffer.push(transition(i))
+            columns.append(buffer.columns[0])
+            self.assertTrue(np.array_equal(buffer.pop()[7].ravel(), np.arange(4)))
+
+        # a drained buffer alternates between two sets of arrays, without allocating new ones
+        self.assertIs(columns[0], columns[2])
+        self.assertIs(columns[1], columns[3])
+        self.assertIsNot(columns[0], columns[1])
@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+import numpy as np
+from segment_tree import SumSegmentTree, MinSegmentTree, MaxSegmentTree
+
+
+class TestSegmentTree(TestCase):
+
+    def testReductions(self):
+        values = [3, 1, 4, 1, 5]
+
+        # 5 leaves, not a power of 2
+        sum_tree = SumSegmentTree(5)
+        min_tree = MinSegmentTree(5)
+        max_tree = MaxSegmentTree(5)
+        for tree in [sum_tree, min_tree, max_tree]:
+            tree.update_many(np.arange(5), values)
+
+        self.assertEqual(sum_tree.reduce(), 14)
+        self.assertEqual(min_tree.reduce(), 1)
+        self.assertEqual(max_tree.reduce(), 5)
+
+    def testEmptyLeaves(self):
+        # leaves that have never been written must not influence the minimum
+        tree = MinSegmentTree(6)
+        tree.update_many([1, 2], [7, 3])
+        self.assertEqual(tree.reduce(), 3)
+
+        tree.update_many([2], [9])
+        self.assertEqual(tree.reduce(), 7)
+
+    def testRangeReduction(self):
+        values = np.random.rand(13)
+
+        tree = SumSegmentTree(13)
+        tree.update_many(np.arange(13), values)
+
+        for start in range(13):
+            for end in range(start + 1, 14):
+                self.assertTrue(np.isclose(tree.reduce(start, end), values[start:end].sum()))
+
+    def testIndexing(self):
+        tree = MaxSegmentTree(3)
+        tree[[0, 2]] = [1, 2]
+
+        self.assertTrue(np.all(tree[[0, 2]] == [1, 2]))
+        self.assertEqual(tree.reduce(), 2)
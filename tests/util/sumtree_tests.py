@@ -44,3 +44,53 @@ class TestSumTree(TestCase):
         self.assertTrue(np.abs(np.sum(res == 3) / num_samples - 0.4) < 0.1)
         self.assertTrue(np.abs(np.sum(res == 2) / num_samples - 0.3) < 0.1)
         self.assertTrue(np.abs(np.sum(res == 1) / num_samples - 0.2) < 0.1)
+
+    def testStratifiedSampling(self):
+        tree = SumTree(4)
+        tree.push(0, 1)
+        tree.push(1, 2)
+        tree.push(2, 3)
+        tree.push(3, 4)
+
+        # with 10 segments of mass 1, every leaf gets exactly as many samples as its priority
+        res = tree.sample(10, stratified=True)
+
+        for idx in range(4):
+            self.assertEqual(np.sum(res == idx), idx + 1)
+
+    def testSamplingWithoutReplacement(self):
+        tree = SumTree(8)
+        tree.push(0, 1000)
+        tree.push(1, 1)
+        tree.push(2, 1)
+        tree.push(3, 1)
+
+        # leaf 0 dominates the priority mass, but every leaf may only be returned once
+        for stratified in [False, True]:
+            res = tree.sample(4, replace=False, stratified=stratified)
+            self.assertEqual(sorted(res), [0, 1, 2, 3])
+
+        # the masking during sampling must not change the stored priorities
+        self.assertEqual(tree._data[0], 1003)
+        self.assertEqual(tree._data[tree._offset], 1000)
+
+        # only 4 leaves have a priority, the priorities are restored after the failed sampling
+        with self.assertRaises(ValueError):
+            tree.sample(5, replace=False)
+        self.assertEqual(tree._data[0], 1003)
+
+    def testUpdateMany(self):
+        tree = SumTree(8)
+        tree.update_many([0, 1, 5, 7], [1, 2, 3, 4])
+
+        self.assertEqual(tree._data[0], 1 + 2 + 3 + 4)
+        # leaves 0 and 1 share their parent
+        self.assertEqual(tree._data[tree._offset // 2], 1 + 2)
+
+        # must give the same tree as pushing one leaf at a time
+        reference = SumTree(8)
+        for idx, val in zip([0, 1, 5, 7, 1], [1, 2, 3, 4, 6]):
+            reference.push(idx, val)
+        tree.update_many([1], [6])
+
+        self.assertTrue(np.allclose(tree._data, reference._data))
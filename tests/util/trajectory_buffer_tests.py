@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+import numpy as np
+from trajectory_buffer import TrajectoryBuffer, compute_gae
+
+GAMMA = 0.9
+LAMBDA = 0.8
+
+
+def weighted_sum_gae(rewards, values, terminal):
+    # the advantage of the first step, as the agents used to compute it for every step
+    padded_values = np.zeros((len(rewards) + 1,))
+    padded_values[:-1] = values
+    padded_values[-1] = values[-1] * (1 - terminal)
+
+    deltas = rewards + GAMMA * padded_values[1:] - padded_values[:-1]
+    weights = (GAMMA * LAMBDA) ** np.arange(len(deltas))
+    return (deltas * weights).sum()
+
+
+class TestTrajectoryBuffer(TestCase):
+
+    def testGae(self):
+        rewards = np.random.rand(10)
+        values = np.random.rand(10)
+
+        for terminal in [False, True]:
+            dones = np.zeros((10,), dtype=np.bool_)
+            dones[-1] = terminal
+            advantages = compute_gae(rewards, values, dones, GAMMA, LAMBDA)
+
+            for t in range(10):
+                self.assertAlmostEqual(advantages[t], weighted_sum_gae(rewards[t:], values[t:], terminal))
+
+    def testEnvironments(self):
+        # an episode ending in the middle of the segment splits it
+        rewards = np.random.rand(6, 2)
+        values = np.random.rand(6, 2)
+        dones = np.zeros((6, 2), dtype=np.bool_)
+        dones[2, 1] = True
+
+        advantages = compute_gae(rewards, values, dones, GAMMA, LAMBDA)
+
+        self.assertTrue(np.allclose(advantages[:, 0], compute_gae(rewards[:, 0], values[:, 0], dones[:, 0],
+                                                                  GAMMA, LAMBDA)))
+        self.assertAlmostEqual(advantages[0, 1], weighted_sum_gae(rewards[:3, 1], values[:3, 1], True))
+        self.assertAlmostEqual(advantages[3, 1], weighted_sum_gae(rewards[3:, 1], values[3:, 1], False))
+
+    def testFlush(self):
+        buffer = TrajectoryBuffer(4, GAMMA, LAMBDA)
+        for t in range(3):
+            buffer.record(np.full((2,), t), [], np.full((3,), 1 / 3), 0.5, np.eye(3)[t], 1., t == 2,
+                          np.full((2,), t + 1), [])
+
+        batch = buffer.flush()
+        self.assertEqual(len(buffer), 0)
+
+        (from_observations, from_states, to_observations, to_states, policies, values, actions, rewards, advantages,
+         terminals, lengths) = batch
+        self.assertEqual(from_observations.shape, (3, 2))
+        self.assertEqual(from_states.shape, (3, 0))
+        self.assertEqual(values.shape, (3,))
+
+        # every transition leads to the end of the episode
+        self.assertTrue(np.array_equal(to_observations[:, 0], [3, 3, 3]))
+        self.assertTrue(np.array_equal(lengths, [3, 2, 1]))
+        self.assertTrue(np.all(terminals))
+        self.assertAlmostEqual(advantages[0], weighted_sum_gae(np.ones(3), np.full((3,), 0.5), True))
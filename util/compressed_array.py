@@ -0,0 +1,109 @@
+# an array that keeps every item compressed in ram
+# it behaves like a numpy array for the operations the replay memory needs:
+# writing single items and reading items with (fancy) integer indices
+#
+# observations of most environments are large areas of the same color, zlib on its fastest level
+# compresses them by an order of magnitude and still takes only microseconds per frame
+# decoded items are kept in a small lru cache, stacked frames share most of their frames
+# zlib releases the gil, so decoding in a thread pool runs in parallel
+
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class CompressedArray:
+    def __init__(self, shape, dtype, compression_level=1, cache_size=1024, num_threads=0):
+        """
+        :param shape: shape of the array, the first axis is the one that gets indexed
+        :param dtype: dtype of the items
+        :param compression_level: zlib level, 1 is the fastest one
+        :param cache_size: number of decoded items kept in the cache, 0 switches off the cache
+        :param num_threads: number of threads decoding the items, 0 decodes in the calling thread
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.item_shape = self.shape[1:]
+        self.compression_level = compression_level
+        self.cache_size = cache_size
+
+        # items that have never been written are None and read as zeros
+        self._items = [None] * self.shape[0]
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        self._executor = ThreadPoolExecutor(num_threads) if num_threads else None
+
+        # only batches with at least this many items to decode are split across the threads
+        self.min_parallel_items = 4 * num_threads
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        # the size of the compressed items, the cache is not included
+        return sum(len(item) for item in self._items if item is not None)
+
+    def __setitem__(self, index, value):
+        assert np.ndim(index) == 0, "items can only be written one at a time"
+        index = int(index)
+
+        value = np.asarray(value, dtype=self.dtype)
+        assert value.shape == self.item_shape, "the item doesn't match the shape of the array"
+
+        self._items[index] = zlib.compress(value.tobytes(), self.compression_level)
+
+        with self._cache_lock:
+            self._cache.pop(index, None)
+
+    def __getitem__(self, index):
+        index = np.asarray(index, dtype=np.int64)
+
+        # every item is decoded at most once per call
+        unique, inverse = np.unique(index, return_inverse=True)
+        decoded = np.empty((len(unique), *self.item_shape), dtype=self.dtype)
+
+        missing = []
+        with self._cache_lock:
+            for i, item_index in enumerate(unique):
+                item = self._cache.get(item_index)
+                if item is None:
+                    missing.append(i)
+                else:
+                    self._cache.move_to_end(item_index)
+                    decoded[i] = item
+
+        items = [self._items[unique[i]] for i in missing]
+        if self._executor is not None and len(missing) >= self.min_parallel_items:
+            values = list(self._executor.map(self._decode, items))
+        else:
+            values = [self._decode(item) for item in items]
+
+        for i, value in zip(missing, values):
+            decoded[i] = value
+
+        if self.cache_size:
+            with self._cache_lock:
+                for i, item, value in zip(missing, items, values):
+                    # an item that has been written while we decoded it would be stale in the cache
+                    # the writer replaces the item before it evicts the cache entry, so comparing them is enough
+                    if self._items[unique[i]] is item:
+                        self._cache[unique[i]] = value
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return decoded[inverse.reshape(index.shape)]
+
+    def _decode(self, item):
+        if item is None:
+            return np.zeros(self.item_shape, dtype=self.dtype)
+        return np.frombuffer(zlib.decompress(item), dtype=self.dtype).reshape(self.item_shape)
+
+    def flush(self):
+        # there is nothing on disk, this keeps the interface of a memory map
+        pass
@@ -0,0 +1,42 @@
+# the training data of one update of the policy gradient brains, kept in tensorflow variables
+# the rollout is uploaded once per update, then every minibatch is gathered inside the graph
+# only the indices of a minibatch are fed, instead of slicing all fields in numpy and feeding them
+#
+# the number of transitions changes from update to update, so the variables don't validate their shapes
+import tensorflow as tf
+
+
+class GraphRollout:
+    def __init__(self, fields):
+        """
+        :param fields: dict of name -> (shape, dtype) of the fields of a single transition
+        after the upload, self.minibatch[name] is the gathered minibatch of that field
+        """
+        self.indices = tf.placeholder(tf.int32, shape=(None,), name="minibatch_indices")
+
+        self.placeholders = {}
+        self.minibatch = {}
+        uploads = []
+        for name, (shape, dtype) in fields.items():
+            placeholder = tf.placeholder(dtype, shape=(None, *shape), name="upload_" + name)
+            variable = tf.Variable(tf.zeros((0, *shape), dtype=dtype), trainable=False, validate_shape=False,
+                                   name="rollout_" + name)
+
+            # the variable has no static shape, the minibatch gets the shape of a transition back
+            minibatch = tf.gather(variable, self.indices)
+            minibatch.set_shape((None, *shape))
+
+            self.placeholders[name] = placeholder
+            self.minibatch[name] = minibatch
+            uploads.append(tf.assign(variable, placeholder, validate_shape=False))
+
+        self.upload_step = tf.group(*uploads)
+
+    def upload(self, session, rollout):
+        """
+        :param rollout: dict of name -> array with one row per transition, for all fields
+        """
+        session.run(self.upload_step, feed_dict={self.placeholders[name]: array for name, array in rollout.items()})
+
+    def create_feed_dict(self, indices):
+        return {self.indices: indices}
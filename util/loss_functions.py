@@ -1,7 +1,7 @@
 import tensorflow as tf
 
 
-def huber_loss(y_true, y_pred):
+def huber_loss(y_true, y_pred, sample_weights=None):
     # huber loss
     error = tf.abs(y_true - y_pred)
     mask = tf.abs(error) < 1
@@ -10,4 +10,10 @@ def huber_loss(y_true, y_pred):
     linear = 1 / 2 * error
 
     huber = tf.where(mask, square, linear)
+
+    # per sample weights, e.g. importance sampling weights for prioritized replay
+    # the weights have shape (batch_size, 1) and are broadcast over the last axis
+    if sample_weights is not None:
+        huber = huber * sample_weights
+
     return tf.reduce_sum(huber)
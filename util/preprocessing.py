@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import lycon
 import numpy as np
 
@@ -7,3 +9,169 @@ def preprocess_frame(frame, FRAME_SIZE):
                                interpolation=lycon.Interpolation.NEAREST)
     grayscale = downsampled.mean(axis=-1).astype(np.uint8)
     return grayscale
+
+
+# thread pools of preprocess_batch, by number of threads, they are created when they are first needed
+_executors = {}
+
+
+def preprocess_batch(frames, FRAME_SIZE, out=None, grayscale=True, num_threads=0):
+    """
+    preprocess_frame for a whole batch of frames, without calling lycon for every single one
+    the nearest neighbour resize is an index gather, the grayscale conversion uses integers only
+    :param frames: array of shape (N, H, W, C)
+    :param FRAME_SIZE: width and height of the resized frames
+    :param out: uint8 array of shape (N, height, width), or (N, height, width, C) without grayscale
+    :param grayscale: False keeps the channels
+    :param num_threads: the batch is split across that many threads, numpy releases the gil
+    :return: out
+    """
+    frames = np.asarray(frames)
+    num_frames = len(frames)
+    out_shape = (num_frames, FRAME_SIZE[1], FRAME_SIZE[0]) + ((frames.shape[-1],) if not grayscale else ())
+    if out is None:
+        out = np.empty(out_shape, dtype=np.uint8)
+    assert out.shape == out_shape, "out doesn't match the shape of the preprocessed frames"
+
+    # frames that are rendered at the final resolution are only copied
+    if frames.shape == out_shape:
+        np.copyto(out, frames, casting="unsafe")
+        return out
+
+    num_frames, height, width, channels = frames.shape
+
+    # the source pixels of nearest neighbour interpolation, the same as lycon and opencv pick
+    rows = np.arange(FRAME_SIZE[1]) * height // FRAME_SIZE[1]
+    columns = np.arange(FRAME_SIZE[0]) * width // FRAME_SIZE[0]
+
+    def preprocess_chunk(start, end):
+        resized = frames[start:end, rows[:, None], columns]
+        if not grayscale:
+            out[start:end] = resized
+            return
+
+        # integer grayscale, the same as truncating the mean of the channels
+        channel_sum = np.sum(resized, axis=-1, dtype=np.uint16)
+        np.floor_divide(channel_sum, channels, out=out[start:end], casting="unsafe")
+
+    if num_threads <= 1 or num_frames < 2 * num_threads:
+        preprocess_chunk(0, num_frames)
+        return out
+
+    if num_threads not in _executors:
+        _executors[num_threads] = ThreadPoolExecutor(num_threads)
+    bounds = np.linspace(0, num_frames, num_threads + 1).astype(np.int64)
+    futures = [_executors[num_threads].submit(preprocess_chunk, start, end) for start, end in zip(bounds, bounds[1:])]
+    for future in futures:
+        future.result()
+
+    return out
+
+
+class GrayscaleResizer:
+    # preprocess_frame without allocations:
+    # the resized frame and the channel sum go to buffers that are allocated once
+    def __init__(self, frame_size):
+        """
+        :param frame_size: width and height of the resized frames, like in preprocess_frame
+        """
+        self.width, self.height = frame_size
+        self._resized = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self._sum = np.empty((self.height, self.width), dtype=np.uint16)
+
+    def __call__(self, frame, out):
+        # frames that are rendered at the final resolution are only copied
+        if frame.shape == out.shape:
+            np.copyto(out, frame, casting="unsafe")
+            return out
+
+        lycon.resize(frame, width=self.width, height=self.height, interpolation=lycon.Interpolation.NEAREST,
+                     output=self._resized)
+
+        # integer grayscale, the same as truncating the mean of the channels
+        np.sum(self._resized, axis=-1, dtype=np.uint16, out=self._sum)
+        np.floor_divide(self._sum, 3, out=out, casting="unsafe")
+        return out
+
+
+class FrameStack:
+    # keeps the newest frames of an agent in a circular buffer, the stacked observations are views into it
+    # every new frame is written once (twice, see below), instead of copying the whole stack every step
+    #
+    # the buffer holds frame_stack + 1 frames, the from and the to observation of the latest step
+    # every frame is stored at slot i and slot i + length,
+    # so the newest frames always form a contiguous range of slots, whatever the position in the circle is
+    # the views are only valid until the next push or reset
+    def __init__(self, frame_shape, frame_stack, preprocess=None, dtype=np.uint8, num_envs=None,
+                 preprocess_batch=None):
+        """
+        :param frame_shape: shape of the preprocessed frames
+        :param frame_stack: number of stacked frames, 0 uses the frames without a stack axis
+        :param preprocess: function(frame, out) writing a preprocessed frame to out, by default frames are copied
+        :param num_envs: if given, the frames of that many environments are stacked together, with a leading axis
+        :param preprocess_batch: function(frames, out) preprocessing the frames of all environments in one call
+        """
+        self.frame_stack = frame_stack
+        self.stack_size = max(frame_stack, 1)
+        self.length = self.stack_size + 1
+        self.preprocess = preprocess
+        self.preprocess_batch = preprocess_batch
+        self.num_envs = num_envs
+
+        env_shape = () if num_envs is None else (num_envs,)
+        self._frames = np.zeros((2 * self.length, *env_shape, *frame_shape), dtype=dtype)
+
+        # the slot of the newest frame
+        self._position = 0
+
+    def _write(self, frame, out):
+        if self.preprocess is None:
+            np.copyto(out, frame, casting="unsafe")
+        else:
+            self.preprocess(frame, out)
+
+    def _window(self, size):
+        # the newest frames, oldest first, with the stack as last axis
+        end = self._position + self.length + 1
+        frames = self._frames[end - size:end]
+        if self.frame_stack:
+            return np.moveaxis(frames, 0, -1)
+        return frames[-1]
+
+    def observation(self):
+        return self._window(self.stack_size)
+
+    def reset(self, frame, env=None):
+        """
+        fills the stack with the first frame of an episode, like the agents did with np.stack
+        :param env: for several environments, the one that is reset
+        :return: the new observation
+        """
+        target = self._frames if env is None else self._frames[:, env]
+        self._write(frame, target[self._position])
+        target[:] = target[self._position]
+        return self.observation()
+
+    def push(self, frames):
+        """
+        adds the newest frame, or the newest frames of all environments
+        :return: the from and to observation of this step
+        """
+        self._position = (self._position + 1) % self.length
+
+        newest = self._frames[self._position]
+        if self.num_envs is None:
+            self._write(frames, newest)
+        elif self.preprocess_batch is not None:
+            self.preprocess_batch(frames, newest)
+        else:
+            for env in range(self.num_envs):
+                self._write(frames[env], newest[env])
+        self._frames[self._position + self.length] = newest
+
+        if self.frame_stack:
+            window = self._window(self.length)
+            return window[..., :-1], window[..., 1:]
+
+        window = self._frames[self._position + self.length - 1:self._position + self.length + 1]
+        return window[0], window[1]
@@ -0,0 +1,32 @@
+# compares preprocessing frame by frame with preprocess_batch
+# the frames have the size of the obstacle car environment, the batches that of a vectorized agent
+import time
+
+import numpy as np
+
+from util.preprocessing import preprocess_batch, preprocess_frame
+
+FRAME_SIZE = (84, 84)
+BATCH_SIZE = 64
+NUM_BATCHES = 50
+
+
+def benchmark(name, preprocess, frames):
+    preprocess(frames)
+
+    start_time = time.time()
+    for batch in range(NUM_BATCHES):
+        preprocess(frames)
+    batch_time = (time.time() - start_time) / NUM_BATCHES
+
+    print("{}: {:.0f} frames per second".format(name, len(frames) / batch_time))
+
+
+if __name__ == "__main__":
+    frames = np.random.randint(0, 256, size=(BATCH_SIZE, 400, 400, 3), dtype=np.uint8)
+    out = np.empty((BATCH_SIZE, FRAME_SIZE[1], FRAME_SIZE[0]), dtype=np.uint8)
+
+    benchmark("per frame", lambda frames: [preprocess_frame(frame, FRAME_SIZE) for frame in frames], frames)
+    for num_threads in [0, 2, 4]:
+        benchmark("batch, {} threads".format(num_threads),
+                  lambda frames: preprocess_batch(frames, FRAME_SIZE, out=out, num_threads=num_threads), frames)
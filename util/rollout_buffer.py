@@ -0,0 +1,104 @@
+# the training data of the policy gradient agents, ppo and a3c
+# every field is a preallocated numpy array with one row per transition, instead of a python list
+# the brains get these arrays directly, there is no conversion from lists before every update
+#
+# the shapes and dtypes of the fields are taken from the first data that is written
+# only the models know the shapes of observations and states
+import numpy as np
+
+# the fields of a transition, in the order of the batches the agents push and the brains optimize on
+FIELDS = ("from_observations", "from_states", "to_observations", "to_states", "pred_policies", "pred_values",
+          "actions", "rewards", "advantages", "terminals", "lengths")
+
+
+class RolloutBuffer:
+    def __init__(self, capacity):
+        """
+        :param capacity: number of transitions the arrays are allocated for, they grow if more are written
+        """
+        self.capacity = capacity
+
+        # the transitions are kept in [start, end) of the arrays
+        self.columns = None
+        self.start = 0
+        self.end = 0
+
+        # a second set of arrays, the writes move there while views of the current arrays are in use
+        self.spare_columns = None
+        self.lent = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _allocate(self, items, capacity):
+        # scalars, like values and rewards, are stored as columns of shape (1,), as the brains need them
+        return [np.empty((capacity, *(item.shape[1:] if item.ndim > 1 else (1,))), dtype=item.dtype)
+                for item in items]
+
+    def _make_room(self, size):
+        # moves what hasn't been popped to the beginning of the arrays
+        # if pop has returned views of the current arrays, they are left alone and the spare arrays are used
+        # the spare arrays have only been popped from before the last pop, so the views of the last pop stay valid
+        if self.lent:
+            columns = self.spare_columns
+            self.spare_columns = self.columns
+        else:
+            columns = self.columns
+
+        if columns is None or len(self) + size > len(columns[0]):
+            columns = self._allocate(self.columns, max(self.capacity, 2 * (len(self) + size)))
+
+        # the ranges can overlap when moving within the same arrays, numpy copies them correctly
+        for column, new_column in zip(self.columns, columns):
+            new_column[:len(self)] = column[self.start:self.end]
+
+        self.columns = columns
+        self.end = len(self)
+        self.start = 0
+        self.lent = False
+
+    def push(self, batch):
+        """
+        writes a single transition
+        :param batch: tuple of the fields of one transition, in the order of FIELDS
+        """
+        self.push_many([np.asarray(item)[None] for item in batch])
+
+    def push_many(self, batch):
+        """
+        writes a whole segment of transitions at once
+        :param batch: tuple of arrays, one per field, in the order of FIELDS, one row per transition
+        """
+        assert len(batch) == len(FIELDS), "a batch needs all fields of the transitions"
+        batch = [np.asarray(item) for item in batch]
+        size = len(batch[0])
+
+        if self.columns is None:
+            self.columns = self._allocate(batch, self.capacity)
+
+        # a drained buffer starts at the beginning again, nothing has to be moved
+        if self.end + size > len(self.columns[0]) or (len(self) == 0 and self.start > 0):
+            self._make_room(size)
+
+        for column, item in zip(self.columns, batch):
+            column[self.end:self.end + size] = item.reshape((size, *column.shape[1:]))
+        self.end += size
+
+    def pop(self, size=None):
+        """
+        removes the oldest transitions
+        :param size: number of transitions, by default all of them
+        :return: list of arrays, one per field, they are views and stay valid until the next pop
+        """
+        if size is None:
+            size = len(self)
+        size = min(size, len(self))
+
+        if self.columns is None:
+            return [np.empty((0,)) for field in FIELDS]
+
+        batch = [column[self.start:self.start + size] for column in self.columns]
+        self.start += size
+        self.lent = True
+
+        return batch
@@ -0,0 +1,107 @@
+# an array based segment tree, the layout is the same as in sumtree.py:
+# node i has the children 2 * i + 1 and 2 * i + 2, the leaves are stored at the end of the array
+# the capacity doesn't have to be a power of 2, the leaves are padded with the neutral element
+
+import numpy as np
+
+
+class SegmentTree:
+    def __init__(self, capacity, operation, neutral_element):
+        """
+        :param capacity: number of leaves
+        :param operation: a numpy ufunc combining two children, e.g. np.add, np.minimum
+        :param neutral_element: value of empty leaves, operation(x, neutral_element) == x
+        """
+        self.capacity = capacity
+        self.operation = operation
+        self.neutral_element = neutral_element
+
+        # the number of leaves is rounded up to the next power of 2
+        self._depth = int(np.ceil(np.log2(max(capacity, 1))))
+        self._size = 2 ** self._depth
+
+        self._length = 2 * self._size - 1
+        self._offset = self._size - 1
+
+        self._data = np.full((self._length,), neutral_element, dtype=np.float64)
+
+    def __len__(self):
+        return self.capacity
+
+    def __getitem__(self, indices):
+        return self._data[self._offset + np.asarray(indices, dtype=np.int64)]
+
+    def __setitem__(self, indices, values):
+        self.update_many(indices, values)
+
+    def update(self, index, value):
+        # a single leaf is updated with scalar indexing, the memories do this on every push
+        # the vectorized version would pay for np.unique and fancy indexing on every level
+        assert 0 <= index < self.capacity, "index out of range"
+        arr_idx = self._offset + int(index)
+        self._data[arr_idx] = value
+
+        while arr_idx > 0:
+            arr_idx = (arr_idx - 1) // 2
+            self._data[arr_idx] = self.operation(self._data[2 * arr_idx + 1], self._data[2 * arr_idx + 2])
+
+    def update_many(self, indices, values):
+        # writes all leaves, then recomputes the parents level by level
+        # shared parents are only computed once per level
+        indices = np.asarray(indices, dtype=np.int64).reshape((-1,))
+        values = np.asarray(values, dtype=np.float64).reshape((-1,))
+        if len(indices) == 1:
+            self.update(indices[0], values[0])
+            return
+
+        arr_idx = self._offset + indices
+        assert np.all(arr_idx < self._offset + self.capacity), "index out of range"
+
+        self._data[arr_idx] = values
+
+        for level in range(self._depth):
+            arr_idx = np.unique((arr_idx - 1) // 2)
+            self._data[arr_idx] = self.operation(self._data[2 * arr_idx + 1], self._data[2 * arr_idx + 2])
+
+    def reduce(self, start=0, end=None):
+        # the reduction over all leaves is cached in the root
+        if end is None:
+            end = self.capacity
+        if start == 0 and end >= self.capacity:
+            return self._data[0]
+
+        # reduction over the leaves [start, end)
+        # walks up from both borders, collecting the nodes that are completely inside the range
+        result = self.neutral_element
+        lower = start + self._offset
+        upper = end + self._offset - 1
+        while lower <= upper:
+            # a right child at the lower border (or a left child at the upper border)
+            # doesn't share its parent with the range, so it is used directly
+            if lower % 2 == 0:
+                result = self.operation(result, self._data[lower])
+                lower += 1
+            if upper % 2 == 1:
+                result = self.operation(result, self._data[upper])
+                upper -= 1
+            if lower > upper:
+                break
+            lower = (lower - 1) // 2
+            upper = (upper - 1) // 2
+
+        return result
+
+
+class SumSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        SegmentTree.__init__(self, capacity, np.add, 0.)
+
+
+class MinSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        SegmentTree.__init__(self, capacity, np.minimum, np.inf)
+
+
+class MaxSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        SegmentTree.__init__(self, capacity, np.maximum, -np.inf)
@@ -11,56 +11,106 @@ class SumTree:
 
         self._length = 2 * size - 1
         self._offset = size - 1
+        self._depth = int(np.log2(size))
 
-        self._data = np.zeros((self._length, 1))
+        self._data = np.zeros((self._length,))
 
     def pop(self, idx):
         self.push(idx, 0)
 
     def push(self, idx, val):
-        arr_idx = self._offset + idx
-
-        delta = val - self._data[arr_idx]
+        # a single leaf is updated with scalar indexing, this runs on every step of the agent
+        # the vectorized version would pay for np.unique and fancy indexing on every level
+        arr_idx = self._offset + int(idx)
         self._data[arr_idx] = val
 
-        parent_idx = (arr_idx - 1) // 2
-        arr_idx = parent_idx
-        self._data[arr_idx] += delta
-
-        while (parent_idx != 0):
-            parent_idx = (arr_idx - 1) // 2
-            arr_idx = parent_idx
-            self._data[arr_idx] += delta
-
-    def sample(self, n, replace=True):
-
-        samples = []
-        for i in range(n):
-
-            # this loop generates samples
-            # if replace == False, the loop exits on the first new sample
-            # be careful: the class doesn't know how many samples have been stored
-            # if you set replace=False and request more samples than actually available, this is an endless loop
-            while True:
-                rand = np.random.rand()
-                rand *= self._data[0]
-
-                idx = 0
-                while (idx < self._offset):
-                    left_idx = 2 * idx + 1
-                    right_idx = 2 * idx + 2
-
-                    left_val = self._data[left_idx]
-
-                    if left_val >= rand:
-                        idx = left_idx
-                    else:
-                        idx = right_idx
-                        rand -= left_val
-
-                new_sample = idx - self._offset
-                if replace or new_sample not in samples:
-                    samples.append(idx - self._offset)
-                    break
-
-        return np.array(samples)
+        while arr_idx > 0:
+            arr_idx = (arr_idx - 1) // 2
+            self._data[arr_idx] = self._data[2 * arr_idx + 1] + self._data[2 * arr_idx + 2]
+
+    def update_many(self, indices, values):
+        # writes all leaves at once, then recomputes their ancestors level by level
+        # parents shared by several leaves are only computed once per level
+        # recomputing instead of propagating deltas also keeps rounding errors from accumulating
+        indices = np.asarray(indices, dtype=np.int64).reshape((-1,))
+        values = np.asarray(values, dtype=np.float64).reshape((-1,))
+        if len(indices) == 1:
+            self.push(indices[0], values[0])
+            return
+
+        arr_idx = self._offset + indices
+        self._data[arr_idx] = values
+
+        for level in range(self._depth):
+            arr_idx = np.unique((arr_idx - 1) // 2)
+            self._data[arr_idx] = self._data[2 * arr_idx + 1] + self._data[2 * arr_idx + 2]
+
+    def get(self, indices):
+        return self._data[self._offset + np.asarray(indices, dtype=np.int64)]
+
+    def find(self, values):
+        # descends the tree for all values at once, one level per iteration
+        # every value is a point in [0, total priority], the result is the leaf whose segment contains it
+        values = np.array(values, dtype=np.float64).reshape((-1,))
+        idx = np.zeros(values.shape, dtype=np.int64)
+
+        for level in range(self._depth):
+            left_idx = 2 * idx + 1
+            left_val = self._data[left_idx]
+
+            # same rule as the scalar version: go left if left_val >= value
+            go_right = values > left_val
+            values -= left_val * go_right
+            idx = left_idx + go_right
+
+        return idx - self._offset
+
+    def sample(self, n, replace=True, stratified=False):
+        # if stratified, the total priority is split into n segments of equal mass
+        # and every segment contributes exactly one uniform draw
+        if stratified:
+            values = (np.arange(n) + np.random.rand(n)) / n
+        else:
+            values = np.random.rand(n)
+        values *= self._data[0]
+
+        samples = self.find(values)
+
+        if replace:
+            return samples
+
+        # sampling without replacement:
+        # the leaves we already have are masked out (priority 0) and the missing samples are drawn again
+        # every round adds at least one new leaf, so this terminates after at most n rounds
+        # the original priorities are restored afterwards
+        samples = np.unique(samples)
+
+        masked_indices = np.empty((0,), dtype=np.int64)
+        masked_values = np.empty((0,))
+        while len(samples) < n:
+            new_indices = np.setdiff1d(samples, masked_indices)
+            masked_indices = np.concatenate([masked_indices, new_indices])
+            masked_values = np.concatenate([masked_values, self.get(new_indices)])
+            self.update_many(new_indices, np.zeros(new_indices.shape))
+
+            # the callers check the number of samples, but fewer leaves than that can have a priority
+            # once all of them are masked, the root is 0
+            if self._data[0] <= 0:
+                self.update_many(masked_indices, masked_values)
+                raise ValueError("trying to sample more samples than available")
+
+            missing = n - len(samples)
+            if stratified:
+                values = (np.arange(missing) + np.random.rand(missing)) / missing
+            else:
+                values = np.random.rand(missing)
+            values *= self._data[0]
+
+            samples = np.union1d(samples, self.find(values))
+
+        if len(masked_indices) > 0:
+            self.update_many(masked_indices, masked_values)
+
+        # np.unique and np.union1d sort the leaves, shuffle to keep the batch order random
+        np.random.shuffle(samples)
+        return samples
@@ -0,0 +1,112 @@
+# the steps an agent has made since it last pushed to the memory, in preallocated arrays
+# a segment ends after a fixed number of steps or with the end of an episode
+# then the advantages of the whole segment are computed in one backward pass and it is pushed in one piece
+#
+# several environments that are stepped together share one buffer, their segments have the same length
+# an episode that ends within the segment of such an environment just splits it
+import numpy as np
+
+
+def compute_gae(rewards, values, dones, gamma, lam):
+    """
+    generalized advantage estimation for all steps of a segment, compare (16) in the gae paper
+    a single backward pass, instead of summing the weighted deltas for every step
+    :param rewards: array of shape (T,), or (T, K) for several environments
+    :param values: the predicted values of the steps, same shape as rewards
+    :param dones: whether an episode ended with the step, same shape as rewards
+    :return: the advantages, same shape as rewards
+    """
+    advantages = np.empty(np.shape(rewards), dtype=np.float64)
+
+    # the value after the last step is bootstrapped from the value of the last step itself
+    # that is how the agents have always done it, the value of the next observation isn't predicted yet
+    next_value = values[-1]
+    advantage = 0.
+    for t in reversed(range(len(rewards))):
+        not_done = 1. - dones[t]
+
+        # delta functions are 1 step TD lambda
+        delta = rewards[t] + gamma * next_value * not_done - values[t]
+        advantage = delta + gamma * lam * not_done * advantage
+
+        advantages[t] = advantage
+        next_value = values[t]
+
+    return advantages
+
+
+class TrajectoryBuffer:
+    def __init__(self, num_steps, gamma, lam, num_envs=None):
+        """
+        :param num_steps: maximal length of a segment
+        :param gamma: discount factor
+        :param lam: lambda of the gae
+        :param num_envs: if given, every step has a leading axis for that many environments
+        """
+        self.num_steps = num_steps
+        self.gamma = gamma
+        self.lam = lam
+        self.num_envs = num_envs
+
+        # observation, state, policy, value, action, reward, done, next observation, next state
+        # the arrays are allocated with the first step, only then the shapes are known
+        self.steps = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.size = 0
+
+    def record(self, observation, state, policy, value, action, reward, done, next_observation, next_state):
+        """
+        adds one step, the state is the one the policy was predicted with
+        if the episode is done, next_observation is usually zeros
+        """
+        assert self.size < self.num_steps, "the segment is full, it has to be flushed first"
+
+        step = [np.asarray(item) for item in
+                (observation, state, policy, value, action, reward, done, next_observation, next_state)]
+        if self.num_envs is None:
+            step = [item[None] for item in step]
+
+        if self.steps is None:
+            self.steps = [np.empty((self.num_steps, *item.shape), dtype=item.dtype) for item in step]
+
+        for array, item in zip(self.steps, step):
+            array[self.size] = item
+        self.size += 1
+
+    def flush(self):
+        """
+        empties the buffer
+        :return: the transitions of the segment, as a batch for the push_many of the memories
+        the environments follow each other, the steps of each one are in order
+        the arrays can be views into the buffer, they are only valid until the next step is recorded
+        """
+        size = self.size
+        observations, states, policies, values, actions, rewards, dones, next_observations, next_states = [
+            array[:size] for array in self.steps]
+
+        advantages = compute_gae(rewards, values, dones, self.gamma, self.lam)
+
+        # every transition leads to the end of its episode, or to the end of the segment
+        ends = np.empty(dones.shape, dtype=np.int64)
+        end = np.full(dones.shape[1:], size)
+        for t in reversed(range(size)):
+            end = np.where(dones[t], t + 1, end)
+            ends[t] = end
+
+        env_indices = np.arange(dones.shape[1])
+        to_observations = next_observations[ends - 1, env_indices]
+        to_states = next_states[ends - 1, env_indices]
+        terminals = dones[ends - 1, env_indices]
+        lengths = ends - np.arange(size)[:, None]
+
+        batch = (observations, states, to_observations, to_states, policies, values, actions, rewards, advantages,
+                 terminals, lengths)
+        self.size = 0
+
+        num_transitions = dones.size
+        return tuple(np.swapaxes(item, 0, 1).reshape((num_transitions, *item.shape[2:])) for item in batch)